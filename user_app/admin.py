@@ -1,9 +1,146 @@
-from django.contrib import admin
-from .models import user, CustomizedEmailDevice
+import uuid
+
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connections, models
+from django.utils.functional import cached_property
+
+from .phones import to_python
+
+from . import profile_cache, verification_state
+from .models import user, CustomizedEmailDevice, OutboxEmail, AccountDeletion, PendingVerification
+
+
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    On PostgreSQL, an unfiltered changelist uses the planner's row estimate (pg_class.reltuples) instead
+    of a full "COUNT(*)", once the table is big enough for the difference to matter. Filtered lists
+    (and other databases) still get an exact count.
+    '''
+
+    exact_count_threshold = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > self.exact_count_threshold:
+                return row[0]
+        return super().count
+
+
+
+def exact_user_search(search_term, prefix=''):
+    """
+    Builds the admin search query: only exact matches on the user's (unique, hence indexed) phone, email
+    and uuid fields, since the default "icontains" search would scan the whole table.
+    """
+    term = search_term.strip()
+    if not term:
+        return None
+
+    query = models.Q(**{f'{prefix}email': term})
+    phone = to_python(term)
+    if phone and phone.is_valid():
+        query |= models.Q(**{f'{prefix}phone': phone})
+    try:
+        query |= models.Q(**{f'{prefix}uuid_value': uuid.UUID(term)})
+    except ValueError:
+        pass
+    return query
+
 
 
 # REGISTER your MODELS here.
 
 
-admin.site.register(user)
-admin.site.register(CustomizedEmailDevice)
+@admin.register(user)
+class UserAdmin(admin.ModelAdmin):
+    list_display = ('phone', 'email', 'first_name', 'last_name', 'is_active', 'email_verified', 'date_joined')
+    list_filter = ('is_active', 'email_verified', 'is_staff')
+    search_fields = ('phone', 'email', 'uuid_value') # see "exact_user_search()"
+    search_help_text = 'Exact phone number, email address or uuid'
+    readonly_fields = ('uuid_value', 'last_login', 'date_joined')
+    ordering = ('-pk',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['activate_users', 'deactivate_users']
+
+    def get_search_results(self, request, queryset, search_term):
+        query = exact_user_search(search_term)
+        return (queryset.filter(query) if query else queryset), False
+
+    def set_active(self, queryset, is_active):
+        # One UPDATE; "QuerySet.update()" sends no post_save signals, so the caches are invalidated here
+        rows = list(queryset.values_list('pk', 'uuid_value'))
+        updated = queryset.update(is_active=is_active)
+        profile_cache.invalidate_on_commit(*(uuid_value for _, uuid_value in rows), using=queryset.db)
+        verification_state.bump_version_on_commit(*(pk for pk, _ in rows), using=queryset.db)
+        return updated
+
+    @admin.action(description='Activate selected users')
+    def activate_users(self, request, queryset):
+        updated = self.set_active(queryset, True)
+        self.message_user(request, f'{updated} user(s) activated.', messages.SUCCESS)
+
+    @admin.action(description='Deactivate selected users')
+    def deactivate_users(self, request, queryset):
+        updated = self.set_active(queryset, False)
+        self.message_user(request, f'{updated} user(s) deactivated.', messages.SUCCESS)
+
+
+
+@admin.register(CustomizedEmailDevice)
+class CustomizedEmailDeviceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'user', 'confirmed', 'throttling_failure_count')
+    list_filter = ('confirmed',)
+    list_select_related = ('user',)
+    autocomplete_fields = ('user',)
+    search_fields = ('user__phone', 'user__email')
+    search_help_text = 'Exact phone number or email address of the user'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        query = exact_user_search(search_term, prefix='user__')
+        return (queryset.filter(query) if query else queryset), False
+
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipients', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+
+@admin.register(AccountDeletion)
+class AccountDeletionAdmin(admin.ModelAdmin):
+    list_display = ('user_uuid', 'status', 'deleted_rows', 'requested_at', 'started_at', 'finished_at')
+    list_filter = ('status',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+
+@admin.register(PendingVerification)
+class PendingVerificationAdmin(admin.ModelAdmin):
+    list_display = ('target', 'kind', 'user', 'attempts', 'created_at', 'expires_at')
+    list_filter = ('kind',)
+    list_select_related = ('user',)
+    autocomplete_fields = ('user',)
+    search_fields = ('target',) # exact matches only, see "get_search_results()"
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        return (queryset.filter(target=term) if term else queryset), False
@@ -0,0 +1,33 @@
+'''
+user_app.async_urls
+
+The same URLs (and names) as "user_app.urls", with the verification views replaced by their async
+counterparts from "user_app.async_views". For ASGI deployments:
+
+    path('user/', include('user_app.async_urls')),
+'''
+
+from django.urls import path
+
+from . import async_views
+from .urls import urlpatterns as sync_urlpatterns
+
+
+
+
+app_name = 'user_app'
+
+ASYNC_VIEWS = {
+    'create': async_views.AsyncUserCreate,
+    'twilio_token_send_again': async_views.AsyncTwilioTokenSendAgain,
+    'phone_verify': async_views.AsyncUserPhoneVerify,
+    'phone_change': async_views.AsyncUserPhoneChange,
+    'email_verify': async_views.AsyncUserEmailVerify,
+    'email_change': async_views.AsyncUserEmailChange,
+    'otp_verify': async_views.AsyncUserOTPVerify,
+}
+
+urlpatterns = [
+    path(str(pattern.pattern), ASYNC_VIEWS[pattern.name].as_view(), name=pattern.name) if pattern.name in ASYNC_VIEWS else pattern
+    for pattern in sync_urlpatterns
+]
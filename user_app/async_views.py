@@ -0,0 +1,298 @@
+'''
+user_app.async_views
+
+Async (ASGI-native) counterparts of the verification views: signup, phone verification, sending
+the code again, phone change, and the email verification, email change and OTP views. They await
+the SMS provider ("twilio_verify.atoken_send()"/"atoken_verify()"; non-blocking with
+"AsyncTwilioBackend") and use the async ORM, so under ASGI a request waiting on Twilio doesn't hold
+a thread. Transactions, form validation that queries the database and session access still run
+in Django's sync thread ("sync_to_async()").
+
+The OTP emails are sent while the (sync) OTP forms validate; with USER_APP_EMAIL_OUTBOX, that is
+a single INSERT instead of an SMTP round-trip.
+
+To use them, include "user_app.async_urls" instead of "user_app.urls" (same URLs and names).
+'''
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth import login as auth_login
+from django.contrib.auth.views import redirect_to_login
+from django.db import IntegrityError, transaction
+from django.http import Http404, HttpResponseRedirect
+from django.shortcuts import resolve_url
+from django.template.response import TemplateResponse
+from django.urls import reverse, reverse_lazy
+from django.utils.http import url_has_allowed_host_and_scheme
+from django.views import View
+
+from .forms import CustomizedUserCreationForm, CustomizedOTPTokenForm, EmailChangeForm, EmailVerificationForm, PhoneVerificationForm, PhoneChangeForm
+from .idempotency import idempotent
+from .models import user as customized_user_model, PendingVerification
+from .throttling import is_rate_limited
+from .verification_state import get_state
+from .sms_backends import COOLDOWN, PENDING
+from .views import CODE_ALREADY_SENT_MESSAGE, PHONE_CHANGE_EXPIRED_MESSAGE, RATE_LIMITED_MESSAGE, is_signup_rate_limited
+from . import deletion, twilio_verify
+
+
+
+
+async def aget_user(request):
+    '''
+    Returns "request.user", loading it (and the session) in the sync thread; the lazy object can't be evaluated in async code.
+    '''
+    await sync_to_async(lambda: request.user.is_authenticated)()
+    return request.user
+
+
+
+class AsyncFormView(View):
+    '''
+    The async views' common parts: rendering a form, and the login/verification gates (checked in "dispatch()",
+    since the sync mixins and decorators would touch the session from async code).
+    '''
+
+    template_name = None
+    form_class = None
+    login_required = False
+    state_test = None # a (test_func, login_url) pair, as in "decorators.state_passes_test()"
+
+    async def dispatch(self, request, *args, **kwargs):
+        if self.login_required or self.state_test:
+            user = await aget_user(request)
+            if not user.is_authenticated:
+                return redirect_to_login(request.get_full_path(), settings.LOGIN_URL)
+        if self.state_test:
+            test_func, login_url = self.state_test
+            state = await sync_to_async(get_state)(request)
+            if state is None or not test_func(state):
+                return redirect_to_login(request.get_full_path(), login_url)
+        return await super().dispatch(request, *args, **kwargs)
+
+    def render(self, form):
+        return TemplateResponse(self.request, self.template_name, {'form': form, 'view': self})
+
+    async def get(self, request, *args, **kwargs):
+        return self.render(await sync_to_async(self.get_form)())
+
+    def get_form(self, data=None):
+        return self.form_class(data)
+
+
+
+class AsyncUUIDUserMixin:
+
+    async def aget_uuid_user(self):
+        try:
+            return await customized_user_model.objects.aget(uuid_value=self.kwargs['uuid_value'])
+        except customized_user_model.DoesNotExist:
+            raise Http404('No user found matching the query')
+
+    async def aget_verifiable_uuid_user(self):
+        # See "views.UUIDUserMixin.get_verifiable_uuid_user()"
+        user = await self.aget_uuid_user()
+        if await deletion.ais_pending(user):
+            raise Http404('No user found matching the query')
+        return user
+
+
+
+class AsyncUserCreate(AsyncFormView):
+    template_name = 'user_app/user_create_form.html'
+    form_class = CustomizedUserCreationForm
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # "method_decorator()" can't wrap async handlers (before Django 5.0), so the whole view is wrapped
+        return idempotent('signup')(super().as_view(**initkwargs))
+
+    async def get(self, request, *args, **kwargs):
+        return self.render(self.get_form()) # an empty form needs no query
+
+    async def post(self, request, *args, **kwargs):
+        form = self.get_form(request.POST)
+        if await sync_to_async(is_signup_rate_limited)(request): # before the password is hashed
+            messages.error(request, RATE_LIMITED_MESSAGE)
+            return self.render(form)
+        if not await sync_to_async(form.is_valid)(): # the uniqueness checks query the database
+            return self.render(form)
+
+        user = await sync_to_async(form.save)(commit=False) # hashes the password
+        user.is_active = False # Setting it to False; because the phone number hasn't been verified yet
+        if await twilio_verify.atoken_send(user.phone) in (PENDING, COOLDOWN): # on cooldown, the code sent moments ago is still valid
+            if not await sync_to_async(form.save_user)(user):
+                return self.render(form)
+            messages.success(request, 'Your account has been created. Please Enter the code we\'ve sent to your number to ACTIVATE your account. Once activated, you can log into your account.')
+            return HttpResponseRedirect(reverse('user_app:phone_verify', args=[user.uuid_value]))
+        messages.error(request, 'Unfortunately, there has been an error sending a confirmation code to your number. So, your account couldn\'t be created. we\'re extremely sorry. Please try again after some time')
+        return self.render(form)
+
+
+
+class AsyncTwilioTokenSendAgain(AsyncUUIDUserMixin, View):
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return idempotent('token_send_again')(super().as_view(**initkwargs))
+
+    async def get(self, request, uuid_value):
+        user = await self.aget_verifiable_uuid_user()
+        phone_temp = await user.apending_target(PendingVerification.PHONE)
+        if user.is_active and not phone_temp:
+            messages.error(request, PHONE_CHANGE_EXPIRED_MESSAGE)
+            return HttpResponseRedirect(reverse('user_app:phone_change'))
+        phone = phone_temp or user.phone
+        if await sync_to_async(is_rate_limited)('send', request, phone=phone, uuid_value=user.uuid_value):
+            messages.error(request, RATE_LIMITED_MESSAGE)
+        elif (status := await twilio_verify.atoken_send(phone)) == PENDING:
+            messages.success(request, f'We\'ve sent another confirmation code to {phone}. Please enter it')
+        elif status == COOLDOWN:
+            messages.info(request, CODE_ALREADY_SENT_MESSAGE)
+        else:
+            messages.error(request, f'Unfortunately, there has been an error sending a confirmation code to {phone}. Please try again.')
+        return HttpResponseRedirect(reverse('user_app:phone_verify', args=[uuid_value]))
+
+
+
+class AsyncUserPhoneVerify(AsyncUUIDUserMixin, AsyncFormView):
+    template_name = 'user_app/user_phone_verify_form.html'
+    form_class = PhoneVerificationForm
+
+    async def get(self, request, *args, **kwargs):
+        return self.render(self.get_form())
+
+    async def post(self, request, *args, **kwargs):
+        form = self.get_form(request.POST)
+        if not form.is_valid():
+            return self.render(form)
+
+        user = await self.aget_verifiable_uuid_user()
+        await user.apending_target(PendingVerification.PHONE) # from here on, "user.phone_temp" needs no query
+        if user.is_active and not user.phone_temp:
+            # The phone number change has expired (or run out of attempts); the user mustn't be activated again
+            messages.error(request, PHONE_CHANGE_EXPIRED_MESSAGE)
+            return HttpResponseRedirect(reverse('user_app:phone_change'))
+        if await sync_to_async(is_rate_limited)('verify', request, phone=user.phone_temp or user.phone, uuid_value=user.uuid_value):
+            messages.error(request, RATE_LIMITED_MESSAGE)
+            return self.render(form)
+
+        if await twilio_verify.atoken_verify(user.phone_temp or user.phone, form.cleaned_data['code']) != 'approved':
+            if user.phone_temp:
+                await sync_to_async(user.record_pending_verification_attempt)(PendingVerification.PHONE)
+            messages.error(request, 'There has been an error verifying your code. Please try again')
+            return self.render(form)
+
+        if user.phone_temp:
+            try:
+                await sync_to_async(self.promote_temp_phone)(user)
+            except IntegrityError:
+                # Someone else has claimed (and verified) the same number in the meantime
+                messages.error(request, 'A user with this number already exists!')
+                return self.render(form)
+            messages.success(request, 'Your phone number is changed!')
+            return HttpResponseRedirect(reverse('user_app:profile', args=[user.uuid_value]))
+
+        await user.customizedemaildevice_set.acreate(name=user.email)
+        await sync_to_async(user.activate)()
+        messages.success(request, 'Congratulations! Your account is now active. You can log into your account.')
+        return HttpResponseRedirect(reverse('user_app:login'))
+
+    @staticmethod
+    def promote_temp_phone(user):
+        with transaction.atomic():
+            user.promote_temp_phone()
+
+
+
+class AsyncUserPhoneChange(AsyncFormView):
+    template_name = 'user_app/user_phone_change_form.html'
+    form_class = PhoneChangeForm
+    login_required = True
+
+    async def get(self, request, *args, **kwargs):
+        return self.render(self.get_form())
+
+    async def post(self, request, *args, **kwargs):
+        form = self.get_form(request.POST)
+        if not form.is_valid():
+            return self.render(form)
+
+        user = request.user # loaded by "dispatch()"
+        new_phone = form.cleaned_data['new_phone']
+        if user.phone == new_phone:
+            messages.error(request, 'You are already using this number!')
+            return self.render(form)
+        if await customized_user_model.objects.filter(phone=new_phone).aexists():
+            messages.error(request, 'A user with this number already exists!')
+            return self.render(form)
+        if await sync_to_async(is_rate_limited)('send', request, phone=new_phone, uuid_value=user.uuid_value):
+            messages.error(request, RATE_LIMITED_MESSAGE)
+            return self.render(form)
+
+        # Reserve the number before sending, so two accounts can't be verifying the same one
+        try:
+            await sync_to_async(user.set_temp_phone)(new_phone)
+        except IntegrityError:
+            messages.error(request, 'This number is already being verified by another user!')
+            return self.render(form)
+
+        if await twilio_verify.atoken_send(new_phone) in (PENDING, COOLDOWN):
+            messages.success(request, 'We\'ve sent a confirmation code to your new number. Please enter it')
+            return HttpResponseRedirect(reverse('user_app:phone_verify', args=[user.uuid_value]))
+        await sync_to_async(user.clear_pending_verification)(PendingVerification.PHONE)
+        messages.error(request, 'Unfortunately, there has been an error sending a confirmation code to your new number. Please try again.')
+        return self.render(form)
+
+
+
+class AsyncOTPFormView(AsyncFormView):
+    '''
+    Like "LoginView" with one of the OTP forms: on success, the user is logged in again with the verified device.
+    '''
+
+    login_required = True
+    success_message = None
+
+    def get_form(self, data=None):
+        # The OTP forms load the user's devices in "__init__()", so they're built in the sync thread too
+        return self.form_class(request=self.request, data=data)
+
+    async def post(self, request, *args, **kwargs):
+        form = await sync_to_async(self.get_form)(request.POST)
+        if not await sync_to_async(form.is_valid)():
+            return self.render(form)
+
+        await sync_to_async(auth_login)(request, form.get_user())
+        messages.success(request, self.success_message)
+        return HttpResponseRedirect(self.get_success_url())
+
+    def get_success_url(self):
+        redirect_to = self.request.POST.get('next', self.request.GET.get('next', ''))
+        if url_has_allowed_host_and_scheme(redirect_to, allowed_hosts={self.request.get_host()}, require_https=self.request.is_secure()):
+            return redirect_to
+        return resolve_url(reverse_lazy('user_app:profile', args=[self.request.user.uuid_value]))
+
+
+
+class AsyncUserEmailVerify(AsyncOTPFormView):
+    template_name = 'user_app/user_email_verify_form.html'
+    form_class = EmailVerificationForm
+    success_message = 'Your Email has been verified!'
+
+
+
+class AsyncUserEmailChange(AsyncOTPFormView):
+    template_name = 'user_app/user_email_change_form.html'
+    form_class = EmailChangeForm
+    state_test = (lambda state: state['email_verified'], reverse_lazy('user_app:email_verify'))
+    success_message = 'Your Email has been changed!'
+
+
+
+class AsyncUserOTPVerify(AsyncOTPFormView):
+    template_name = 'user_app/user_otp_verify_form.html'
+    form_class = CustomizedOTPTokenForm
+    success_message = 'Email Verification Successful!'
@@ -0,0 +1,57 @@
+'''
+user_app.backends
+'''
+
+import logging
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+
+logger = logging.getLogger(__name__)
+
+
+
+
+class PhoneAuthenticationBackend(ModelBackend):
+    '''
+    Same as Django's "ModelBackend", but it also leaves the outcome of a failed login on the request
+    ("request.user_app_login_failure" is 'inactive' or 'invalid'), so "CustomizededAuthenticationForm"
+    doesn't have to look the user up a second time to tell an inactive account from a wrong password.
+
+    Unknown users still pay for one (dummy) password hash, so they can't be told apart by timing.
+    Every attempt's duration is logged at DEBUG level on the "user_app.backends" logger.
+
+    To use it, set:
+        AUTHENTICATION_BACKENDS = ['user_app.backends.PhoneAuthenticationBackend']
+    '''
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return
+
+        started = time.perf_counter()
+        failure = None
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # Run the default password hasher once to reduce the timing difference between an existing and a nonexistent user (#20760).
+            UserModel().set_password(password)
+            user, failure = None, 'invalid'
+        else:
+            if not self.user_can_authenticate(user):
+                # Like "ModelBackend", the password is hashed anyway; and just like the form always did, inactive accounts are reported as such
+                user.check_password(password)
+                user, failure = None, 'inactive'
+            elif not user.check_password(password):
+                user, failure = None, 'invalid'
+
+        if request is not None and failure:
+            request.user_app_login_failure = failure
+
+        logger.debug('Login attempt %s in %.1f ms', failure or 'succeeded', (time.perf_counter() - started) * 1000)
+        return user
@@ -0,0 +1,6 @@
+'''
+user_app.benchmarks
+
+Load tests for a running server ("locustfile.py"). For in-process benchmarks, see the
+"benchmark_flows" management command.
+'''
@@ -0,0 +1,101 @@
+'''
+user_app.benchmarks.locustfile
+
+A locust (https://locust.io, "pip install locust") load test of the signup, phone verification,
+login, profile, email verification and email change flows, against a running server:
+
+    locust -f user_app/benchmarks/locustfile.py --host http://localhost:8000 --headless -u 50 -r 5 -t 5m --csv results
+
+"--csv" saves the per-request statistics (throughput, p50/p99 latency, ...) as CSV files.
+
+Never point it at a server that sends real SMS or emails. Run the server with:
+
+    USER_APP_SMS_BACKEND = 'user_app.sms_backends.FakeBackend'
+    USER_APP_FAKE_SMS_CODE = '123456'  # the code below
+    USER_APP_PHONE_RATE_LIMITS = {}
+    EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+Email tokens can't be read from outside the server, so the email verification flow only requests
+the token, and the email change flow (which needs a verified email) is left out; "manage.py
+benchmark_flows" measures both end to end. The app
+is expected to be mounted at /user/ (override with the USER_APP_PREFIX environment variable).
+'''
+
+import itertools
+import os
+import random
+import re
+
+from locust import HttpUser, SequentialTaskSet, between, task
+
+
+PREFIX = os.environ.get('USER_APP_PREFIX', '/user/')
+SMS_CODE = os.environ.get('USER_APP_FAKE_SMS_CODE', '123456')
+PASSWORD = 'Bench-Pa55word!'
+
+# Unique, valid (but fictional) phone numbers per locust process
+_numbers = itertools.count(random.randrange(0, 7000000, 100000))
+
+DEVICE_RE = re.compile(r'<option value="([^"]+)"')
+
+
+
+
+class SignupFlow(SequentialTaskSet):
+
+    def on_start(self):
+        n = next(_numbers)
+        self.phone = f'+1650{2000000 + n:07d}'
+        self.email = f'load{n}-{random.getrandbits(32):x}@bench.invalid'
+
+    def post_form(self, path, data, name):
+        # Django's CSRF protection: the token comes from the form page's cookie
+        self.client.get(path, name=f'{name} (form)')
+        data['csrfmiddlewaretoken'] = self.client.cookies.get('csrftoken', '')
+        return self.client.post(path, data, name=name, headers={'Referer': self.client.base_url + path})
+
+    @task
+    def signup(self):
+        response = self.post_form(f'{PREFIX}create/', {
+            'first_name': 'Load', 'last_name': 'Test', 'phone': self.phone, 'email': self.email,
+            'gender': 'None', 'password1': PASSWORD, 'password2': PASSWORD,
+        }, name='signup')
+        # Redirected to the phone verification page, whose url holds the user's uuid
+        self.verify_path = response.url[len(self.client.base_url):] if response.url else None
+
+    @task
+    def phone_verify(self):
+        if self.verify_path and 'phone_verify' in self.verify_path:
+            self.post_form(self.verify_path, {'code': SMS_CODE}, name='phone_verify')
+
+    @task
+    def login(self):
+        response = self.post_form(f'{PREFIX}login/', {'username': self.phone, 'password': PASSWORD}, name='login')
+        self.profile_path = response.url[len(self.client.base_url):] if response.url else None
+
+    @task
+    def profile(self):
+        if self.profile_path and 'profile' in self.profile_path:
+            self.client.get(self.profile_path, name='profile')
+
+    @task
+    def email_verify_send(self):
+        self.send_email_token(f'{PREFIX}email_verify/', {}, name='email_verify (send token)')
+
+    def send_email_token(self, path, data, name):
+        page = self.client.get(path, name=f'{name} (form)')
+        device = DEVICE_RE.search(page.text)
+        if device:
+            data.update({'otp_device': device.group(1), 'otp_challenge': '1', 'csrfmiddlewaretoken': self.client.cookies.get('csrftoken', '')})
+            self.client.post(path, data, name=name, headers={'Referer': self.client.base_url + path})
+
+    @task
+    def done(self):
+        self.client.cookies.clear()
+        self.interrupt(reschedule=False)
+
+
+
+class UserAppUser(HttpUser):
+    tasks = [SignupFlow]
+    wait_time = between(0.5, 2)
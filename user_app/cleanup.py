@@ -0,0 +1,105 @@
+'''
+user_app.cleanup
+
+Removes what the verification flows leave behind; run periodically by the "sweep_stale_data"
+management command (e.g. from cron):
+
+- Abandoned signups: accounts created by "UserCreate" whose phone number was never verified stay
+  inactive (and keep their phone number and email address taken) forever. They're deleted once
+  they're older than USER_APP_UNVERIFIED_ACCOUNT_TTL. An abandoned signup is an inactive account
+  that has never logged in, has no verified email address and has no email OTP device (every
+  account gets one when its phone number is verified, and "import_users" gives every imported
+  account one); so accounts deactivated by an admin, and imported inactive accounts, are kept.
+  Accounts created without a device in some other way (e.g. in the admin, or with "create_user()")
+  that stay inactive and never log in do look abandoned, and are deleted too.
+- Expired email OTP tokens are cleared from "CustomizedEmailDevice".
+- Expired pending phone/email verifications are deleted (out of attempts ones are kept until they
+  expire, so the verification can't be restarted right away).
+
+All of it works in batches of primary keys, each in its own short transaction, so no statement
+locks (or scans) much of a table. Optional settings:
+
+USER_APP_UNVERIFIED_ACCOUNT_TTL: seconds before an abandoned signup is deleted (default 7 days).
+'''
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, models, transaction
+from django.utils import timezone
+
+from .models import user as customized_user_model, CustomizedEmailDevice, PendingVerification
+
+
+# Matches the condition of the user model's "user_app_user_unverified_idx" partial index
+UNVERIFIED_Q = models.Q(is_active=False, last_login__isnull=True)
+
+# Signups that never got past the phone verification; checked per candidate row found with the index
+NEVER_VERIFIED_Q = models.Q(email_verified=False) & ~models.Exists(CustomizedEmailDevice.objects.filter(user=models.OuterRef('pk')))
+
+
+
+
+def stale_accounts(ttl=None, now=None):
+    '''
+    Abandoned signups (see the module docstring) older than "ttl" seconds. Staff accounts are never included.
+    '''
+    if ttl is None:
+        ttl = getattr(settings, 'USER_APP_UNVERIFIED_ACCOUNT_TTL', 7 * 24 * 3600)
+    cutoff = (now or timezone.now()) - timedelta(seconds=ttl)
+    return customized_user_model.objects.filter(UNVERIFIED_Q, NEVER_VERIFIED_Q, date_joined__lt=cutoff, is_staff=False, is_superuser=False)
+
+
+def expired_tokens(now=None):
+    return CustomizedEmailDevice.objects.filter(token__isnull=False, valid_until__lt=now or timezone.now())
+
+
+def delete_stale_accounts(batch_size, ttl=None, now=None, progress=None):
+    '''
+    Deletes the "stale_accounts()" (and the rows cascading from them), oldest first; returns how many accounts were deleted.
+    "progress", if given, is called with the running total after every batch.
+    '''
+    stale = stale_accounts(ttl, now)
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            # Rows locked by a request (e.g. one activating the account right now) are left for the next run
+            oldest = stale.order_by('date_joined')
+            if connections[oldest.db].features.has_select_for_update_skip_locked:
+                oldest = oldest.select_for_update(skip_locked=True)
+            pks = list(oldest.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            # Filtered again, so an account activated since the SELECT above isn't deleted
+            _, per_model = stale.filter(pk__in=pks).delete()
+            deleted += per_model.get(customized_user_model._meta.label, 0)
+        if progress:
+            progress(deleted)
+
+
+def clear_expired_tokens(batch_size, now=None, progress=None):
+    '''
+    Clears expired tokens, walking the devices in primary key order; returns how many were cleared.
+    '''
+    expired = expired_tokens(now)
+    cleared = last_pk = 0
+    while True:
+        pks = list(expired.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return cleared
+        last_pk = pks[-1]
+        cleared += expired.filter(pk__in=pks).update(token=None)
+        if progress:
+            progress(cleared)
+
+
+def delete_inactive_pending_verifications(batch_size, progress=None):
+    deleted = 0
+    while True:
+        # Deleting by primary key keeps every DELETE (and its locks) small
+        pks = list(PendingVerification.objects.expired().values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += PendingVerification.objects.filter(pk__in=pks).delete()[0]
+        if progress:
+            progress(deleted)
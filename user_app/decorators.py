@@ -2,10 +2,51 @@
 user_app.decorators 
 '''
 
-from django.contrib.auth.decorators import user_passes_test
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
 from django.urls import reverse_lazy
 
+from django_otp.conf import settings as otp_settings
+
+from .verification_state import get_state
+
+
+
+
+def state_passes_test(test_func, login_url=None, redirect_field_name='next'):
+    '''
+    Like "django.contrib.auth.decorators.user_passes_test()", but "test_func" gets the session's
+    verification-state snapshot (see "user_app.verification_state") instead of the user; so the check
+    itself needs no database query. Anonymous (and inactive) users always fail the test.
+    '''
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapper_view(request, *args, **kwargs):
+            state = get_state(request)
+            if state is not None and test_func(state):
+                return view_func(request, *args, **kwargs)
+            return redirect_to_login(request.get_full_path(), login_url or settings.LOGIN_URL, redirect_field_name)
+
+        return _wrapper_view
+
+    return decorator
+
+
+def otp_required(view=None, redirect_field_name='next', login_url=None):
+    '''
+    A drop-in for "django_otp.decorators.otp_required(if_configured=False)", decided by the session snapshot
+    (the device id django_otp stores in the session when a token is verified) instead of loading the device.
+    '''
+    if login_url is None:
+        login_url = otp_settings.OTP_LOGIN_URL
+
+    decorator = state_passes_test(lambda state: bool(state['otp_device_id']), login_url=login_url, redirect_field_name=redirect_field_name)
+    return decorator if (view is None) else decorator(view)
+
 
 
 
-Email_Verification_Required = user_passes_test(lambda u: u.email_verified, login_url=reverse_lazy('user_app:email_verify'))
\ No newline at end of file
+Email_Verification_Required = state_passes_test(lambda state: state['email_verified'], login_url=reverse_lazy('user_app:email_verify'))
@@ -0,0 +1,162 @@
+'''
+user_app.deletion
+
+Queued account deletion. When "settings.USER_APP_ACCOUNT_DELETION_QUEUE" is True, "UserDelete" only
+deactivates the account and queues an "AccountDeletion"; the "process_account_deletions" management
+command then removes the account's related rows in bounded batches, and finally the user row
+itself. That way, no request (and no single transaction) has to delete a big account's rows all at once.
+
+Optional settings:
+
+USER_APP_ACCOUNT_DELETION_BATCH_SIZE: rows deleted per statement and transaction (default 1000).
+USER_APP_ACCOUNT_DELETION_CLAIM_TIMEOUT: seconds after which a deletion still in progress is considered
+    abandoned (e.g. its worker was killed) and claimed again (default 1 hour). Purging is idempotent, so
+    a deletion claimed again just picks up the rows that are left.
+'''
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, models, transaction
+from django.db.models.deletion import Collector
+from django.utils import timezone
+
+from . import profile_cache, verification_state
+from .models import user as customized_user_model, AccountDeletion
+
+
+logger = logging.getLogger(__name__)
+
+
+
+
+def enqueue(user):
+    '''
+    Deactivates "user" right away and queues the removal of the account.
+    '''
+    with transaction.atomic():
+        customized_user_model.objects.filter(pk=user.pk).update(is_active=False)
+        user.is_active = False
+        profile_cache.invalidate_on_commit(user.uuid_value)
+        verification_state.bump_version_on_commit(user.pk)
+        return AccountDeletion.objects.create(user_id=user.pk, user_uuid=user.uuid_value)
+
+
+def _pending(user):
+    # Queued, in progress, or failed (and waiting to be retried); once done, the user row is gone too
+    return AccountDeletion.objects.filter(user_id=user.pk).exclude(status=AccountDeletion.DONE)
+
+
+def is_pending(user):
+    '''
+    Whether the removal of "user"'s account has been requested (and isn't done yet). Such a user mustn't be
+    verified (and so activated) again in the meantime.
+    '''
+    return _pending(user).exists()
+
+
+async def ais_pending(user):
+    return await _pending(user).aexists()
+
+
+def _delete_in_batches(queryset, batch_size):
+    '''
+    Deletes "queryset" a batch of primary keys at a time, each batch in its own (short) transaction.
+    Models without further cascades or delete signals are deleted with "_raw_delete()", a single DELETE
+    statement per batch; the others go through the collector, so their cascades and signals still run.
+    '''
+    deleted = 0
+    fast = Collector(using=queryset.db).can_fast_delete(queryset)
+    while True:
+        with transaction.atomic(using=queryset.db):
+            pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            batch = queryset.model._base_manager.using(queryset.db).filter(pk__in=pks)
+            deleted += batch._raw_delete(batch.db) if fast else batch.delete()[0]
+
+
+def _related_querysets(user_id):
+    '''
+    Everything that would be cascade-deleted (or unlinked, for many-to-many relations) together with the user.
+    '''
+    opts = customized_user_model._meta
+    for field in opts.many_to_many:
+        through = field.remote_field.through
+        yield through._base_manager.filter(**{field.m2m_field_name(): user_id})
+    for relation in opts.related_objects:
+        if relation.many_to_many:
+            through = relation.through
+            yield through._base_manager.filter(**{relation.field.m2m_reverse_field_name(): user_id})
+        elif relation.on_delete is models.CASCADE:
+            yield relation.related_model._base_manager.filter(**{relation.field.name: user_id})
+
+
+def purge(deletion, batch_size=None):
+    '''
+    Removes the account of one (claimed) "AccountDeletion".
+    '''
+    batch_size = batch_size or getattr(settings, 'USER_APP_ACCOUNT_DELETION_BATCH_SIZE', 1000)
+    deleted = deletion.deleted_rows # rows deleted by an earlier, abandoned attempt
+    for queryset in _related_querysets(deletion.user_id):
+        deleted += _delete_in_batches(queryset, batch_size)
+        AccountDeletion.objects.filter(pk=deletion.pk).update(deleted_rows=deleted)
+
+    # By now only the user row (and any SET_NULL/PROTECT relations) is left. It goes through the collector:
+    # the user model has delete signal receivers (see "user_app.signals")
+    count, _ = customized_user_model._base_manager.filter(pk=deletion.user_id).delete()
+    return deleted + count
+
+
+def claim_next(now=None):
+    '''
+    Marks the oldest queued (or abandoned, see USER_APP_ACCOUNT_DELETION_CLAIM_TIMEOUT) deletion as in progress and
+    returns it (None if the queue is empty). Safe with several workers: rows are claimed with "SELECT ... FOR UPDATE
+    SKIP LOCKED" where supported.
+    '''
+    now = now or timezone.now()
+    timeout = getattr(settings, 'USER_APP_ACCOUNT_DELETION_CLAIM_TIMEOUT', 3600)
+    with transaction.atomic():
+        claimable = (
+            AccountDeletion.objects
+            .filter(
+                models.Q(status=AccountDeletion.QUEUED)
+                | models.Q(status=AccountDeletion.IN_PROGRESS, started_at__lt=now - timedelta(seconds=timeout))
+            )
+            .order_by('requested_at')
+        )
+        if connections[claimable.db].features.has_select_for_update_skip_locked:
+            claimable = claimable.select_for_update(skip_locked=True)
+        deletion = claimable.first()
+        if deletion is not None:
+            if deletion.status == AccountDeletion.IN_PROGRESS:
+                logger.warning('Deleting account %s was abandoned; claiming it again', deletion.user_uuid)
+            deletion.status = AccountDeletion.IN_PROGRESS
+            deletion.started_at = now
+            deletion.save(update_fields=['status', 'started_at'])
+    return deletion
+
+
+def process_next(batch_size=None):
+    '''
+    Claims and processes one queued deletion; returns it (None if the queue is empty).
+    '''
+    deletion = claim_next()
+    if deletion is None:
+        return None
+
+    try:
+        deletion.deleted_rows = purge(deletion, batch_size)
+        deletion.status = AccountDeletion.DONE
+        update_fields = ['status', 'deleted_rows', 'last_error', 'finished_at']
+    except Exception as e:
+        logger.exception('Deleting account %s failed', deletion.user_uuid)
+        deletion.status = AccountDeletion.FAILED
+        deletion.last_error = str(e)
+        # "purge()" saved its progress as it went; the in-memory count is stale
+        deletion.refresh_from_db(fields=['deleted_rows'])
+        update_fields = ['status', 'last_error', 'finished_at']
+    deletion.finished_at = timezone.now()
+    deletion.save(update_fields=update_fields)
+    return deletion
@@ -2,7 +2,10 @@
 user_app.forms
 '''
 
-from django.db import transaction
+import uuid
+
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, Q
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth import authenticate
 from django.contrib.auth.forms import UserCreationForm
@@ -13,22 +16,62 @@ from django.core.exceptions import ValidationError
 
 from django_otp.forms import OTPTokenForm
 
-from phonenumber_field.formfields import PhoneNumberField
-
-from .models import user as customized_user_model
+from .models import user as customized_user_model, CustomizedEmailDevice, PendingVerification
+from .phones import PhoneNumberFormField
 
 
 
 
 class CustomizedUserCreationForm(UserCreationForm):
     '''
-    A Custom User-Creation-form is needed since we're using a customized user model
+    A Custom User-Creation-form is needed since we're using a customized user model.
+    Every rendered form carries a fresh idempotency key, so a double-submitted signup is only processed once (see "user_app.idempotency").
+    The unique fields (phone, email) are checked with a single query, instead of one per field.
     '''
+
+    idempotency_key = forms.CharField(widget=forms.HiddenInput, required=False, initial=lambda: uuid.uuid4().hex)
     
     class Meta:
         model = customized_user_model
         fields = ('first_name', 'last_name', 'phone', 'email', 'gender')
 
+    def validate_unique(self):
+        # Same checks and error messages as "Model.validate_unique()", for the fields on the form
+        exclude = self._get_validation_exclusions()
+        values = {}
+        for field in self.instance._meta.fields:
+            value = getattr(self.instance, field.attname)
+            if field.unique and not field.primary_key and field.name not in exclude and value is not None:
+                values[field.name] = field.get_prep_value(value)
+        if not values:
+            return
+
+        rows = customized_user_model.objects.filter(Q(_connector=Q.OR, **values))
+        if self.instance.pk is not None:
+            rows = rows.exclude(pk=self.instance.pk)
+        taken = set()
+        for row in rows.values(*values):
+            taken.update(name for name, value in values.items() if self.instance._meta.get_field(name).get_prep_value(row[name]) == value)
+        if taken:
+            self._update_errors(ValidationError({
+                name: self.instance.unique_error_message(customized_user_model, [name]) for name in values if name in taken
+            }))
+
+    def save_user(self, user):
+        '''
+        INSERTs "user" (this form's instance); returns False, with the errors added to the form, if someone else has
+        taken its phone or email since the form was validated.
+        '''
+        try:
+            with transaction.atomic():
+                user.save()
+        except IntegrityError:
+            self.validate_unique()
+            if not self.errors:
+                raise
+            return False
+        return True
+
 
 
 class CustomizededAuthenticationForm(AuthenticationForm):
@@ -53,18 +96,18 @@ class CustomizededAuthenticationForm(AuthenticationForm):
             self.user_cache = authenticate(self.request, username=username, password=password)
 
             if self.user_cache is None:
-                try:
-                    unauthenticated_user = customized_user_model.objects.get(phone=username) 
-                    # because "authenticate()" method returns None if the user is inactive or not authenticated.                   
-                except:
-                    unauthenticated_user = None
-                finally:
-                    if unauthenticated_user and not unauthenticated_user.is_active:
-                        # Instead of calling the "confirm_login_allowed(unauthenticated_user)"; I'm 
-                        # directly raising a ValidationError. You can call the method if it's needed for your project.
-                        raise ValidationError(self.error_messages['inactive'], code='inactive',)
-                    else:
-                        raise self.get_invalid_login_error()
+                # "PhoneAuthenticationBackend" tells us why the login failed; other backends don't, so we have to look the user up ourselves
+                failure = getattr(self.request, 'user_app_login_failure', None)
+                if failure is None:
+                    failure = 'inactive' if customized_user_model.objects.filter(phone=username, is_active=False).exists() else 'invalid'
+                    # because "authenticate()" method returns None if the user is inactive or not authenticated.
+
+                if failure == 'inactive':
+                    # Instead of calling the "confirm_login_allowed(unauthenticated_user)"; I'm 
+                    # directly raising a ValidationError. You can call the method if it's needed for your project.
+                    raise ValidationError(self.error_messages['inactive'], code='inactive',)
+                else:
+                    raise self.get_invalid_login_error()
                         
         return self.cleaned_data
 
@@ -102,23 +145,50 @@ class CustomizedOTPTokenForm(OTPTokenForm):
     }
 
     def __init__(self, request=None, *args, **kwargs):
-        super().__init__(request.user, *args, **kwargs)
+        super().__init__(request.user, *args, **kwargs) # this also sets the "otp_device" choices
 
         self.user = request.user
-        self.fields['otp_device'].choices = self.device_choices(request.user)
 
+    def _update_form(self, user):
+        # The device choices were loaded in __init__(); no need to query them again
+        self.fields['otp_device'].widget.choices = self.fields['otp_device'].choices
 
 
-class EmailVerificationForm(CustomizedOTPTokenForm):
-    
+
+class EmailDeviceFormMixin:
+    '''
+    For the forms that only work with the user's "CustomizedEmailDevice"s: the choices are loaded with a
+    single narrow query, and the chosen device is loaded (already restricted to the user) with another one.
+    '''
+
     @staticmethod
     def device_choices(user):
         # We want to specify the email devices only.
-        return list((d.persistent_id, d.name) for d in user.customizedemaildevice_set.all())
+        label = CustomizedEmailDevice.model_label()
+        return [(f'{label}/{pk}', name) for pk, name in user.customizedemaildevice_set.values_list('pk', 'name')]
+
+    def device_queryset(self, user):
+        return user.customizedemaildevice_set.select_for_update()
 
+    def _chosen_device(self, user):
+        label, _, pk = (self.cleaned_data.get('otp_device') or '').rpartition('/')
+        if label != CustomizedEmailDevice.model_label() or not pk.isdigit():
+            return None
 
+        # Filtering by the user makes sure nobody can use some other user's device
+        device = self.device_queryset(user).filter(pk=pk).first()
+        if device is not None:
+            device.user = user # saves loading the user again in "generate_challenge()"/"verify_token()"
+        return device
 
-class EmailChangeForm(CustomizedOTPTokenForm):
+
+
+class EmailVerificationForm(EmailDeviceFormMixin, CustomizedOTPTokenForm):
+    pass
+
+
+
+class EmailChangeForm(EmailDeviceFormMixin, CustomizedOTPTokenForm):
     """
     This form is built on top of the "django_otp.forms.OTPTokenForm" and modified to 
     serve the purpose of changing a "user.email" field upon a successful token-verification.
@@ -126,40 +196,70 @@ class EmailChangeForm(CustomizedOTPTokenForm):
     How it works: 
     First of, when called with 'Send OTP (Get Challenge)', the "CustomizedEmailDevice.email" field 
     is filled with "form.cleaned_data['new_email']", and thus an OTP Token is delivered to 
-    this email address. If the token-delivery is successful, the email address where the token 
-    has been sent is saved to "user.email_temp" field (in DATABASE level). After that, when 
-    a user submits a token; "clean_otp()" first checks if the current 
-    "form.cleaned_data['new_email']" and "user.temp_email" match; if matched, then 
-    the token is given to the "verify_token()" method for further processing; if they don't, then 
-    "user.email_temp" is assigned the new value of the "form.cleaned_data['new_email']" and 
-    "_handle_challenge()" is called to start the process again. Once the "verify_token()" method 
-    successfully verifies a token, "user.email" is set to the value of "user.temp_email", 
-    "user.temp_email" is set to None and the "user" object is saved in the database. "EmailDevice.name" 
-    is also changed to the "user.email" and saved.
+    this email address. Before the token is sent, the new email address is reserved as the user's 
+    pending email ("PendingVerification", readable as "user.email_temp"); if the delivery fails, the 
+    reservation is dropped again. After that, when a user submits a token; "clean_otp()" first checks 
+    if the current "form.cleaned_data['new_email']" and "user.email_temp" match; if matched, then 
+    the token is given to the "verify_token()" method for further processing (failed attempts are 
+    counted on the pending verification); if they don't, then "_handle_challenge()" is called to start 
+    the process again with the new address. Once the "verify_token()" method successfully verifies a 
+    token, "user.email" is set to the pending email address and the pending verification is deleted. 
+    "EmailDevice.name" is also changed to the "user.email" and saved. If another account has taken the 
+    address in the meantime, the pending verification is dropped and the form is invalid. Once the pending verification 
+    is out of attempts, neither tokens nor new challenges are accepted until it expires.
     """
 
     new_email = forms.EmailField()
 
+    otp_error_messages = {
+        **CustomizedOTPTokenForm.otp_error_messages,
+        'verification_exhausted': _('Too many invalid tokens. Please wait a few minutes before requesting a new one.'),
+        'email_taken': _('This email address has been taken by another account in the meantime. Please choose another one.'),
+    }
+
+    def device_queryset(self, user):
+        # Whether "new_email" is taken already (and whether the pending verification is out of attempts) is
+        # checked in the same query that loads the device
+        queryset = super().device_queryset(user).annotate(
+            verification_exhausted=Exists(PendingVerification.objects.exhausted().filter(user=user, kind=PendingVerification.EMAIL)),
+        )
+        if 'new_email' in self.cleaned_data:
+            queryset = queryset.annotate(new_email_taken=Exists(customized_user_model.objects.filter(email=self.cleaned_data['new_email'])))
+        return queryset
+
     @staticmethod
-    def device_choices(user):
-        # We want to specify the email devices only.
-        return list((d.persistent_id, d.name) for d in user.customizedemaildevice_set.all())
+    def _verification_exhausted(user, device):
+        exhausted = getattr(device, 'verification_exhausted', None)
+        if exhausted is None:
+            exhausted = user.pending_verification_exhausted(PendingVerification.EMAIL)
+        return exhausted
 
     def _handle_challenge(self, device):
-        if customized_user_model.objects.filter(email = self.cleaned_data['new_email']).exists():
+        if device is None:
+            # Checked before anything is reserved
+            raise forms.ValidationError(self.otp_error_messages['not_interactive'], code='not_interactive')
+        new_email_taken = getattr(device, 'new_email_taken', None)
+        if new_email_taken is None:
+            new_email_taken = customized_user_model.objects.filter(email = self.cleaned_data['new_email']).exists()
+        if new_email_taken:
             raise forms.ValidationError(
                 self.otp_error_messages['challenge_exception'].format("This email address already exists to an account"), code='challenge_exception'
             )
+        try:
+            # Reserve the address before sending, so two accounts can't be verifying the same one
+            self.user.set_temp_email(self.cleaned_data['new_email'])
+        except IntegrityError:
+            raise forms.ValidationError(
+                self.otp_error_messages['challenge_exception'].format("This email address is already being verified by another account"), code='challenge_exception'
+            )
         try:
             device.email = self.cleaned_data['new_email'] # The value of device.email is used to deliver the token
-            challenge = device.generate_challenge() if (device is not None) else None
+            challenge = device.generate_challenge()
             if challenge:
-                # if the token is successfully delivered to the new email address, then save it to user.email_temp field
-                self.user.email_temp = device.email
                 device.email = None
-                device.save()
-                self.user.save()
+                device.save(update_fields=['email'])
         except Exception as e:
+            self.user.clear_pending_verification(PendingVerification.EMAIL)
             raise forms.ValidationError(
                 self.otp_error_messages['challenge_exception'].format(e), code='challenge_exception'
             )
@@ -193,11 +293,18 @@ class EmailChangeForm(CustomizedOTPTokenForm):
                 user.otp_device = None
 
                 try:
+                    if self._verification_exhausted(user, device):
+                        # Neither a token nor a new challenge is accepted until the exhausted verification expires
+                        raise forms.ValidationError(self.otp_error_messages['verification_exhausted'], code='verification_exhausted')
                     if self.cleaned_data.get('otp_challenge'):
                         self._handle_challenge(device)
                     elif token:                       
                         if self.cleaned_data['new_email'] == user.email_temp: # check if the email address given previously (when clicking 'send token') and the current one (when clicking 'verify') match
-                            user.otp_device = self._verify_token(user, token, device)
+                            try:
+                                user.otp_device = self._verify_token(user, token, device)
+                            except forms.ValidationError:
+                                user.record_pending_verification_attempt(PendingVerification.EMAIL)
+                                raise
                         else:
                             # if they don't match, start the process again with the newly given email address
                             self._handle_challenge(device)
@@ -209,11 +316,16 @@ class EmailChangeForm(CustomizedOTPTokenForm):
                     if user.otp_device:
                         # OTP verification is successful
                         # Some cleaning up at the end; and most importantly, the assignment of the newly verified email address to "user.email"
-                        user.email = user.email_temp
-                        user.email_temp = None
-                        user.save()
+                        try:
+                            user.promote_temp_email()
+                        except IntegrityError:
+                            # Taken since the token was sent (a signup doesn't check pending verifications); the unique
+                            # constraint on "email" is the final guard, like "promote_temp_phone()" in "UserPhoneVerify"
+                            user.otp_device = None
+                            user.clear_pending_verification(PendingVerification.EMAIL)
+                            raise forms.ValidationError(self.otp_error_messages['email_taken'], code='email_taken')
                         device.name = user.email
-                        device.save()
+                        device.save(update_fields=['name'])
                         
 
                     
@@ -232,7 +344,7 @@ class PhoneVerificationForm(forms.Form):
 
 
 class PhoneChangeForm(forms.Form):
-    new_phone = PhoneNumberField(required=True, help_text= _('Please provide a valid phone number in international format.'))
+    new_phone = PhoneNumberFormField(required=True, help_text= _('Please provide a valid phone number in international format.'))
 
 
    
\ No newline at end of file
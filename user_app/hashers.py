@@ -0,0 +1,76 @@
+'''
+user_app.hashers
+
+Password hashers whose cost parameters can be tuned per deployment, without subclassing anything
+in the project. Put the ones you want in PASSWORD_HASHERS (the first one is used for new hashes):
+
+    PASSWORD_HASHERS = [
+        'user_app.hashers.TunedArgon2PasswordHasher',  # requires "pip install argon2-cffi"
+        'user_app.hashers.TunedScryptPasswordHasher',
+        'user_app.hashers.TunedPBKDF2PasswordHasher',
+    ]
+    USER_APP_PASSWORD_HASHER_PARAMS = {
+        'argon2': {'time_cost': 2, 'memory_cost': 65536, 'parallelism': 2},
+        'scrypt': {'work_factor': 2**14, 'block_size': 8, 'parallelism': 1},
+        'pbkdf2_sha256': {'iterations': 600000},
+    }
+
+Missing parameters fall back to Django's defaults. The hashers keep Django's algorithm names, so
+existing hashes remain valid; and since "must_update()" compares a stored hash's parameters with
+the configured ones, a user's password is transparently re-hashed with the new parameters on their
+next successful login (or any other "check_password()"). Use the "benchmark_password_hashers"
+management command to see what a set of parameters costs.
+'''
+
+from django.conf import settings
+from django.contrib.auth.hashers import Argon2PasswordHasher, PBKDF2PasswordHasher, ScryptPasswordHasher
+
+
+
+
+def _param(algorithm, name, default):
+    return getattr(settings, 'USER_APP_PASSWORD_HASHER_PARAMS', {}).get(algorithm, {}).get(name, default)
+
+
+
+class TunedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+
+    @property
+    def iterations(self):
+        return _param(self.algorithm, 'iterations', PBKDF2PasswordHasher.iterations)
+
+
+
+class TunedArgon2PasswordHasher(Argon2PasswordHasher):
+
+    @property
+    def time_cost(self):
+        return _param(self.algorithm, 'time_cost', Argon2PasswordHasher.time_cost)
+
+    @property
+    def memory_cost(self):
+        return _param(self.algorithm, 'memory_cost', Argon2PasswordHasher.memory_cost)
+
+    @property
+    def parallelism(self):
+        return _param(self.algorithm, 'parallelism', Argon2PasswordHasher.parallelism)
+
+
+
+class TunedScryptPasswordHasher(ScryptPasswordHasher):
+
+    @property
+    def work_factor(self):
+        return _param(self.algorithm, 'work_factor', ScryptPasswordHasher.work_factor)
+
+    @property
+    def block_size(self):
+        return _param(self.algorithm, 'block_size', ScryptPasswordHasher.block_size)
+
+    @property
+    def parallelism(self):
+        return _param(self.algorithm, 'parallelism', ScryptPasswordHasher.parallelism)
+
+    @property
+    def maxmem(self):
+        return _param(self.algorithm, 'maxmem', ScryptPasswordHasher.maxmem)
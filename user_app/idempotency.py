@@ -0,0 +1,135 @@
+'''
+user_app.idempotency
+
+Retried or double-submitted requests (the same "Idempotency-Key" header, or "idempotency_key" form
+field) are answered from the first request's outcome instead of being processed again: no second
+form validation, password hash, INSERT or SMS. While the first request is still running, a retry
+waits for its outcome. Only redirects (the successful outcomes of the views using it) are stored;
+a retry whose first request ended without one (e.g. with an invalid form) stops waiting and is
+processed itself.
+
+The signup form carries a fresh key in a hidden field, so double clicks are covered without any
+client changes. Optional settings:
+
+USER_APP_IDEMPOTENCY_CACHE: an alias from settings.CACHES (default 'default').
+USER_APP_IDEMPOTENCY_TTL: seconds an outcome is kept (default 300).
+'''
+
+import asyncio
+import hashlib
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseRedirect
+
+
+KEY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+KEY_FIELD = 'idempotency_key'
+
+LOCK_TIMEOUT = 30 # seconds; longer than any request should take
+WAIT_TIMEOUT = 10
+WAIT_INTERVAL = 0.1
+
+
+
+
+def _cache():
+    return caches[getattr(settings, 'USER_APP_IDEMPOTENCY_CACHE', 'default')]
+
+
+def _keys(request, action):
+    key = request.META.get(KEY_HEADER) or (request.POST.get(KEY_FIELD) if request.method == 'POST' else None)
+    if not key:
+        return None, None
+    digest = hashlib.sha256(f'{request.path}:{key}'.encode()).hexdigest()
+    return f'user_app:idem:{action}:{digest}', f'user_app:idem:{action}:{digest}:lock'
+
+
+def _outcome(response):
+    if response.status_code in (301, 302, 303, 307, 308):
+        return {'status': response.status_code, 'location': response['Location']}
+    return None
+
+
+def _replay(outcome):
+    if outcome is None:
+        # The first request is still running (or died); the client should retry later
+        return HttpResponse('A request with this idempotency key is already being processed.', status=409)
+    response = HttpResponseRedirect(outcome['location'])
+    response.status_code = outcome['status']
+    return response
+
+
+
+def idempotent(action):
+    '''
+    Makes a view idempotent for requests carrying an idempotency key; see the module docstring.
+    Works on sync and async views ("action" namespaces the stored outcomes).
+    '''
+
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def _async_wrapper_view(request, *args, **kwargs):
+                result_key, lock_key = _keys(request, action)
+                if result_key is None:
+                    return await view_func(request, *args, **kwargs)
+
+                cache = _cache()
+                deadline = time.monotonic() + WAIT_TIMEOUT
+                while not await cache.aadd(lock_key, True, LOCK_TIMEOUT): # see "_wrapper_view()"
+                    if (outcome := await cache.aget(result_key)) is not None:
+                        return _replay(outcome)
+                    if time.monotonic() >= deadline:
+                        return _replay(None)
+                    await asyncio.sleep(WAIT_INTERVAL)
+                if (outcome := await cache.aget(result_key)) is not None:
+                    await cache.adelete(lock_key)
+                    return _replay(outcome)
+
+                try:
+                    response = await view_func(request, *args, **kwargs)
+                    if (outcome := _outcome(response)) is not None:
+                        await cache.aset(result_key, outcome, getattr(settings, 'USER_APP_IDEMPOTENCY_TTL', 300))
+                finally:
+                    await cache.adelete(lock_key)
+                return response
+
+            return markcoroutinefunction(_async_wrapper_view)
+
+        @wraps(view_func)
+        def _wrapper_view(request, *args, **kwargs):
+            result_key, lock_key = _keys(request, action)
+            if result_key is None:
+                return view_func(request, *args, **kwargs)
+
+            cache = _cache()
+            deadline = time.monotonic() + WAIT_TIMEOUT
+            while not cache.add(lock_key, True, LOCK_TIMEOUT):
+                # Another request with this key is running: wait for its outcome. If it releases the lock
+                # without storing one, this request takes the lock over and runs the view itself
+                if (outcome := cache.get(result_key)) is not None:
+                    return _replay(outcome)
+                if time.monotonic() >= deadline:
+                    return _replay(None)
+                time.sleep(WAIT_INTERVAL)
+            # Looked up with the lock held: the request holding it before may have stored an outcome
+            if (outcome := cache.get(result_key)) is not None:
+                cache.delete(lock_key)
+                return _replay(outcome)
+
+            try:
+                response = view_func(request, *args, **kwargs)
+                if (outcome := _outcome(response)) is not None:
+                    cache.set(result_key, outcome, getattr(settings, 'USER_APP_IDEMPOTENCY_TTL', 300))
+            finally:
+                cache.delete(lock_key)
+            return response
+
+        return _wrapper_view
+
+    return decorator
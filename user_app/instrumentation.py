@@ -0,0 +1,241 @@
+'''
+user_app.instrumentation
+
+Where does a request's time go? "InstrumentationMiddleware" times every (sampled) request, counts
+its database queries, and adds up the time spent in the app's slow calls, each wrapped in a
+"timed()" block: SMS provider calls ('sms', see "user_app.twilio_verify"), OTP emails ('email',
+see "CustomizedEmailDevice.generate_challenge") and password hashing ('password_hash', see the
+user model's "check_password()"/"set_password()").
+
+Each sampled request is logged on the "user_app.instrumentation" logger (INFO), with the numbers
+also attached to the log record as "record.user_app_metrics" for structured (e.g. JSON) formatters,
+and added to per-view metrics that "render_metrics()"/"metrics_view" return in the Prometheus text
+format. The metrics are per process; with several workers, scrape (or aggregate) each of them.
+
+    MIDDLEWARE = [..., 'user_app.instrumentation.InstrumentationMiddleware']
+    USER_APP_INSTRUMENTATION_SAMPLE_RATE = 0.1  # share of requests measured (default 0: nothing is)
+
+The middleware works under WSGI and ASGI; under ASGI, database queries aren't counted (only timed).
+Unsampled requests, and code running outside a request (management commands, workers), only pay
+for one context variable lookup per "timed()" block.
+'''
+
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import HttpResponse
+
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = ContextVar('user_app_instrumentation', default=None)
+
+
+
+
+class _Metrics:
+    '''
+    Per-view aggregates of the sampled requests, kept in memory.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = defaultdict(int)             # (view, status) -> count
+        self.duration = {}                            # view -> [bucket counts..., sum, count]
+        self.queries = defaultdict(int)               # view -> total queries
+        self.calls = defaultdict(lambda: [0, 0.0])    # (view, hook) -> [calls, seconds]
+
+    def observe(self, view, status, record):
+        with self.lock:
+            self.requests[(view, status)] += 1
+            duration = self.duration.setdefault(view, [0] * len(DURATION_BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if record['duration'] <= bound:
+                    duration[i] += 1
+            duration[-2] += record['duration']
+            duration[-1] += 1
+            if record['queries'] is not None:
+                self.queries[view] += record['queries']
+            for hook, (calls, seconds) in record['calls'].items():
+                totals = self.calls[(view, hook)]
+                totals[0] += calls
+                totals[1] += seconds
+
+    def render(self):
+        with self.lock:
+            lines = [
+                '# HELP user_app_requests_total Sampled requests.',
+                '# TYPE user_app_requests_total counter',
+            ]
+            lines += [f'user_app_requests_total{{view="{view}",status="{status}"}} {count}' for (view, status), count in self.requests.items()]
+
+            lines += [
+                '# HELP user_app_request_duration_seconds Duration of sampled requests.',
+                '# TYPE user_app_request_duration_seconds histogram',
+            ]
+            for view, duration in self.duration.items():
+                lines += [f'user_app_request_duration_seconds_bucket{{view="{view}",le="{bound}"}} {duration[i]}' for i, bound in enumerate(DURATION_BUCKETS)]
+                lines += [
+                    f'user_app_request_duration_seconds_bucket{{view="{view}",le="+Inf"}} {duration[-1]}',
+                    f'user_app_request_duration_seconds_sum{{view="{view}"}} {duration[-2]:.6f}',
+                    f'user_app_request_duration_seconds_count{{view="{view}"}} {duration[-1]}',
+                ]
+
+            lines += [
+                '# HELP user_app_request_queries_total Database queries of sampled requests.',
+                '# TYPE user_app_request_queries_total counter',
+            ]
+            lines += [f'user_app_request_queries_total{{view="{view}"}} {count}' for view, count in self.queries.items()]
+
+            lines += [
+                '# HELP user_app_calls_total Timed calls (sms, email, password_hash, db) of sampled requests.',
+                '# TYPE user_app_calls_total counter',
+            ]
+            lines += [f'user_app_calls_total{{view="{view}",call="{hook}"}} {calls}' for (view, hook), (calls, _) in self.calls.items()]
+            lines += [
+                '# HELP user_app_call_seconds_total Time spent in timed calls of sampled requests.',
+                '# TYPE user_app_call_seconds_total counter',
+            ]
+            lines += [f'user_app_call_seconds_total{{view="{view}",call="{hook}"}} {seconds:.6f}' for (view, hook), (_, seconds) in self.calls.items()]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = _Metrics()
+
+
+
+def _new_record():
+    return {'duration': 0.0, 'queries': 0, 'calls': defaultdict(lambda: [0, 0.0]), 'active': set()}
+
+
+def _add_call(record, name, seconds):
+    totals = record['calls'][name]
+    totals[0] += 1
+    totals[1] += seconds
+
+
+@contextmanager
+def timed(name):
+    '''
+    Adds the time spent in the block to the current (sampled) request's "name" call; a no-op otherwise.
+    '''
+    record = _current.get()
+    if record is None or name in record['active']: # nested blocks (e.g. a password rehash inside a check) count once
+        yield
+        return
+    record['active'].add(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record['active'].discard(name)
+        _add_call(record, name, time.perf_counter() - started)
+
+
+
+class InstrumentationMiddleware:
+    '''
+    Measures a share ("USER_APP_INSTRUMENTATION_SAMPLE_RATE") of the requests; see the module docstring.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def sampled():
+        sample_rate = getattr(settings, 'USER_APP_INSTRUMENTATION_SAMPLE_RATE', 0)
+        return sample_rate and random.random() < sample_rate
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.sampled():
+            return self.get_response(request)
+
+        record = _new_record()
+        token = _current.set(record)
+        started = time.perf_counter()
+        try:
+            with connections[DEFAULT_DB_ALIAS].execute_wrapper(self.count_query):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        record['duration'] = time.perf_counter() - started
+        self.report(request, response, record)
+        return response
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+
+        # Under ASGI, the ORM runs in other threads (with their own connections), so queries aren't counted;
+        # the "timed()" blocks still are, since "sync_to_async()" carries the record over
+        record = _new_record()
+        record['queries'] = None
+        token = _current.set(record)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        record['duration'] = time.perf_counter() - started
+        self.report(request, response, record)
+        return response
+
+    @staticmethod
+    def report(request, response, record):
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        metrics.observe(view, response.status_code, record)
+        calls = {name: {'calls': calls, 'ms': round(seconds * 1000, 1)} for name, (calls, seconds) in record['calls'].items()}
+        logger.info(
+            '%s %s %s %.1f ms, %s queries, %s', request.method, view, response.status_code, record['duration'] * 1000,
+            'n/a' if record['queries'] is None else record['queries'],
+            ', '.join(f'{name} {call["calls"]}x {call["ms"]} ms' for name, call in calls.items()) or 'no timed calls',
+            extra={'user_app_metrics': {
+                'view': view, 'method': request.method, 'status': response.status_code,
+                'duration_ms': round(record['duration'] * 1000, 1), 'queries': record['queries'], 'calls': calls,
+            }},
+        )
+
+    @staticmethod
+    def count_query(execute, sql, params, many, context):
+        record = _current.get()
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if record is not None:
+                record['queries'] += 1
+                _add_call(record, 'db', time.perf_counter() - started)
+
+
+
+def render_metrics():
+    return metrics.render()
+
+
+def metrics_view(request):
+    '''
+    The metrics in the Prometheus text format. It isn't part of "user_app.urls"; route it yourself, and only where your scraper (not the public) can reach it.
+    '''
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,243 @@
+'''
+user_app.management.commands.benchmark_flows
+'''
+
+import json
+import math
+import platform
+import statistics
+import time
+from contextlib import contextmanager
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from user_app.models import user as customized_user_model, CustomizedEmailDevice
+
+
+FLOWS = ('signup', 'phone_verify', 'login', 'profile', 'email_verify', 'email_change')
+
+SMS_CODE = '123456'
+PASSWORD = 'Bench-Pa55word!'
+SEED_DOMAIN = 'seed.bench.invalid'
+SIGNUP_DOMAIN = 'signup.bench.invalid'
+
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the signup, phone verification, login, profile, email verification and email change flows '
+        'with the Django test client, at one or more user table sizes. Twilio and SMTP are replaced by the '
+        'in-process FakeBackend and the locmem email backend, and rate limits are off. It runs against a '
+        'separate test database (like "manage.py test"), never your real one. Reports the throughput, '
+        'p50/p99 latency and queries of every flow; --output saves them as JSON, which --compare can diff '
+        'against a previous run. For load tests against a running server, see "user_app/benchmarks/locustfile.py".'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000],
+                            help='User table sizes to measure at, e.g. "--sizes 10000 1000000" (default 10000).')
+        parser.add_argument('--iterations', type=int, default=100, help='Users taken through all flows at each size.')
+        parser.add_argument('--warmup', type=int, default=5, help='Unmeasured iterations before each size.')
+        parser.add_argument('--seed-batch-size', type=int, default=10000)
+        parser.add_argument('--fast-hashing', action='store_true',
+                            help='Use the (insecure) MD5 hasher, so the results show the app\'s own costs rather than the password hasher\'s.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the test database (and its seeded users) for the next run.')
+        parser.add_argument('--label', default='', help='Stored with the results, e.g. a version or commit.')
+        parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+        parser.add_argument('--compare', default=None, help='A previous --output file to compare the results with.')
+
+    def handle(self, *args, sizes, iterations, warmup, seed_batch_size, fast_hashing, keepdb, label, output, compare, **options):
+        if iterations < 1:
+            raise CommandError('--iterations must be at least 1.')
+        baseline = self.load(compare) if compare else None
+
+        overrides = {
+            'USER_APP_SMS_BACKEND': 'user_app.sms_backends.FakeBackend',
+            'USER_APP_FAKE_SMS_CODE': SMS_CODE,
+            'USER_APP_PHONE_RATE_LIMITS': {},
+            'USER_APP_EMAIL_OUTBOX': False,
+            'USER_APP_ACCOUNT_DELETION_QUEUE': False,
+            'USER_APP_INSTRUMENTATION_SAMPLE_RATE': 0,
+            'EMAIL_BACKEND': 'django.core.mail.backends.locmem.EmailBackend',
+            'ALLOWED_HOSTS': ['testserver'],
+        }
+        if fast_hashing:
+            overrides['PASSWORD_HASHERS'] = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb)
+        try:
+            with override_settings(**overrides):
+                results = []
+                for size in sorted(sizes):
+                    self.seed(size, seed_batch_size)
+                    results += self.run_size(size, iterations, warmup)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+
+        report = {
+            'label': label,
+            'created_at': timezone.now().isoformat(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'fast_hashing': fast_hashing,
+                'iterations': iterations,
+            },
+            'results': results,
+        }
+        self.print_results(results, baseline)
+        if output:
+            with open(output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'Results written to {output}.')
+
+    def seed(self, size, batch_size):
+        '''
+        Tops the user table up to "size" users (each with its email device), in chunks.
+        '''
+        existing = customized_user_model.objects.filter(email__endswith=f'@{SEED_DOMAIN}').count()
+        if existing >= size:
+            return
+        self.stdout.write(f'Seeding {size - existing} users...')
+        password = make_password(PASSWORD)
+        for start in range(existing, size, batch_size):
+            users = customized_user_model.objects.bulk_create(
+                customized_user_model(phone=f'+1201{2000000 + i:07d}', email=f'user{i}@{SEED_DOMAIN}', password=password, is_active=True, email_verified=True)
+                for i in range(start, min(start + batch_size, size))
+            )
+            if users[0].pk is None: # databases that don't return ids from bulk inserts
+                users = customized_user_model.objects.filter(email__in=[u.email for u in users])
+            CustomizedEmailDevice.objects.bulk_create(CustomizedEmailDevice(user=u, name=u.email, confirmed=True) for u in users)
+
+    def run_size(self, size, iterations, warmup):
+        # Users signed up by earlier runs/sizes would make the table bigger than "size"
+        customized_user_model.objects.filter(email__endswith=f'@{SIGNUP_DOMAIN}').delete()
+        self.stdout.write(f'Measuring at {size} users...')
+
+        timings = {flow: [] for flow in FLOWS}
+        queries = {flow: [] for flow in FLOWS}
+        for i in range(warmup + iterations):
+            measured = self.run_flows(size * 10 + i)
+            if i >= warmup:
+                for flow, (seconds, count) in measured.items():
+                    timings[flow].append(seconds)
+                    queries[flow].append(count)
+            mail.outbox = []
+
+        return [
+            {
+                'users': size,
+                'flow': flow,
+                'count': len(timings[flow]),
+                'ops_per_s': round(len(timings[flow]) / sum(timings[flow]), 2),
+                'mean_ms': round(statistics.mean(timings[flow]) * 1000, 3),
+                'p50_ms': round(self.percentile(timings[flow], 50) * 1000, 3),
+                'p99_ms': round(self.percentile(timings[flow], 99) * 1000, 3),
+                'queries': round(statistics.mean(queries[flow]), 2),
+            }
+            for flow in FLOWS
+        ]
+
+    def run_flows(self, n):
+        '''
+        Takes one new user through all flows; returns {flow: (seconds, queries)}.
+        '''
+        client = Client()
+        phone, email = f'+1650{2000000 + n % 8000000:07d}', f'user{n}@{SIGNUP_DOMAIN}'
+        measured = {}
+
+        with self.measure(measured, 'signup'):
+            response = client.post(reverse('user_app:create'), {
+                'first_name': 'Bench', 'last_name': 'User', 'phone': phone, 'email': email,
+                'gender': 'None', 'password1': PASSWORD, 'password2': PASSWORD,
+            })
+        self.expect(response, 'signup')
+        new_user = customized_user_model.objects.get(email=email)
+
+        with self.measure(measured, 'phone_verify'):
+            response = client.post(reverse('user_app:phone_verify', args=[new_user.uuid_value]), {'code': SMS_CODE})
+        self.expect(response, 'phone_verify')
+
+        with self.measure(measured, 'login'):
+            response = client.post(reverse('user_app:login'), {'username': phone, 'password': PASSWORD})
+        self.expect(response, 'login')
+
+        with self.measure(measured, 'profile'):
+            response = client.get(reverse('user_app:profile', args=[new_user.uuid_value]))
+        self.expect(response, 'profile', expected=200)
+
+        # The email flows take two requests each: sending the token, and submitting it
+        device = CustomizedEmailDevice.objects.get(user=new_user)
+        with self.measure(measured, 'email_verify'):
+            client.post(reverse('user_app:email_verify'), {'otp_device': device.persistent_id, 'otp_challenge': '1'})
+            response = client.post(reverse('user_app:email_verify'), {'otp_device': device.persistent_id, 'otp_token': self.token(device)})
+        self.expect(response, 'email_verify')
+
+        new_email = f'changed{n}@{SIGNUP_DOMAIN}'
+        with self.measure(measured, 'email_change'):
+            client.post(reverse('user_app:email_change'), {'otp_device': device.persistent_id, 'otp_challenge': '1', 'new_email': new_email})
+            response = client.post(reverse('user_app:email_change'), {'otp_device': device.persistent_id, 'otp_token': self.token(device), 'new_email': new_email})
+        self.expect(response, 'email_change')
+
+        return measured
+
+    @staticmethod
+    def token(device):
+        # Read the token the (unmeasured) way a test would; the email itself only went to the locmem outbox
+        return CustomizedEmailDevice.objects.values_list('token', flat=True).get(pk=device.pk)
+
+    @contextmanager
+    def measure(self, measured, flow):
+        count = 0
+
+        def counter(execute, sql, params, many, context):
+            nonlocal count
+            count += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(counter):
+            started = time.perf_counter()
+            yield
+            seconds = time.perf_counter() - started
+        measured[flow] = (seconds, count)
+
+    @staticmethod
+    def expect(response, flow, expected=302):
+        if response.status_code != expected:
+            raise CommandError(f'The {flow} flow failed (HTTP {response.status_code}); is "user_app.urls" included in your ROOT_URLCONF?')
+
+    @staticmethod
+    def percentile(values, percent):
+        # Nearest-rank percentile
+        ordered = sorted(values)
+        return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+    @staticmethod
+    def load(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return {(r['users'], r['flow']): r for r in json.load(f)['results']}
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f'Can\'t read {path}: {e}')
+
+    def print_results(self, results, baseline):
+        self.stdout.write(f'{"users":>9} {"flow":<14} {"ops/s":>9} {"p50 ms":>9} {"p99 ms":>9} {"queries":>8}' + ('  p50 vs. baseline' if baseline else ''))
+        for r in results:
+            line = f'{r["users"]:>9} {r["flow"]:<14} {r["ops_per_s"]:>9.1f} {r["p50_ms"]:>9.2f} {r["p99_ms"]:>9.2f} {r["queries"]:>8.1f}'
+            previous = baseline.get((r['users'], r['flow'])) if baseline else None
+            if previous:
+                line += f'  {(r["p50_ms"] - previous["p50_ms"]) / previous["p50_ms"] * 100:+6.1f}%'
+                if r['queries'] != previous['queries']:
+                    line += f' (queries: {previous["queries"]:g} -> {r["queries"]:g})'
+            self.stdout.write(line)
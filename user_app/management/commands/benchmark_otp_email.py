@@ -0,0 +1,38 @@
+'''
+user_app.management.commands.benchmark_otp_email
+'''
+
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.template import Context, Template
+from django.template.loader import get_template
+
+from django_otp.plugins.otp_email.conf import settings
+
+from user_app.models import compile_email_body_template
+
+
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmarks the ways an OTP email body can be rendered.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=10000, help='Renders per path.')
+        parser.add_argument('--template', default='Your OTP token is {{ token }}. It expires in {{ minutes }} minutes.',
+                            help='The inline template string to benchmark (defaults to a short sample; OTP_EMAIL_BODY_TEMPLATE is not required).')
+
+    def handle(self, *args, number, template, **options):
+        context = {'token': '123456', 'minutes': 5}
+        compile_email_body_template.cache_clear()
+
+        paths = {
+            'inline string, parsed every time': lambda: Template(template).render(Context(context)),
+            'inline string, cached compile': lambda: compile_email_body_template(template).render(Context(context)),
+            f'get_template({settings.OTP_EMAIL_BODY_TEMPLATE_PATH!r})': lambda: get_template(settings.OTP_EMAIL_BODY_TEMPLATE_PATH).render(context),
+        }
+
+        for name, render in paths.items():
+            seconds = timeit.timeit(render, number=number)
+            self.stdout.write(f'{name:<50} {seconds / number * 1e6:8.2f} us/render  ({number / seconds:,.0f} renders/s)')
@@ -0,0 +1,44 @@
+'''
+user_app.management.commands.benchmark_password_hashers
+'''
+
+import os
+import time
+
+from django.contrib.auth.hashers import get_hashers
+from django.core.management.base import BaseCommand
+
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures how many passwords per second each hasher in PASSWORD_HASHERS can hash on one core '
+        '(a login, password change or password check costs one hash), to help size worker pools.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=2.0, help='Time spent measuring each hasher.')
+        parser.add_argument('--logins-per-second', type=float, default=None,
+                            help='If given, also prints how many cores that login rate needs with each hasher.')
+
+    def handle(self, *args, seconds, logins_per_second, **options):
+        self.stdout.write(f'{os.cpu_count()} cores available. The first hasher below is used for new passwords.')
+
+        for hasher in get_hashers():
+            try:
+                hasher.encode('benchmark-password', hasher.salt()) # warm up (and check that its library is installed)
+            except ValueError as e:
+                self.stdout.write(f'{hasher.algorithm:<16} skipped: {e}')
+                continue
+
+            count, started = 0, time.perf_counter()
+            while time.perf_counter() - started < seconds:
+                hasher.encode('benchmark-password', hasher.salt())
+                count += 1
+            rate = count / (time.perf_counter() - started)
+
+            line = f'{hasher.algorithm:<16} {rate:10.1f} hashes/s/core  {1000 / rate:8.1f} ms/hash'
+            if logins_per_second:
+                line += f'  {logins_per_second / rate:8.1f} cores for {logins_per_second:g} logins/s'
+            self.stdout.write(line)
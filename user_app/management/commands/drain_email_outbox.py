@@ -0,0 +1,40 @@
+'''
+user_app.management.commands.drain_email_outbox
+'''
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from user_app import outbox
+
+
+PURGE_INTERVAL = 3600 # seconds between purges of old sent emails (with --loop)
+
+
+
+
+class Command(BaseCommand):
+    help = 'Delivers the queued emails of the user_app outbox, and deletes sent ones older than USER_APP_OUTBOX_SENT_RETENTION (see "user_app.outbox").'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Emails sent per batch (defaults to USER_APP_OUTBOX_BATCH_SIZE).')
+        parser.add_argument('--loop', action='store_true', help='Keep running, polling the outbox for new emails.')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep between polls when the outbox is empty (with --loop).')
+
+    def handle(self, *args, batch_size, loop, interval, **options):
+        purged_at = None
+        while True:
+            if purged_at is None or time.monotonic() - purged_at >= PURGE_INTERVAL:
+                purged = outbox.purge_sent()
+                if purged:
+                    self.stdout.write(f'Deleted {purged} sent email(s).')
+                purged_at = time.monotonic()
+
+            sent, failed = outbox.drain(batch_size=batch_size)
+            if sent or failed:
+                self.stdout.write(f'Sent {sent}, failed {failed}.')
+                continue
+            if not loop:
+                break # without --loop, we only drain what's currently due
+            time.sleep(interval)
@@ -0,0 +1,70 @@
+'''
+user_app.management.commands.export_users
+'''
+
+import csv
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from user_app.models import user as customized_user_model
+
+
+FIELDS = ['uuid_value', 'phone', 'email', 'first_name', 'last_name', 'gender', 'username', 'is_active', 'email_verified', 'date_joined']
+
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Exports all users to CSV or JSONL (the format "import_users" reads), in constant memory: rows are '
+        'streamed from a server-side cursor instead of being loaded all at once.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The output file, or "-" for stdout.')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], default=None, help='Defaults to the file extension (csv for stdout).')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched from the database at a time.')
+        parser.add_argument('--include-passwords', action='store_true', help='Also export the password hashes.')
+
+    def handle(self, *args, path, format, chunk_size, include_passwords, **options):
+        format = format or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        fields = FIELDS + ['password'] if include_passwords else FIELDS
+        try:
+            stream = self.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(e)
+
+        rows = (
+            customized_user_model.objects
+            .order_by('pk')
+            .values_list(*fields)
+            .iterator(chunk_size=chunk_size)
+        )
+
+        try:
+            if format == 'csv':
+                writer = csv.writer(stream)
+                writer.writerow(fields)
+            count = 0
+            for row in rows:
+                row = [self.serialize(value) for value in row]
+                if format == 'csv':
+                    writer.writerow(row)
+                else:
+                    stream.write(json.dumps(dict(zip(fields, row))) + '\n')
+                count += 1
+        finally:
+            if stream is not self.stdout:
+                stream.close()
+
+        (sys.stderr if stream is self.stdout else self.stdout).write(f'Exported {count} users.\n')
+
+    @staticmethod
+    def serialize(value):
+        if value is None or isinstance(value, bool):
+            return value
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        return str(value)
@@ -0,0 +1,206 @@
+'''
+user_app.management.commands.import_users
+'''
+
+import csv
+import itertools
+import json
+import sys
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX, identify_hasher, make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from user_app.phones import to_python
+
+from user_app.models import user as customized_user_model, CustomizedEmailDevice
+
+
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 't'}
+
+# Validated with the model fields' "clean()" (choices, max_length, format), so a bad value makes its row invalid
+# instead of failing the whole chunk's INSERT (on PostgreSQL, e.g. with a DataError for a value that's too long)
+VALIDATED_FIELDS = ('email', 'username', 'first_name', 'last_name', 'gender')
+
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports users from a CSV or JSONL file (or stdin), in constant memory. Rows are inserted in chunks with '
+        '"bulk_create"; rows whose phone/email/username already exist are skipped. Every imported user gets its '
+        'email OTP device. Columns: phone, email (required), first_name, last_name, gender, username, is_active, '
+        'email_verified, date_joined, uuid_value, password (an already-hashed password, e.g. "pbkdf2_sha256$...").'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The file to import, or "-" for stdin.')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], default=None, help='Defaults to the file extension (csv for stdin).')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--region', default=None, help='Region for numbers without a country code (defaults to PHONENUMBER_DEFAULT_REGION).')
+        parser.add_argument('--hash-passwords', action='store_true',
+                            help='Treat the "password" column as plain text and hash it (slow!). Without it, passwords must be pre-hashed.')
+
+    def handle(self, *args, path, format, batch_size, region, hash_passwords, **options):
+        format = format or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        try:
+            stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(e)
+
+        try:
+            if format == 'csv':
+                rows, parse = self.csv_rows(stream), dict
+            else:
+                rows, parse = self.jsonl_rows(stream), self.parse_json
+            read = imported = skipped = invalid = 0
+
+            for chunk in self.chunked(rows, batch_size):
+                users = []
+                for line_no, row in chunk:
+                    try:
+                        users.append(self.build_user(parse(row), region, hash_passwords))
+                    except ValueError as e:
+                        self.stderr.write(f'Line {line_no}: {e}')
+                        invalid += 1
+
+                created = self.insert(users)
+                read += len(chunk)
+                imported += created
+                skipped += len(users) - created
+                self.stdout.write(f'{read} rows read: {imported} imported, {skipped} skipped (already exist), {invalid} invalid')
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        self.stdout.write(self.style.SUCCESS(f'Done: {imported} imported, {skipped} skipped, {invalid} invalid.'))
+
+    @staticmethod
+    def csv_rows(stream):
+        '''
+        Yields (line number, row) pairs; the line number is the one the row ends on.
+        '''
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+
+    @staticmethod
+    def jsonl_rows(stream):
+        '''
+        Yields (line number, line) pairs, skipping blank lines. Lines are parsed in "handle()", with the other row
+        errors, so a malformed one is reported as an invalid row instead of aborting the import.
+        '''
+        for line_no, line in enumerate(stream, start=1):
+            if line.strip():
+                yield line_no, line
+
+    @staticmethod
+    def parse_json(line):
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f'invalid JSON ({e})')
+        if not isinstance(row, dict):
+            raise ValueError('not a JSON object')
+        return row
+
+    @staticmethod
+    def chunked(iterable, size):
+        iterator = iter(iterable)
+        while chunk := list(itertools.islice(iterator, size)):
+            yield chunk
+
+    def build_user(self, row, region, hash_passwords):
+        phone = to_python((row.get('phone') or '').strip(), region=region)
+        if not phone or not phone.is_valid():
+            raise ValueError(f'invalid phone number {row.get("phone")!r}')
+        if not row.get('email'):
+            raise ValueError('missing email')
+
+        password = row.get('password') or None
+        if password and hash_passwords:
+            password = make_password(password)
+        elif password and not password.startswith(UNUSABLE_PASSWORD_PREFIX):
+            try:
+                identify_hasher(password)
+            except ValueError:
+                raise ValueError('the password is not a recognized hash (use --hash-passwords for plain-text passwords)')
+        else:
+            password = make_password(None) # unusable password; the user has to reset it
+
+        user = customized_user_model(
+            uuid_value=uuid.UUID(row['uuid_value']) if row.get('uuid_value') else uuid.uuid4(),
+            phone=phone.as_e164,
+            email=row['email'].strip(),
+            username=row.get('username') or None,
+            first_name=row.get('first_name') or '',
+            last_name=row.get('last_name') or '',
+            gender=row.get('gender') or 'None',
+            is_active=self.to_bool(row.get('is_active'), default=True),
+            email_verified=self.to_bool(row.get('email_verified'), default=False),
+            date_joined=self.to_datetime(row.get('date_joined')),
+            password=password,
+        )
+        self.validate(user)
+        return user
+
+    @staticmethod
+    def validate(user):
+        for name in VALIDATED_FIELDS:
+            field = user._meta.get_field(name)
+            value = getattr(user, field.attname)
+            if value is None and field.null:
+                continue
+            try:
+                setattr(user, field.attname, field.clean(value, user))
+            except ValidationError as e:
+                raise ValueError(f'invalid {name} {value!r} ({" ".join(e.messages)})')
+
+    @staticmethod
+    def to_bool(value, default):
+        if value in (None, ''):
+            return default
+        if isinstance(value, bool):
+            return value
+        return str(value).strip().lower() in TRUE_VALUES
+
+    @staticmethod
+    def to_datetime(value):
+        if not value:
+            return timezone.now()
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError(f'invalid date_joined {value!r}')
+        if settings.USE_TZ and timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed) # in the current time zone
+        return parsed
+
+    @staticmethod
+    def insert(users):
+        '''
+        Inserts a chunk of users plus their email devices; returns how many users were actually inserted.
+        '''
+        if not users:
+            return 0
+
+        uuids = {u.uuid_value for u in users}
+        with transaction.atomic():
+            # With "ignore_conflicts", the inserted rows' ids aren't returned; we find them by their uuids, leaving out
+            # the users that already had one of those uuids before the insert
+            existing = set(customized_user_model.objects.filter(uuid_value__in=uuids).values_list('uuid_value', flat=True))
+            customized_user_model.objects.bulk_create(users, ignore_conflicts=True)
+            created = list(
+                customized_user_model.objects
+                .filter(uuid_value__in=uuids - existing)
+                .values_list('pk', 'email')
+            )
+            CustomizedEmailDevice.objects.bulk_create(
+                CustomizedEmailDevice(user_id=pk, name=email) for pk, email in created
+            )
+
+        return len(created)
@@ -0,0 +1,30 @@
+'''
+user_app.management.commands.process_account_deletions
+'''
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from user_app import deletion
+
+
+
+
+class Command(BaseCommand):
+    help = 'Processes queued account deletions (see "user_app.deletion").'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Rows deleted per batch (defaults to USER_APP_ACCOUNT_DELETION_BATCH_SIZE).')
+        parser.add_argument('--loop', action='store_true', help='Keep running, polling the queue for new deletions.')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds to sleep between polls when the queue is empty (with --loop).')
+
+    def handle(self, *args, batch_size, loop, interval, **options):
+        while True:
+            processed = deletion.process_next(batch_size=batch_size)
+            if processed is not None:
+                self.stdout.write(f'Account {processed.user_uuid}: {processed.status} ({processed.deleted_rows} rows deleted).')
+                continue
+            if not loop:
+                break # without --loop, we only process what's currently queued
+            time.sleep(interval)
@@ -0,0 +1,20 @@
+'''
+user_app.management.commands.sweep_pending_verifications
+'''
+
+from django.core.management.base import BaseCommand
+
+from user_app.cleanup import delete_inactive_pending_verifications
+
+
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired pending phone/email verifications, in batches. Meant to be run periodically, e.g. from cron. ("sweep_stale_data" does this too.)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, batch_size, **options):
+        deleted = delete_inactive_pending_verifications(batch_size)
+        self.stdout.write(self.style.SUCCESS(f'{deleted} pending verification(s) deleted.'))
@@ -0,0 +1,61 @@
+'''
+user_app.management.commands.sweep_stale_data
+'''
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from user_app import cleanup
+from user_app.models import PendingVerification
+
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes abandoned signups (inactive accounts that never logged in or verified anything, older than USER_APP_UNVERIFIED_ACCOUNT_TTL), '
+        'clears expired email OTP tokens and deletes expired pending verifications, in batches (see "user_app.cleanup"). '
+        'Meant to be run periodically, e.g. from cron, or kept running with --loop.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per batch (and transaction).')
+        parser.add_argument('--ttl', type=int, default=None, help='Seconds before an abandoned signup is deleted (defaults to USER_APP_UNVERIFIED_ACCOUNT_TTL).')
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be removed.')
+        parser.add_argument('--loop', action='store_true', help='Keep running, sweeping every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=3600.0, help='Seconds between sweeps (with --loop).')
+
+    def handle(self, *args, batch_size, ttl, dry_run, loop, interval, **options):
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        self.verbosity = options['verbosity']
+        while True:
+            self.sweep(batch_size, ttl, dry_run)
+            if not loop or dry_run:
+                break
+            time.sleep(interval)
+
+    def sweep(self, batch_size, ttl, dry_run):
+        now = timezone.now()
+        steps = [
+            ('abandoned account(s)', 'deleted', cleanup.stale_accounts(ttl, now),
+             lambda progress: cleanup.delete_stale_accounts(batch_size, ttl, now, progress)),
+            ('expired email token(s)', 'cleared', cleanup.expired_tokens(now),
+             lambda progress: cleanup.clear_expired_tokens(batch_size, now, progress)),
+            ('expired pending verification(s)', 'deleted', PendingVerification.objects.expired(),
+             lambda progress: cleanup.delete_inactive_pending_verifications(batch_size, progress)),
+        ]
+        for label, verb, queryset, run in steps:
+            total = queryset.count()
+            if dry_run:
+                self.stdout.write(f'{total} {label} would be {verb}.')
+                continue
+            done = run(lambda count: self.progress(label, verb, count, total)) if total else 0
+            self.stdout.write(self.style.SUCCESS(f'{done} {label} {verb}.'))
+
+    def progress(self, label, verb, count, total):
+        # Once per batch; "-v 0" keeps cron output to the totals
+        if self.verbosity >= 1:
+            self.stdout.write(f'  {label}: {count}/{total} {verb}...')
@@ -0,0 +1,58 @@
+'''
+Adds a unique index on "user.uuid_value".
+
+On PostgreSQL the index is built with "CREATE UNIQUE INDEX CONCURRENTLY", so a big user table
+isn't locked against writes while the index is being built. That's why this migration is
+non-atomic. Other backends get a regular unique index.
+'''
+
+import uuid
+
+from django.db import migrations, models
+
+
+INDEX_NAME = 'user_app_user_uuid_value_uniq'
+
+
+def create_uuid_value_index(apps, schema_editor):
+    connection = schema_editor.connection
+    table = connection.ops.quote_name(apps.get_model('user_app', 'user')._meta.db_table)
+    concurrently = 'CONCURRENTLY ' if connection.vendor == 'postgresql' else ''
+    schema_editor.execute(
+        f'CREATE UNIQUE INDEX {concurrently}{connection.ops.quote_name(INDEX_NAME)} ON {table} ({connection.ops.quote_name("uuid_value")})'
+    )
+
+
+def drop_uuid_value_index(apps, schema_editor):
+    connection = schema_editor.connection
+    table = connection.ops.quote_name(apps.get_model('user_app', 'user')._meta.db_table)
+    if connection.vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {connection.ops.quote_name(INDEX_NAME)}')
+    elif connection.vendor == 'mysql':
+        schema_editor.execute(f'DROP INDEX {connection.ops.quote_name(INDEX_NAME)} ON {table}')
+    else:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {connection.ops.quote_name(INDEX_NAME)}')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False # "CREATE INDEX CONCURRENTLY" can't run inside a transaction
+
+    dependencies = [
+        ('user_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='user',
+                    name='uuid_value',
+                    field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(create_uuid_value_index, drop_uuid_value_index),
+            ],
+        ),
+    ]
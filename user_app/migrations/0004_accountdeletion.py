@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_app', '0003_outboxemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField(db_index=True)),
+                ('user_uuid', models.UUIDField()),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('in_progress', 'In progress'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=11)),
+                ('deleted_rows', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('requested_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'requested_at'], name='user_app_ac_status_f3ae35_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:51
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def copy_pending_changes(apps, schema_editor):
+    """
+    Moves pending phone/email changes from the user row into "PendingVerification". They get a fresh
+    expiry; when several users had the same pending target, only the first one keeps it.
+    """
+    User = apps.get_model('user_app', 'user')
+    PendingVerification = apps.get_model('user_app', 'PendingVerification')
+    expires_at = timezone.now() + timedelta(seconds=getattr(settings, 'USER_APP_PENDING_VERIFICATION_TTL', 600))
+
+    for kind, field in (('phone', 'phone_temp'), ('email', 'email_temp')):
+        rows = (
+            User.objects.using(schema_editor.connection.alias)
+            .exclude(**{f'{field}__isnull': True}).exclude(**{field: ''})
+            .values_list('pk', field).order_by('pk').iterator(chunk_size=2000)
+        )
+        batch = []
+        for pk, target in rows:
+            batch.append(PendingVerification(user_id=pk, kind=kind, target=str(target), expires_at=expires_at))
+            if len(batch) == 2000:
+                PendingVerification.objects.using(schema_editor.connection.alias).bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        PendingVerification.objects.using(schema_editor.connection.alias).bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_app', '0004_accountdeletion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingVerification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('phone', 'Phone number'), ('email', 'Email address')], max_length=5)),
+                ('target', models.CharField(max_length=254)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_verifications', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='pendingverification',
+            constraint=models.UniqueConstraint(fields=('user', 'kind'), name='user_app_pendingverification_user_kind'),
+        ),
+        migrations.AddConstraint(
+            model_name='pendingverification',
+            constraint=models.UniqueConstraint(fields=('kind', 'target'), name='user_app_pendingverification_kind_target'),
+        ),
+        migrations.RunPython(copy_pending_changes, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='user',
+            name='email_temp',
+        ),
+        migrations.RemoveField(
+            model_name='user',
+            name='phone_temp',
+        ),
+    ]
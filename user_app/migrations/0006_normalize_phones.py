@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:10
+
+from django.db import migrations, transaction
+
+import user_app.phones
+
+
+BATCH_SIZE = 2000
+
+
+def _normalize(model, field, queryset, alias):
+    """
+    Rewrites "field" in E.164 where it isn't, one batch (in its own transaction) at a time. Values that
+    can't be normalized (invalid numbers, or numbers already stored in E.164 on another row) are left as they are.
+    """
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', field)[:BATCH_SIZE])
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+
+        with transaction.atomic(using=alias):
+            for pk, value in rows:
+                number = user_app.phones.to_python(getattr(value, 'raw_input', value)) # the value as stored
+                if not number or not number.is_valid() or number.raw_input == number.as_e164:
+                    continue
+                if queryset.filter(**{field: number.as_e164}).exclude(pk=pk).exists():
+                    continue
+                model.objects.using(alias).filter(pk=pk).update(**{field: number.as_e164})
+
+
+def normalize_phones(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    User = apps.get_model('user_app', 'user')
+    PendingVerification = apps.get_model('user_app', 'PendingVerification')
+    _normalize(User, 'phone', User.objects.using(alias), alias)
+    _normalize(PendingVerification, 'target', PendingVerification.objects.using(alias).filter(kind='phone'), alias)
+
+
+class Migration(migrations.Migration):
+
+    # Each batch commits on its own, so the backfill never holds locks on the whole table
+    atomic = False
+
+    dependencies = [
+        ('user_app', '0005_pendingverification'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='phone',
+            field=user_app.phones.PhoneNumberField(help_text='Please provide a valid phone number in international format.', max_length=128, region=None, unique=True, verbose_name='Phone Number'),
+        ),
+        migrations.RunPython(normalize_phones, migrations.RunPython.noop),
+    ]
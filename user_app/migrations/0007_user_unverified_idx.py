@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_app', '0006_normalize_phones'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('is_active', False), ('last_login__isnull', True)), fields=['date_joined'], name='user_app_user_unverified_idx'),
+        ),
+    ]
@@ -3,12 +3,17 @@ user_app.models
 '''
 
 import uuid
+from datetime import timedelta
+from functools import lru_cache
 
-from django.db import models
+from django.db import models, transaction
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.core.mail import send_mail
 from django.template import Context, Template
 from django.template.loader import get_template
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.contrib.auth.models import AbstractUser
@@ -16,7 +21,8 @@ from django.contrib.auth.models import AbstractUser
 from django_otp.plugins.otp_email.conf import settings
 from django_otp.models import SideChannelDevice, ThrottlingMixin
 
-from phonenumber_field.modelfields import PhoneNumberField
+from .instrumentation import timed
+from .phones import PhoneNumberField, to_python
 
 
 
@@ -33,6 +39,21 @@ from phonenumber_field.modelfields import PhoneNumberField
 
 
 
+@lru_cache(maxsize=8)
+def compile_email_body_template(template_string):
+    """
+    "settings.OTP_EMAIL_BODY_TEMPLATE" is compiled only once per process (per distinct value), instead of on every challenge.
+    """
+    return Template(template_string)
+
+
+@receiver(setting_changed)
+def _clear_email_body_template_cache(setting, **kwargs):
+    if setting == 'OTP_EMAIL_BODY_TEMPLATE':
+        compile_email_body_template.cache_clear()
+
+
+
 class user(AbstractUser):
 
     """
@@ -41,6 +62,7 @@ class user(AbstractUser):
 
     uuid_value = models.UUIDField(
         primary_key=False,
+        unique=True, # every profile/verification URL looks users up by this value
         default=uuid.uuid4,
         editable=False,
         null=False)
@@ -51,21 +73,12 @@ class user(AbstractUser):
         blank=False, 
         null=False,
         help_text= _('Please provide a valid phone number in international format.'),)
-    phone_temp = PhoneNumberField(
-        _('temporary phone number'),
-        blank=True, 
-        null=True,)
-
     email = models.EmailField(
         _('Email Address'),
         unique=True, 
         blank=False, 
         null=False,
         help_text= _('Please provide a valid email address'),)
-    email_temp = models.EmailField(
-        _('temporary email address'), 
-        blank=True, 
-        null=True, )
     email_verified = models.BooleanField(default=False)
 
     username_validator = UnicodeUsernameValidator()
@@ -101,11 +114,130 @@ class user(AbstractUser):
     def get_absolute_url(self):
         return reverse('user_app:profile', kwargs={'uuid_value': self.uuid_value})
 
+    # The following methods change a user's state with narrow UPDATEs (only the touched columns are
+    # written), instead of a bare "save()" rewriting the whole row. Use them for every mutation.
+
+    def activate(self):
+        self.is_active = True
+        self.save(update_fields=['is_active'])
+
+    def mark_email_verified(self):
+        self.email_verified = True
+        self.save(update_fields=['email_verified'])
+
+    # Password hashing is deliberately slow; its share of a request shows up in "user_app.instrumentation"
+
+    def set_password(self, raw_password):
+        with timed('password_hash'):
+            super().set_password(raw_password)
+
+    def check_password(self, raw_password):
+        with timed('password_hash'):
+            return super().check_password(raw_password)
+
+    # Pending phone/email changes live in "PendingVerification" rather than on the user row.
+    # "phone_temp" and "email_temp" give read access to the active ones (cached per instance).
+
+    def pending_target(self, kind):
+        cache = self.__dict__.setdefault('_pending_targets', {})
+        if kind not in cache:
+            cache[kind] = None if self.pk is None else (
+                PendingVerification.objects.active().filter(user=self, kind=kind).values_list('target', flat=True).first()
+            )
+        return cache[kind]
+
+    async def apending_target(self, kind):
+        # The async counterpart of "pending_target()"; fills the same per-instance cache
+        cache = self.__dict__.setdefault('_pending_targets', {})
+        if kind not in cache:
+            cache[kind] = None if self.pk is None else (
+                await PendingVerification.objects.active().filter(user=self, kind=kind).values_list('target', flat=True).afirst()
+            )
+        return cache[kind]
+
+    @property
+    def phone_temp(self):
+        target = self.pending_target(PendingVerification.PHONE)
+        return to_python(target) if target else None
+
+    @property
+    def email_temp(self):
+        return self.pending_target(PendingVerification.EMAIL)
+
+    def start_pending_verification(self, kind, target):
+        """
+        Records "target" as this user's pending (unverified) phone number/email address. Raises IntegrityError
+        if another user has an active pending verification for the same target.
+        """
+        target = str(target)
+        with transaction.atomic():
+            # Replaces the user's previous one; expired claims of the same target (not swept yet) mustn't block anyone either
+            PendingVerification.objects.filter(
+                models.Q(user=self) | models.Q(target=target) & PendingVerificationQuerySet.inactive_q(), kind=kind,
+            ).delete()
+            PendingVerification.objects.create(user=self, kind=kind, target=target, expires_at=PendingVerification.new_expiry())
+        self.__dict__.setdefault('_pending_targets', {})[kind] = target
+
+    def clear_pending_verification(self, kind):
+        PendingVerification.objects.filter(user=self, kind=kind).delete()
+        self.__dict__.setdefault('_pending_targets', {})[kind] = None
+
+    def record_pending_verification_attempt(self, kind):
+        """
+        Counts a verification attempt. Once the maximum is reached, the pending verification isn't active anymore, but
+        it's kept until it expires (see "pending_verification_exhausted()"), so the verification can't just be restarted.
+        """
+        PendingVerification.objects.filter(user=self, kind=kind).update(attempts=models.F('attempts') + 1)
+        if not PendingVerification.objects.active().filter(user=self, kind=kind).exists():
+            self.__dict__.setdefault('_pending_targets', {})[kind] = None
+
+    def pending_verification_exhausted(self, kind):
+        """
+        Whether this user's pending verification of "kind" is out of attempts (and not expired yet).
+        """
+        return PendingVerification.objects.exhausted().filter(user=self, kind=kind).exists()
+
+    def set_temp_phone(self, phone):
+        # Stored in E.164 (like "phone"), so the same number always is the same target
+        self.start_pending_verification(PendingVerification.PHONE, to_python(phone).as_e164)
+
+    def _promote_pending_verification(self, kind, field):
+        previous = getattr(self, field)
+        try:
+            with transaction.atomic():
+                setattr(self, field, self.pending_target(kind))
+                self.save(update_fields=[field])
+                self.clear_pending_verification(kind)
+        except Exception:
+            # Nothing was saved; the rest of the request mustn't see the new value either
+            setattr(self, field, previous)
+            self.__dict__.get('_pending_targets', {}).pop(kind, None)
+            raise
+
+    def promote_temp_phone(self):
+        """
+        Makes the (verified) pending phone number the user's phone number. Raises IntegrityError if the number has been taken in the meantime.
+        """
+        self._promote_pending_verification(PendingVerification.PHONE, 'phone')
+
+    def set_temp_email(self, email):
+        self.start_pending_verification(PendingVerification.EMAIL, email)
+
+    def promote_temp_email(self):
+        """
+        Makes the (verified) pending email address the user's email address. Raises IntegrityError if the address has been taken in the meantime.
+        """
+        self._promote_pending_verification(PendingVerification.EMAIL, 'email')
+
     def __str__(self):
         return str(self.phone)
 
     class Meta:
         abstract = False
+        indexes = [
+            # Abandoned signups (never activated, never logged in) by age, for "user_app.cleanup"
+            models.Index(fields=['date_joined'], name='user_app_user_unverified_idx', condition=models.Q(is_active=False, last_login__isnull=True)),
+        ]
 
 
 
@@ -138,14 +270,22 @@ class CustomizedEmailDevice(ThrottlingMixin, SideChannelDevice):
 
         context = {'token': self.token, **(extra_context or {})}
         if settings.OTP_EMAIL_BODY_TEMPLATE:
-            body = Template(settings.OTP_EMAIL_BODY_TEMPLATE).render(Context(context))
+            body = compile_email_body_template(settings.OTP_EMAIL_BODY_TEMPLATE).render(Context(context))
         else:
             body = get_template(settings.OTP_EMAIL_BODY_TEMPLATE_PATH).render(context)
 
-        send_mail(settings.OTP_EMAIL_SUBJECT,
-                  body,
-                  settings.OTP_EMAIL_SENDER,
-                  [self.email or self.user.email])
+        if getattr(settings, 'USER_APP_EMAIL_OUTBOX', False):
+            # The email is queued and delivered later by the "drain_email_outbox" management command
+            from .outbox import enqueue
+            deliver = enqueue
+        else:
+            deliver = send_mail
+
+        with timed('email'):
+            deliver(settings.OTP_EMAIL_SUBJECT,
+                    body,
+                    settings.OTP_EMAIL_SENDER,
+                    [self.email or self.user.email])
 
         message = f"sent to {self.email or self.user.email}"
 
@@ -157,10 +297,10 @@ class CustomizedEmailDevice(ThrottlingMixin, SideChannelDevice):
             verified = super().verify_token(token)
 
             if verified:
-                self.throttle_reset()
+                if self.throttling_failure_count or self.throttling_failure_timestamp:
+                    self.throttle_reset() # (it's an extra UPDATE; only needed if there were failed attempts)
                 if not self.user.email_verified:
-                    self.user.email_verified = True
-                    self.user.save()
+                    self.user.mark_email_verified()
             else:
                 self.throttle_increment()
         else:
@@ -169,3 +309,142 @@ class CustomizedEmailDevice(ThrottlingMixin, SideChannelDevice):
         return verified
 
 
+
+
+
+
+class OutboxEmail(models.Model):
+
+    """
+    An outgoing email waiting to be delivered by the "drain_email_outbox" management command (see "user_app.outbox").
+    """
+
+    QUEUED = 'queued'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    subject = models.CharField(max_length=998)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254, blank=True, null=True)
+    recipients = models.TextField(help_text='Comma-separated list of recipient addresses')
+
+    status = models.CharField(
+        max_length=6,
+        choices=[(QUEUED, 'Queued'), (SENT, 'Sent'), (FAILED, 'Failed'),],
+        default=QUEUED,)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f'{self.subject} -> {self.recipients} ({self.status})'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']), # the worker's "what's due?" query
+        ]
+
+
+
+
+class AccountDeletion(models.Model):
+
+    """
+    A queued account removal, processed by the "process_account_deletions" management command (see "user_app.deletion").
+    It doesn't reference the user with a foreign key, so the record outlives the account and the progress stays observable.
+    """
+
+    QUEUED = 'queued'
+    IN_PROGRESS = 'in_progress'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    user_id = models.BigIntegerField(db_index=True)
+    user_uuid = models.UUIDField()
+
+    status = models.CharField(
+        max_length=11,
+        choices=[(QUEUED, 'Queued'), (IN_PROGRESS, 'In progress'), (DONE, 'Done'), (FAILED, 'Failed'),],
+        default=QUEUED,)
+    deleted_rows = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    requested_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f'{self.user_uuid} ({self.status})'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'requested_at']),
+        ]
+
+
+
+
+class PendingVerificationQuerySet(models.QuerySet):
+
+    def active(self):
+        return self.filter(expires_at__gt=timezone.now(), attempts__lt=self.max_attempts())
+
+    def inactive(self):
+        return self.filter(self.inactive_q())
+
+    def exhausted(self):
+        return self.filter(expires_at__gt=timezone.now(), attempts__gte=self.max_attempts())
+
+    def expired(self):
+        return self.filter(expires_at__lte=timezone.now())
+
+    @staticmethod
+    def max_attempts():
+        return getattr(settings, 'USER_APP_PENDING_VERIFICATION_MAX_ATTEMPTS', 5)
+
+    @classmethod
+    def inactive_q(cls):
+        # Expired, or out of attempts
+        return models.Q(expires_at__lte=timezone.now()) | models.Q(attempts__gte=cls.max_attempts())
+
+
+
+class PendingVerification(models.Model):
+
+    """
+    A phone number or email address a user wants to switch to, waiting to be verified. Keeping these in
+    their own table keeps the user row narrow. Rows are deleted once they're verified, and expired ones
+    are removed by the "sweep_pending_verifications" management command. Rows out of attempts don't
+    reserve their target anymore, but are kept until they expire, so the user can't start over at once.
+
+    Optional settings: USER_APP_PENDING_VERIFICATION_TTL (seconds, default 600) and
+    USER_APP_PENDING_VERIFICATION_MAX_ATTEMPTS (default 5).
+    """
+
+    PHONE = 'phone'
+    EMAIL = 'email'
+
+    user = models.ForeignKey(user, on_delete=models.CASCADE, related_name='pending_verifications')
+    kind = models.CharField(max_length=5, choices=[(PHONE, 'Phone number'), (EMAIL, 'Email address'),])
+    target = models.CharField(max_length=254)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    objects = PendingVerificationQuerySet.as_manager()
+
+    @staticmethod
+    def new_expiry():
+        return timezone.now() + timedelta(seconds=getattr(settings, 'USER_APP_PENDING_VERIFICATION_TTL', 600))
+
+    def __str__(self):
+        return f'{self.kind} {self.target} ({self.user_id})'
+
+    class Meta:
+        constraints = [
+            # One pending change of each kind per user; a new one replaces the old one
+            models.UniqueConstraint(fields=['user', 'kind'], name='user_app_pendingverification_user_kind'),
+            # A phone number/email address can only be pending for one user at a time
+            models.UniqueConstraint(fields=['kind', 'target'], name='user_app_pendingverification_kind_target'),
+        ]
@@ -0,0 +1,138 @@
+'''
+user_app.outbox
+
+A small database-backed email outbox. When "settings.USER_APP_EMAIL_OUTBOX" is True,
+"CustomizedEmailDevice.generate_challenge()" only writes an "OutboxEmail" row; delivery happens
+out of the request cycle, in the "drain_email_outbox" management command, which sends due emails
+in batches over a single SMTP connection and retries failures with exponential backoff.
+
+Optional settings:
+
+USER_APP_OUTBOX_EMAIL_BACKEND: the email backend used by the worker (defaults to EMAIL_BACKEND;
+    use 'django.core.mail.backends.locmem.EmailBackend' or the file backend in tests).
+USER_APP_OUTBOX_BATCH_SIZE: emails sent per batch (default 100).
+USER_APP_OUTBOX_MAX_ATTEMPTS: attempts before an email is marked as failed (default 5).
+USER_APP_OUTBOX_RETRY_DELAY: base retry delay in seconds, doubled after every failure (default 30).
+USER_APP_OUTBOX_CLAIM_TIMEOUT: seconds a claimed batch is reserved for its worker (default 300).
+USER_APP_OUTBOX_SENT_RETENTION: seconds sent emails are kept before "purge_sent()" deletes them (default 7 days).
+'''
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+
+logger = logging.getLogger(__name__)
+
+
+
+
+def enqueue(subject, message, from_email, recipient_list):
+    '''
+    Same signature as "django.core.mail.send_mail()" (for the arguments we use), but only queues the email.
+    '''
+    return OutboxEmail.objects.create(
+        subject=subject,
+        body=message,
+        from_email=from_email,
+        recipients=','.join(recipient_list),
+    )
+
+
+def _retry_delay(attempts):
+    base = getattr(settings, 'USER_APP_OUTBOX_RETRY_DELAY', 30)
+    return timedelta(seconds=base * 2 ** (attempts - 1))
+
+
+def claim(batch_size=None):
+    '''
+    Claims a batch of due emails: in one short transaction, their "next_attempt_at" is pushed
+    USER_APP_OUTBOX_CLAIM_TIMEOUT seconds ahead, so no other worker picks them up while they're
+    being sent. If the worker dies before recording the outcome, they're due again after that.
+    '''
+    batch_size = batch_size or getattr(settings, 'USER_APP_OUTBOX_BATCH_SIZE', 100)
+    now = timezone.now()
+    with transaction.atomic():
+        due = OutboxEmail.objects.filter(status=OutboxEmail.QUEUED, next_attempt_at__lte=now).order_by('next_attempt_at')
+        if connections[due.db].features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        batch = list(due[:batch_size])
+        if batch:
+            claimed_until = now + timedelta(seconds=getattr(settings, 'USER_APP_OUTBOX_CLAIM_TIMEOUT', 300))
+            OutboxEmail.objects.filter(pk__in=[email.pk for email in batch]).update(next_attempt_at=claimed_until)
+    return batch
+
+
+def _failed(email, error, max_attempts):
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= max_attempts:
+        email.status = OutboxEmail.FAILED
+    else:
+        email.next_attempt_at = timezone.now() + _retry_delay(email.attempts)
+
+
+def drain(batch_size=None, connection=None):
+    '''
+    Sends one batch of due emails over a single connection. Returns a (sent, failed) tuple.
+
+    The batch is claimed first (see "claim()"), then sent outside of any transaction, so no row
+    locks are held during the SMTP round-trips; several workers can drain the same outbox without
+    sending an email twice. If the connection can't be opened (e.g. the SMTP server is down),
+    that counts as a failed attempt for every email of the batch.
+    '''
+    max_attempts = getattr(settings, 'USER_APP_OUTBOX_MAX_ATTEMPTS', 5)
+    batch = claim(batch_size)
+    if not batch:
+        return 0, 0
+
+    connection = connection or get_connection(getattr(settings, 'USER_APP_OUTBOX_EMAIL_BACKEND', None))
+    sent = failed = 0
+    try:
+        connection.open()
+    except Exception as e:
+        logger.warning('Opening the outbox email connection failed: %s', e)
+        for email in batch:
+            _failed(email, e, max_attempts)
+        failed = len(batch)
+    else:
+        try:
+            for email in batch:
+                message = EmailMessage(email.subject, email.body, email.from_email, email.recipients.split(','), connection=connection)
+                try:
+                    connection.send_messages([message])
+                except Exception as e:
+                    logger.warning('Sending outbox email %s failed (attempt %s): %s', email.pk, email.attempts + 1, e)
+                    _failed(email, e, max_attempts)
+                    failed += 1
+                else:
+                    email.attempts += 1
+                    email.status = OutboxEmail.SENT
+                    email.sent_at = timezone.now()
+                    sent += 1
+        finally:
+            connection.close()
+
+    OutboxEmail.objects.bulk_update(batch, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+    return sent, failed
+
+
+def purge_sent(older_than=None, batch_size=1000):
+    '''
+    Deletes sent emails older than "older_than" seconds (default USER_APP_OUTBOX_SENT_RETENTION), in batches; returns how many were deleted.
+    '''
+    if older_than is None:
+        older_than = getattr(settings, 'USER_APP_OUTBOX_SENT_RETENTION', 7 * 24 * 3600)
+    old = OutboxEmail.objects.filter(status=OutboxEmail.SENT, sent_at__lt=timezone.now() - timedelta(seconds=older_than))
+    deleted = 0
+    while True:
+        pks = list(old.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += OutboxEmail.objects.filter(pk__in=pks).delete()[0]
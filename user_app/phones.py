@@ -0,0 +1,154 @@
+'''
+user_app.phones
+
+Parsing ("phonenumbers.parse()") and validating phone numbers is costly, and it happens on every
+login, signup and phone change, and for every phone number loaded from the database. Here, a number
+is parsed and validated once per distinct (raw input, region) pair; the results are kept in a
+bounded LRU cache, and every "PhoneNumber" remembers its validity and formats:
+
+    USER_APP_PHONE_CACHE_SIZE = 4096  # distinct inputs kept (default 4096; 0 disables the cache)
+
+This module's "PhoneNumberField" (the user model's "phone") always stores numbers in E.164, whatever
+PHONENUMBER_DB_FORMAT says, so every lookup is an exact match on the (unique) index; saving an
+invalid number raises ValueError instead of storing it as typed.
+'''
+
+from functools import lru_cache
+
+import phonenumbers
+
+from django import forms
+from django.conf import settings
+from django.core import validators
+from django.core.signals import setting_changed
+from django.db import models
+from django.dispatch import receiver
+
+from phonenumber_field import formfields, modelfields, phonenumber
+
+
+E164 = phonenumbers.PhoneNumberFormat.E164
+
+
+
+
+class PhoneNumber(phonenumber.PhoneNumber):
+    '''
+    A "phonenumber_field" PhoneNumber that remembers its validity and formats (asked for on every str(), ==, hash() and save).
+    Treat instances as immutable.
+    '''
+
+    def is_valid(self):
+        if '_valid' not in self.__dict__:
+            self._valid = super().is_valid()
+        return self._valid
+
+    def format_as(self, format):
+        formats = self.__dict__.setdefault('_formats', {})
+        if format not in formats:
+            formats[format] = super().format_as(format)
+        return formats[format]
+
+    def merge_from(self, other):
+        self.__dict__.pop('_valid', None)
+        self.__dict__.pop('_formats', None)
+        return super().merge_from(other)
+
+
+def _parse(raw, region):
+    try:
+        number = PhoneNumber.from_string(raw, region=region)
+    except phonenumbers.NumberParseException:
+        return None
+    return number, number.is_valid(), number.as_e164 if number.is_valid() else None
+
+
+_cached_parse = None
+
+
+def _build_cache():
+    global _cached_parse
+    _cached_parse = lru_cache(maxsize=getattr(settings, 'USER_APP_PHONE_CACHE_SIZE', 4096))(_parse)
+
+
+_build_cache()
+
+
+@receiver(setting_changed)
+def _rebuild_cache(setting, **kwargs):
+    if setting == 'USER_APP_PHONE_CACHE_SIZE':
+        _build_cache()
+
+
+def to_python(value, region=None):
+    '''
+    Same as "phonenumber_field.phonenumber.to_python()", with strings parsed through the cache.
+    '''
+    if isinstance(value, str) and value not in validators.EMPTY_VALUES:
+        if region is None:
+            region = getattr(settings, 'PHONENUMBER_DEFAULT_REGION', None)
+        parsed = _cached_parse(value, region)
+        if parsed is None:
+            return PhoneNumber(raw_input=value)
+        # A copy, so callers can't change the cached number
+        cached, valid, e164 = parsed
+        number = PhoneNumber()
+        number.merge_from(cached)
+        number._valid = valid
+        if e164 is not None:
+            number._formats = {E164: e164}
+        return number
+    if isinstance(value, phonenumbers.PhoneNumber) and not isinstance(value, PhoneNumber):
+        number = PhoneNumber()
+        number.merge_from(value)
+        return number
+    return phonenumber.to_python(value, region=region)
+
+
+
+class PhoneNumberFormField(formfields.PhoneNumberField):
+
+    def to_python(self, value):
+        if value in validators.EMPTY_VALUES:
+            return self.empty_value
+        return to_python(forms.CharField.to_python(self, value), region=self.region)
+
+
+
+class PhoneNumberDescriptor(modelfields.PhoneNumberDescriptor):
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.name] = to_python(value, region=self.field.region)
+
+
+
+class PhoneNumberField(modelfields.PhoneNumberField):
+    '''
+    "phonenumber_field"'s model field, parsing through the cache and always storing E.164; see the module docstring.
+    '''
+
+    attr_class = PhoneNumber
+    descriptor_class = PhoneNumberDescriptor
+
+    def to_python(self, value):
+        return to_python(value, region=self.region)
+
+    def get_prep_value(self, value):
+        number = models.CharField.get_prep_value(self, value) # "to_python()"'d, skipping the parent's PHONENUMBER_DB_FORMAT formatting
+        if not number:
+            return number
+        # Invalid numbers can still be looked up (they match nothing), just not saved; see "pre_save()"
+        return number.as_e164 if number.is_valid() else number.raw_input
+
+    def pre_save(self, model_instance, add):
+        number = super().pre_save(model_instance, add)
+        if number and not self.to_python(number).is_valid():
+            raise ValueError(f'"{number}" is not a valid phone number; only valid numbers are stored (in E.164).')
+        return number
+
+    def from_db_value(self, value, expression, connection):
+        return to_python(value)
+
+    def formfield(self, **kwargs):
+        kwargs.setdefault('form_class', PhoneNumberFormField)
+        return super().formfield(**kwargs)
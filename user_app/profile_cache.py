@@ -0,0 +1,122 @@
+'''
+user_app.profile_cache
+
+Profiles are read far more often than they change, so "UserProfile" renders them from a per-user
+cache entry instead of the user row. The entry holds the (denormalized) profile data, a version and
+the time it was built; the latter two are used for the profile page's ETag/Last-Modified headers,
+so conditional GETs get a 304 without the profile being looked up at all.
+
+Entries are deleted whenever the user (or one of their email devices) is saved or deleted; see
+"user_app.signals". Code that changes users with "QuerySet.update()" has to call
+"invalidate_on_commit()" itself.
+
+The cache has to be shared by every process serving requests (e.g. Redis or Memcached): an entry
+is only deleted from the cache of the process that saved the user, so with a per-process cache such
+as locmem, the other processes keep serving the outdated profile (and its ETag) until the entry
+times out. "manage.py check --deploy" warns about a locmem profile cache. Optional settings:
+
+USER_APP_PROFILE_CACHE: an alias from settings.CACHES (default 'default').
+USER_APP_PROFILE_CACHE_TIMEOUT: seconds an entry lives (default 300).
+'''
+
+import hashlib
+import uuid
+from functools import partial
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.db import transaction
+from django.http import Http404
+from django.utils import timezone
+
+from .models import user as customized_user_model
+
+
+PROFILE_FIELDS = ('uuid_value', 'first_name', 'last_name', 'phone', 'email', 'email_verified', 'gender')
+
+
+
+
+def _cache():
+    return caches[getattr(settings, 'USER_APP_PROFILE_CACHE', 'default')]
+
+
+@checks.register(checks.Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    alias = getattr(settings, 'USER_APP_PROFILE_CACHE', 'default')
+    if settings.CACHES.get(alias, {}).get('BACKEND') != 'django.core.cache.backends.locmem.LocMemCache':
+        return []
+    return [checks.Warning(
+        f'The profile cache ("{alias}") is a per-process locmem cache; profile changes won\'t invalidate '
+        'the entries of other processes, which keep serving outdated profiles until they time out.',
+        hint='Use a cache shared by all processes, such as Redis or Memcached, for USER_APP_PROFILE_CACHE.',
+        id='user_app.W001',
+    )]
+
+
+def _key(uuid_value):
+    return f'user_app:profile:{uuid_value}'
+
+
+def _build(uuid_value):
+    row = customized_user_model.objects.filter(uuid_value=uuid_value).values(*PROFILE_FIELDS).first()
+    if row is None:
+        return None
+    return {
+        'data': {name: value if isinstance(value, (bool, type(None))) else str(value) for name, value in row.items()},
+        'version': uuid.uuid4().hex,
+        'last_modified': timezone.now().replace(microsecond=0), # HTTP dates have a 1 second resolution
+    }
+
+
+def get_entry(request, uuid_value):
+    '''
+    Returns the profile's cache entry ({'data': {...}, 'version': str, 'last_modified': datetime}), or raises Http404.
+    The entry is also memoized on the request, since the ETag/Last-Modified functions and the view all need it.
+    '''
+    memo = request.__dict__.setdefault('_user_app_profiles', {})
+    key = _key(uuid_value)
+    if key not in memo:
+        entry = _cache().get(key)
+        if entry is None:
+            entry = _build(uuid_value)
+            if entry is None:
+                raise Http404('No user found matching the query')
+            _cache().set(key, entry, getattr(settings, 'USER_APP_PROFILE_CACHE_TIMEOUT', 300))
+        memo[key] = entry
+    return memo[key]
+
+
+def invalidate(*uuid_values):
+    _cache().delete_many([_key(uuid_value) for uuid_value in uuid_values])
+
+
+def invalidate_on_commit(*uuid_values, using=None):
+    '''
+    Invalidates the entries now, and again once the current transaction (if any) commits: until then, a concurrent
+    request still reads the old rows, and may cache them again.
+    '''
+    invalidate(*uuid_values)
+    if transaction.get_connection(using).in_atomic_block:
+        transaction.on_commit(partial(invalidate, *uuid_values), using=using)
+
+
+def _renders_from_cache(request):
+    # The page also shows the viewer's OTP status and any pending messages; those responses can't be 304s
+    from django.contrib.messages import get_messages
+    return not len(get_messages(request))
+
+
+def etag(request, uuid_value):
+    if not _renders_from_cache(request):
+        return None
+    entry = get_entry(request, uuid_value)
+    viewer = f'{request.user.pk}:{request.user.is_verified()}' if hasattr(request.user, 'is_verified') else str(request.user.pk)
+    return hashlib.md5(f'{uuid_value}:{entry["version"]}:{viewer}'.encode(), usedforsecurity=False).hexdigest()
+
+
+def last_modified(request, uuid_value):
+    if not _renders_from_cache(request):
+        return None
+    return get_entry(request, uuid_value)['last_modified']
@@ -0,0 +1,90 @@
+'''
+user_app.query_budget
+
+Every view declares how many database queries a request to it may take ("query_budget", an int
+or a {'GET': int, 'POST': int, ...} dict), so an N+1 or a duplicate lookup doesn't slip in
+unnoticed. Queries are counted on the default database for the whole request to the view,
+including its decorators, the lazily loaded session/user and the rendering of its template
+(savepoints aren't counted). To count the template's queries, a TemplateResponse is rendered
+inside the view while budgets are checked, so "process_template_response()" middleware can't
+change its context anymore.
+Checking is controlled by:
+
+    USER_APP_QUERY_BUDGET_MODE = 'off'  # default; budgets aren't checked at all
+    USER_APP_QUERY_BUDGET_MODE = 'log'  # requests over budget are logged (WARNING, "user_app.query_budget")
+    USER_APP_QUERY_BUDGET_MODE = 'raise'  # ... and raise QueryBudgetExceeded; used by the tests
+'''
+
+import functools
+import logging
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+logger = logging.getLogger(__name__)
+
+# Savepoints (from "transaction.atomic()" blocks) aren't counted
+TRANSACTION_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+
+def get_budget(budget, method):
+    if isinstance(budget, dict):
+        return budget.get(method)
+    return budget
+
+
+def check_query_budget(view_func, budget, name):
+    '''
+    Wraps "view_func" so it counts (and checks) the queries of every request against "budget".
+    '''
+
+    @functools.wraps(view_func)
+    def view(request, *args, **kwargs):
+        mode = getattr(settings, 'USER_APP_QUERY_BUDGET_MODE', 'off')
+        limit = get_budget(budget, request.method)
+        if mode == 'off' or limit is None:
+            return view_func(request, *args, **kwargs)
+
+        count = 0
+
+        def counter(execute, sql, params, many, context):
+            nonlocal count
+            if not sql.startswith(TRANSACTION_STATEMENTS):
+                count += 1
+            return execute(sql, params, many, context)
+
+        with connections[DEFAULT_DB_ALIAS].execute_wrapper(counter):
+            response = view_func(request, *args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render() # templates query too (e.g. "request.user.email_temp")
+
+        if count > limit:
+            message = f'{name} {request.method} took {count} queries; its budget is {limit}'
+            if mode == 'raise':
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+    return view
+
+
+
+class QueryBudgetMixin:
+    '''
+    Class-based views with this mixin have their "query_budget" checked; see the module docstring.
+    '''
+
+    query_budget = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        return check_query_budget(view, initkwargs.get('query_budget', cls.query_budget), cls.__name__)
@@ -0,0 +1,24 @@
+'''
+user_app.resolvers
+'''
+
+from django.shortcuts import get_object_or_404
+
+from .models import user as customized_user_model
+
+
+
+
+def get_user_by_uuid(request, uuid_value):
+    '''
+    Returns the user identified by "uuid_value" (or raises Http404).
+
+    Several views (and their "get_object()"/"test_func()" pairs) need the same user within a single
+    request. The resolved user is memoized on the request object, so the lookup hits the
+    database only once per request, no matter how many times it's asked for.
+    '''
+    cache = request.__dict__.setdefault('_user_app_uuid_users', {})
+    key = str(uuid_value)
+    if key not in cache:
+        cache[key] = get_object_or_404(customized_user_model, uuid_value=uuid_value)
+    return cache[key]
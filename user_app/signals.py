@@ -0,0 +1,48 @@
+'''
+user_app.signals
+'''
+
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import profile_cache, verification_state
+from .models import user as customized_user_model, CustomizedEmailDevice
+
+
+
+
+@receiver(post_save, sender=customized_user_model)
+@receiver(post_delete, sender=customized_user_model)
+def invalidate_user_profile(sender, instance, using, **kwargs):
+    profile_cache.invalidate_on_commit(instance.uuid_value, using=using)
+
+
+@receiver(post_save, sender=CustomizedEmailDevice)
+@receiver(post_delete, sender=CustomizedEmailDevice)
+def invalidate_device_owner_profile(sender, instance, using, **kwargs):
+    # Fetch only the uuid if the user isn't loaded already
+    if CustomizedEmailDevice.user.is_cached(instance):
+        uuid_values = [instance.user.uuid_value]
+    else:
+        uuid_values = customized_user_model.objects.using(using).filter(pk=instance.user_id).values_list('uuid_value', flat=True)
+    profile_cache.invalidate_on_commit(*uuid_values, using=using)
+
+
+@receiver(post_save, sender=customized_user_model)
+@receiver(post_delete, sender=customized_user_model)
+def invalidate_verification_state(sender, instance, using, update_fields=None, **kwargs):
+    if update_fields is None or {'is_active', 'email_verified', 'password'} & set(update_fields):
+        verification_state.bump_version_on_commit(instance.pk, using=using)
+
+
+@receiver(post_delete, sender=CustomizedEmailDevice)
+def invalidate_device_owner_verification_state(sender, instance, using, **kwargs):
+    # A session verified with this device mustn't pass "otp_required" anymore
+    verification_state.bump_version_on_commit(instance.user_id, using=using)
+
+
+@receiver(user_logged_in)
+def clear_verification_state(sender, request, user, **kwargs):
+    if request is not None and hasattr(request, 'session'):
+        verification_state.clear(request)
@@ -0,0 +1,250 @@
+'''
+user_app.sms_backends
+
+Pluggable backends for phone-number verification. "twilio_verify.token_send()" and
+"twilio_verify.token_verify()" delegate to the backend named by the "USER_APP_SMS_BACKEND"
+setting (a dotted path), which defaults to "user_app.twilio_verify.TwilioBackend".
+
+Every backend returns Twilio-style statuses: 'pending' once a code has been sent, 'approved'
+once a code has been verified, and 'got error' if anything went wrong.
+'''
+
+import asyncio
+import logging
+import secrets
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from asgiref.sync import async_to_sync, sync_to_async
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .throttling import release_send
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+APPROVED = 'approved'
+ERROR = 'got error'
+COOLDOWN = 'cooldown' # from "twilio_verify.token_send()": a code was sent to the number moments ago, so none was sent now
+
+
+
+
+class BaseVerificationBackend:
+    '''
+    Subclasses implement either the sync pair ("send()"/"check()") or the async pair
+    ("asend()"/"acheck()"); the other pair is derived automatically. "close()" is called when the
+    backend is replaced (e.g. after a settings change).
+    '''
+
+    def _overrides(self, name):
+        if getattr(type(self), name) is getattr(BaseVerificationBackend, name):
+            raise NotImplementedError(f'{type(self).__name__} must implement send()/check() or asend()/acheck().')
+
+    def send(self, phone):
+        self._overrides('asend') # otherwise "send()" and "asend()" would call each other forever
+        return async_to_sync(self.asend)(phone)
+
+    def check(self, phone, code):
+        self._overrides('acheck')
+        return async_to_sync(self.acheck)(phone, code)
+
+    async def asend(self, phone):
+        self._overrides('send')
+        return await sync_to_async(self.send, thread_sensitive=False)(phone)
+
+    async def acheck(self, phone, code):
+        self._overrides('check')
+        return await sync_to_async(self.check, thread_sensitive=False)(phone, code)
+
+    def close(self):
+        pass
+
+
+
+class AsyncTwilioBackend(BaseVerificationBackend):
+    '''
+    Talks to the Twilio Verify REST API with "httpx" instead of the blocking "twilio" client, and
+    always with a timeout ("USER_APP_SMS_TIMEOUT", in seconds). Requires "pip install httpx".
+    Used from sync code (e.g. "QueuedBackend"'s workers), it sends with a sync "httpx.Client".
+    '''
+
+    api_url = 'https://verify.twilio.com/v2/Services/{service_sid}/{resource}'
+
+    def __init__(self):
+        try:
+            import httpx
+        except ImportError as e:
+            raise ImproperlyConfigured('AsyncTwilioBackend requires the "httpx" package.') from e
+
+        self.httpx = httpx
+        self.timeout = getattr(settings, 'USER_APP_SMS_TIMEOUT', 5)
+        # The sync "send()"/"check()" share one "httpx.Client" (it's thread-safe). An "httpx.AsyncClient"
+        # can't be shared between event loops, so there's one (and one connection pool) per loop
+        self.sync_client = None
+        self.clients = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def _auth(self):
+        # Like "TwilioBackend", the credentials are only read when they're needed; missing ones end up as an ERROR status
+        from .twilio_verify import get_credentials
+
+        account_sid, auth_token, _ = get_credentials()
+        return account_sid, auth_token
+
+    def _url(self, resource):
+        from .twilio_verify import get_credentials
+
+        return self.api_url.format(service_sid=get_credentials()[2], resource=resource)
+
+    def get_sync_client(self):
+        with self.lock:
+            if self.sync_client is None:
+                self.sync_client = self.httpx.Client(auth=self._auth(), timeout=self.timeout)
+            return self.sync_client
+
+    def get_client(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.clients:
+            self.clients[loop] = self.httpx.AsyncClient(auth=self._auth(), timeout=self.timeout)
+        return self.clients[loop]
+
+    @staticmethod
+    def _status(response):
+        response.raise_for_status()
+        return response.json()['status']
+
+    def _post(self, resource, data):
+        try:
+            return self._status(self.get_sync_client().post(self._url(resource), data=data))
+        except Exception:
+            logger.exception('Twilio Verify request to %s failed', resource)
+            return ERROR
+
+    async def _apost(self, resource, data):
+        try:
+            return self._status(await self.get_client().post(self._url(resource), data=data))
+        except Exception:
+            logger.exception('Twilio Verify request to %s failed', resource)
+            return ERROR
+
+    def close(self):
+        with self.lock:
+            if self.sync_client is not None:
+                self.sync_client.close()
+                self.sync_client = None
+        clients, self.clients = list(self.clients.items()), weakref.WeakKeyDictionary()
+        for loop, client in clients:
+            # An async client has to be closed in its own loop; the connections of a closed loop are gone already
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+            elif not loop.is_closed():
+                loop.run_until_complete(client.aclose())
+
+    def send(self, phone):
+        return self._post('Verifications', {'To': str(phone), 'Channel': 'sms'})
+
+    def check(self, phone, code):
+        return self._post('VerificationCheck', {'To': str(phone), 'Code': str(code)})
+
+    async def asend(self, phone):
+        return await self._apost('Verifications', {'To': str(phone), 'Channel': 'sms'})
+
+    async def acheck(self, phone, code):
+        return await self._apost('VerificationCheck', {'To': str(phone), 'Code': str(code)})
+
+
+
+class QueuedBackend(BaseVerificationBackend):
+    '''
+    Hands outgoing SMS over to a pool of background worker threads and reports 'pending' right
+    away, so the provider's latency never shows up in the request. Checking a code is still done
+    inline (the view needs the answer).
+
+    The real work is done by the backend named in "USER_APP_SMS_QUEUE_BACKEND"; the pool size is
+    set by "USER_APP_SMS_QUEUE_WORKERS".
+    '''
+
+    def __init__(self):
+        self.backend = import_string(
+            getattr(settings, 'USER_APP_SMS_QUEUE_BACKEND', 'user_app.twilio_verify.TwilioBackend')
+        )()
+        self.executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'USER_APP_SMS_QUEUE_WORKERS', 4),
+            thread_name_prefix='user_app_sms',
+        )
+
+    def _deliver(self, phone):
+        status = ERROR
+        try:
+            status = self.backend.send(phone)
+        except Exception:
+            logger.exception('Queued SMS verification to %s failed', phone)
+        else:
+            if status != PENDING:
+                logger.error('Queued SMS verification to %s failed with status %r', phone, status)
+        finally:
+            if status != PENDING:
+                # "send()" already reported 'pending'; drop the cooldown claim, so the next attempt isn't coalesced with this failure
+                release_send(phone)
+        return status
+
+    def send(self, phone):
+        self.executor.submit(self._deliver, phone)
+        return PENDING
+
+    def check(self, phone, code):
+        return self.backend.check(phone, code)
+
+    def close(self):
+        # Queued sends still go out; the threads exit once the queue is empty
+        self.executor.shutdown(wait=False)
+        self.backend.close()
+
+
+
+class FakeBackend(BaseVerificationBackend):
+    '''
+    An in-process stand-in for Twilio, meant for local development, tests and load tests. Nothing
+    leaves the process: the last code "sent" to every number is kept in "FakeBackend.outbox".
+
+    If "USER_APP_FAKE_SMS_CODE" is set, every number gets that code; otherwise a random 6-digit
+    code is generated.
+    '''
+
+    outbox = {}
+    lock = threading.Lock()
+
+    def send(self, phone):
+        code = getattr(settings, 'USER_APP_FAKE_SMS_CODE', None) or f'{secrets.randbelow(10**6):06d}'
+        with self.lock:
+            self.outbox[str(phone)] = code
+        return PENDING
+
+    def check(self, phone, code):
+        with self.lock:
+            if self.outbox.get(str(phone)) == str(code):
+                del self.outbox[str(phone)]
+                return APPROVED
+        return PENDING # Twilio also answers 'pending' to a wrong code
+
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    return import_string(getattr(settings, 'USER_APP_SMS_BACKEND', 'user_app.twilio_verify.TwilioBackend'))()
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    if setting.startswith('USER_APP_SMS_') or setting == 'USER_APP_FAKE_SMS_CODE':
+        if get_backend.cache_info().currsize:
+            get_backend().close()
+        get_backend.cache_clear()
@@ -1,3 +1,1514 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import io
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.apps import apps
+from django.contrib import admin
+from django.contrib.auth import hashers as django_hashers
+from django.contrib.auth.tokens import default_token_generator
+from django.core import mail
+from django.core import checks
+from django.core.management import call_command
+from django.core.cache import cache
+from django import forms
+from django.template import Template, engines
+from django.template.response import TemplateResponse
+from django.db import IntegrityError, connection
+from django.db.models import QuerySet
+from django.http import Http404, HttpResponse
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import include, path, reverse
+from django.utils.encoding import force_bytes
+from django.utils import timezone
+from django.utils.http import urlsafe_base64_encode
+
+import httpx
+import phonenumbers
+from django_otp import DEVICE_ID_SESSION_KEY
+
+from . import cleanup, deletion, hashers, profile_cache, verification_state
+from .admin import EstimatedCountPaginator, UserAdmin, exact_user_search
+from .forms import CustomizededAuthenticationForm, CustomizedUserCreationForm, EmailChangeForm, EmailVerificationForm
+from .models import compile_email_body_template, user as customized_user_model, AccountDeletion, CustomizedEmailDevice, OutboxEmail, PendingVerification
+from .phones import to_python
+from .query_budget import QueryBudgetExceeded, check_query_budget
+from .resolvers import get_user_by_uuid
+from . import idempotency, instrumentation, outbox, sms_backends, throttling, twilio_verify
+
+
+urlpatterns = [
+    path('user/', include('user_app.urls')),
+]
+
+
+class AsyncURLConf:
+    # For ROOT_URLCONF: the same URLs, with the async views (see "user_app.async_urls")
+    urlpatterns = [
+        path('user/', include('user_app.async_urls')),
+    ]
+
+
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', OTP_EMAIL_BODY_TEMPLATE='{{ token }}')
+class OTPFormQueryCountTests(TestCase):
+    '''
+    Pins the number of queries the OTP forms run per request, so N+1s and repeated lookups don't creep back in.
+    (Transaction statements such as SAVEPOINT/RELEASE aren't counted.)
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = customized_user_model.objects.create(phone='+12025550100', email='user@example.com')
+        cls.device = cls.user.customizedemaildevice_set.create(name=cls.user.email)
+        customized_user_model.objects.create(phone='+12025550101', email='taken@example.com')
+
+    def submit(self, form_class, data=None):
+        request = RequestFactory().post('/')
+        request.user = customized_user_model.objects.get(pk=self.user.pk)
+        with CaptureQueriesContext(connection) as context:
+            form = form_class(request, data=data)
+            if data is not None:
+                form.is_valid()
+        queries = [q['sql'] for q in context.captured_queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE', 'BEGIN', 'COMMIT'))]
+        return form, queries
+
+    def test_get(self):
+        for form_class in (EmailVerificationForm, EmailChangeForm):
+            form, queries = self.submit(form_class)
+            self.assertEqual(len(queries), 1, queries) # the device choices
+            self.assertEqual(form.fields['otp_device'].choices, [(self.device.persistent_id, self.device.name)])
+
+    def test_email_verification_challenge(self):
+        form, queries = self.submit(EmailVerificationForm, {'otp_device': self.device.persistent_id, 'otp_challenge': '1'})
+        self.assertEqual(form.errors['__all__'][0], f'OTP Token: sent to {self.user.email}')
+        self.assertEqual(len(queries), 3, queries) # choices, device, token UPDATE
+
+    def test_email_verification_token(self):
+        self.device.generate_token()
+        form, queries = self.submit(EmailVerificationForm, {'otp_device': self.device.persistent_id, 'otp_token': self.device.token})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(len(queries), 4, queries) # choices, device, token UPDATE, user UPDATE
+        self.assertTrue(customized_user_model.objects.get(pk=self.user.pk).email_verified)
+
+    def test_email_change_challenge_with_taken_email(self):
+        form, queries = self.submit(EmailChangeForm, {'otp_device': self.device.persistent_id, 'otp_challenge': '1', 'new_email': 'taken@example.com'})
+        self.assertEqual(form.errors['__all__'][0], 'Error generating OTP Token: This email address already exists to an account')
+        self.assertEqual(len(queries), 2, queries) # choices, device (with the email check)
+
+    def test_email_change(self):
+        form, queries = self.submit(EmailChangeForm, {'otp_device': self.device.persistent_id, 'otp_challenge': '1', 'new_email': 'new@example.com'})
+        self.assertEqual(form.errors['__all__'][0], 'OTP Token: sent to new@example.com')
+        self.assertEqual(len(queries), 6, queries) # choices, device, pending DELETE + INSERT, token UPDATE, device UPDATE
+
+        self.device.refresh_from_db()
+        form, queries = self.submit(EmailChangeForm, {'otp_device': self.device.persistent_id, 'otp_token': self.device.token, 'new_email': 'new@example.com'})
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(len(queries), 8, queries) # choices, device, pending SELECT, token UPDATE, 2 user UPDATEs, pending DELETE, device UPDATE
+        self.assertEqual(customized_user_model.objects.get(pk=self.user.pk).email, 'new@example.com')
+
+    def test_email_body_template_is_compiled_once_per_value(self):
+        compile_email_body_template.cache_clear()
+        with mock.patch('user_app.models.Template', side_effect=Template) as template_class:
+            with override_settings(OTP_EMAIL_BODY_TEMPLATE='Code: {{ token }}'):
+                for _ in range(2):
+                    self.device.generate_challenge()
+                self.assertEqual(template_class.call_count, 1)
+                self.assertEqual(mail.outbox[-1].body, f'Code: {self.device.token}')
+
+                with override_settings(OTP_EMAIL_BODY_TEMPLATE='Your code: {{ token }}'):
+                    self.assertEqual(compile_email_body_template.cache_info().currsize, 0) # cleared by "setting_changed"
+                    self.device.generate_challenge()
+                    self.assertEqual(mail.outbox[-1].body, f'Your code: {self.device.token}')
+                self.assertEqual(template_class.call_count, 2)
+
+                self.device.generate_challenge() # the cache was cleared again when the override ended
+            self.assertEqual(template_class.call_count, 3)
+
+    def test_other_users_device_is_rejected(self):
+        other_device = customized_user_model.objects.get(email='taken@example.com').customizedemaildevice_set.create(name='taken@example.com')
+        form, _ = self.submit(EmailVerificationForm, {'otp_device': other_device.persistent_id, 'otp_challenge': '1'})
+        self.assertEqual(form.errors['__all__'][0], 'The selected OTP device is not interactive')
+
+
+
+class UserCreationFormTests(TestCase):
+    '''
+    The signup form checks its unique fields with one query, with the same errors as "ModelForm.validate_unique()".
+    '''
+
+    class PerFieldUniqueForm(CustomizedUserCreationForm):
+        validate_unique = forms.ModelForm.validate_unique
+
+    @classmethod
+    def setUpTestData(cls):
+        customized_user_model.objects.create(phone='+12025550100', email='taken@example.com')
+
+    def data(self, phone, email):
+        return {
+            'first_name': 'Form', 'last_name': 'Test', 'phone': phone, 'email': email,
+            'gender': 'None', 'password1': 'Unique-Pa55word!', 'password2': 'Unique-Pa55word!',
+        }
+
+    def test_unique_errors(self):
+        for phone, email in [('+12025550100', 'taken@example.com'), ('+12025550100', 'new@example.com'), ('+12025550101', 'taken@example.com')]:
+            form = CustomizedUserCreationForm(self.data(phone, email))
+            with self.assertNumQueries(1):
+                self.assertFalse(form.is_valid())
+            per_field = self.PerFieldUniqueForm(self.data(phone, email))
+            self.assertFalse(per_field.is_valid())
+            self.assertEqual(form.errors, per_field.errors)
+
+        form = CustomizedUserCreationForm(self.data('+12025550101', 'new@example.com'))
+        with self.assertNumQueries(1):
+            self.assertTrue(form.is_valid())
+
+    def test_save_user_race(self):
+        form = CustomizedUserCreationForm(self.data('+12025550101', 'new@example.com'))
+        self.assertTrue(form.is_valid())
+        customized_user_model.objects.create(phone='+12025550101', email='other@example.com') # signed up in the meantime
+        self.assertFalse(form.save_user(form.save(commit=False)))
+        self.assertEqual(form.errors['phone'], self.PerFieldUniqueForm(self.data('+12025550101', 'new@example.com')).errors['phone'])
+
+
+
+class PhoneNumberTests(TestCase):
+
+    @override_settings(USER_APP_PHONE_CACHE_SIZE=16)
+    def test_parse_cache(self):
+        with mock.patch('phonenumbers.parse', wraps=phonenumbers.parse) as parse:
+            first, second = to_python('+1 (202) 555-0142'), to_python('+1 (202) 555-0142')
+            self.assertEqual(parse.call_count, 1)
+            self.assertEqual(to_python('202 555 0142', region='US'), first)
+            self.assertEqual(parse.call_count, 2)
+        self.assertIsNot(first, second) # copies; the cached number itself is never handed out
+        self.assertEqual(second.as_e164, '+12025550142')
+
+    @override_settings(PHONENUMBER_DB_FORMAT='INTERNATIONAL')
+    def test_stored_in_e164(self):
+        user = customized_user_model.objects.create(phone='+1 (202) 555-0142', email='user@example.com')
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT phone FROM user_app_user WHERE id = %s', [user.pk])
+            self.assertEqual(cursor.fetchone()[0], '+12025550142')
+        self.assertEqual(customized_user_model.objects.get(phone='+1 202-555-0142'), user)
+        self.assertFalse(customized_user_model.objects.filter(phone='not a number').exists())
+
+        with self.assertRaises(ValueError):
+            customized_user_model.objects.create(phone='+1 555', email='invalid@example.com')
+
+
+
+@override_settings(USER_APP_UNVERIFIED_ACCOUNT_TTL=3600)
+class CleanupTests(TestCase):
+
+    def create(self, phone, age, **fields):
+        user = customized_user_model.objects.create(phone=phone, email=f'{phone}@example.com', **fields)
+        customized_user_model.objects.filter(pk=user.pk).update(date_joined=timezone.now() - age)
+        return user
+
+    def test_delete_stale_accounts(self):
+        old = timedelta(hours=2)
+        for i in range(5):
+            self.create(f'+1202555010{i}', old, is_active=False)
+        kept = [
+            self.create('+12025550110', timedelta(minutes=5), is_active=False), # still within the TTL
+            self.create('+12025550111', old, is_active=True),
+            self.create('+12025550112', old, is_active=False, last_login=timezone.now() - old), # deactivated, not abandoned
+            self.create('+12025550113', old, is_active=False, is_staff=True),
+            self.create('+12025550114', old, is_active=False, email_verified=True),
+        ]
+        # Deactivated by an admin (or imported inactive): its phone number was verified once, so it has a device
+        deactivated = self.create('+12025550115', old, is_active=False)
+        deactivated.customizedemaildevice_set.create(name=deactivated.email)
+        kept.append(deactivated)
+        progress = []
+        self.assertEqual(cleanup.delete_stale_accounts(2, progress=progress.append), 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertQuerysetEqual(customized_user_model.objects.order_by('pk'), kept)
+
+    def test_clear_expired_tokens(self):
+        user = self.create('+12025550100', timedelta(0))
+        expired = CustomizedEmailDevice.objects.create(user=user, name='expired', token='123456', valid_until=timezone.now() - timedelta(minutes=1))
+        valid = CustomizedEmailDevice.objects.create(user=user, name='valid', token='654321', valid_until=timezone.now() + timedelta(minutes=5))
+        self.assertEqual(cleanup.clear_expired_tokens(1), 1)
+        self.assertIsNone(CustomizedEmailDevice.objects.get(pk=expired.pk).token)
+        self.assertEqual(CustomizedEmailDevice.objects.get(pk=valid.pk).token, '654321')
+
+
+
+@override_settings(
+    ROOT_URLCONF='user_app.tests',
+    USER_APP_QUERY_BUDGET_MODE='raise',
+    USER_APP_SMS_BACKEND='user_app.sms_backends.FakeBackend',
+    USER_APP_FAKE_SMS_CODE='123456',
+    USER_APP_PHONE_RATE_LIMITS={},
+    USER_APP_EMAIL_OUTBOX=False,
+    USER_APP_ACCOUNT_DELETION_QUEUE=False,
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    OTP_EMAIL_BODY_TEMPLATE='{{ token }}',
+)
+class ViewQueryBudgetTests(TestCase):
+    '''
+    Takes users through every view (GET and POST); a request over its view's "query_budget" raises "QueryBudgetExceeded".
+    '''
+
+    password = 'Budget-Pa55word!'
+
+    def setUp(self):
+        # Cached state (profiles, SMS send cooldowns, idempotency keys) mustn't leak between tests
+        cache.clear()
+
+    def signup(self, phone='+12025550100', email='user@example.com'):
+        self.client.get(reverse('user_app:create'))
+        response = self.client.post(reverse('user_app:create'), {
+            'first_name': 'Budget', 'last_name': 'Test', 'phone': phone, 'email': email,
+            'gender': 'None', 'password1': self.password, 'password2': self.password,
+        })
+        user = customized_user_model.objects.get(email=email)
+        self.assertRedirects(response, reverse('user_app:phone_verify', args=[user.uuid_value]), fetch_redirect_response=False)
+        return user
+
+    def verify_phone(self, user):
+        self.client.get(reverse('user_app:phone_verify', args=[user.uuid_value]))
+        self.client.post(reverse('user_app:phone_verify', args=[user.uuid_value]), {'code': '123456'})
+
+    def login(self, user):
+        self.client.get(reverse('user_app:login'))
+        response = self.client.post(reverse('user_app:login'), {'username': str(user.phone), 'password': self.password})
+        self.assertEqual(response.status_code, 302)
+
+    def token(self, user):
+        return user.customizedemaildevice_set.values_list('token', flat=True).get()
+
+    def verified_user(self):
+        user = self.signup()
+        self.verify_phone(user)
+        self.login(user)
+        device = user.customizedemaildevice_set.get()
+        self.client.get(reverse('user_app:email_verify'))
+        self.client.post(reverse('user_app:email_verify'), {'otp_device': device.persistent_id, 'otp_challenge': '1'})
+        self.client.post(reverse('user_app:email_verify'), {'otp_device': device.persistent_id, 'otp_token': self.token(user)})
+        return user, device
+
+    def test_signup_and_phone_views(self):
+        user = self.signup()
+        self.client.get(reverse('user_app:twilio_token_send_again', args=[user.uuid_value]))
+        self.verify_phone(user)
+        self.assertTrue(customized_user_model.objects.get(pk=user.pk).is_active)
+        self.login(user)
+
+        self.client.get(reverse('user_app:profile', args=[user.uuid_value]))
+        self.client.get(reverse('user_app:update', args=[user.uuid_value]))
+        self.client.post(reverse('user_app:update', args=[user.uuid_value]), {'first_name': 'New', 'last_name': 'Name', 'gender': 'None'})
+        self.client.get(reverse('user_app:profile', args=[user.uuid_value]))
+
+        self.client.get(reverse('user_app:phone_change'))
+        self.client.post(reverse('user_app:phone_change'), {'new_phone': '+12025550199'})
+        self.verify_phone(user)
+        self.assertEqual(str(customized_user_model.objects.get(pk=user.pk).phone), '+12025550199')
+
+        self.client.get(reverse('user_app:logout'))
+        self.client.post(reverse('user_app:logout'))
+
+    def test_email_and_account_views(self):
+        user, device = self.verified_user()
+        self.assertTrue(customized_user_model.objects.get(pk=user.pk).email_verified)
+
+        self.client.get(reverse('user_app:email_change'))
+        self.client.post(reverse('user_app:email_change'), {'otp_device': device.persistent_id, 'otp_challenge': '1', 'new_email': 'new@example.com'})
+        self.client.post(reverse('user_app:email_change'), {'otp_device': device.persistent_id, 'otp_token': self.token(user), 'new_email': 'new@example.com'})
+        self.assertEqual(customized_user_model.objects.get(pk=user.pk).email, 'new@example.com')
+
+        self.client.get(reverse('user_app:password_change'))
+        self.password, old_password = 'Budget-Pa55word!2', self.password
+        self.client.post(reverse('user_app:password_change'), {'old_password': old_password, 'new_password1': self.password, 'new_password2': self.password})
+
+        self.client.get(reverse('user_app:delete')) # redirected to the OTP verification
+        self.client.get(reverse('user_app:otp_verify'))
+        self.client.post(reverse('user_app:otp_verify'), {'otp_device': device.persistent_id, 'otp_challenge': '1'})
+        self.client.post(reverse('user_app:otp_verify'), {'otp_device': device.persistent_id, 'otp_token': self.token(user)})
+        self.client.get(reverse('user_app:delete'))
+        self.client.post(reverse('user_app:delete'), {'password': self.password})
+        self.assertFalse(customized_user_model.objects.filter(pk=user.pk).exists())
+
+    def test_password_reset_views(self):
+        user, _ = self.verified_user()
+        self.client.get(reverse('user_app:password_reset'))
+        self.client.post(reverse('user_app:password_reset'), {'email': 'unknown@example.com'})
+        self.client.post(reverse('user_app:password_reset'), {'email': user.email})
+        self.client.get(reverse('user_app:password_reset_done'))
+
+        user = customized_user_model.objects.get(pk=user.pk)
+        url = reverse('user_app:password_reset_confirm', args=[urlsafe_base64_encode(force_bytes(user.pk)), default_token_generator.make_token(user)])
+        response = self.client.get(url, follow=True)
+        self.client.post(response.redirect_chain[-1][0], {'new_password1': 'Budget-Pa55word!3', 'new_password2': 'Budget-Pa55word!3'})
+        self.assertTrue(customized_user_model.objects.get(pk=user.pk).check_password('Budget-Pa55word!3'))
+
+    def test_exceeded_budget(self):
+        def view(request):
+            list(customized_user_model.objects.all())
+            list(customized_user_model.objects.all())
+
+        request = RequestFactory().get('/')
+        with self.assertRaisesMessage(QueryBudgetExceeded, 'view GET took 2 queries; its budget is 1'):
+            check_query_budget(view, 1, 'view')(request)
+        check_query_budget(view, {'POST': 1}, 'view')(request) # no budget for GET
+
+    def test_template_queries_count(self):
+        template = engines['django'].from_string('{{ users|length }}')
+
+        def view(request):
+            return TemplateResponse(request, template, {'users': customized_user_model.objects.all()}) # queried while rendering
+
+        request = RequestFactory().get('/')
+        with self.assertRaisesMessage(QueryBudgetExceeded, 'view GET took 1 queries; its budget is 0'):
+            check_query_budget(view, 0, 'view')(request)
+        response = check_query_budget(view, 1, 'view')(request)
+        self.assertTrue(response.is_rendered)
+        self.assertEqual(response.content, b'0')
+
+
+
+class UUIDResolverTests(TestCase):
+
+    def test_memoized_per_request(self):
+        user = customized_user_model.objects.create(phone='+12025550100', email='user@example.com')
+        request = RequestFactory().get('/')
+        with self.assertNumQueries(1):
+            self.assertEqual(get_user_by_uuid(request, user.uuid_value), user)
+            self.assertIs(get_user_by_uuid(request, str(user.uuid_value)), get_user_by_uuid(request, user.uuid_value))
+        with self.assertNumQueries(1):
+            get_user_by_uuid(RequestFactory().get('/'), user.uuid_value) # a new request looks it up again
+
+    def test_unknown_uuid(self):
+        with self.assertRaises(Http404):
+            get_user_by_uuid(RequestFactory().get('/'), '00000000-0000-0000-0000-000000000000')
+
+    def test_uuid_index_migration(self):
+        migration = importlib.import_module('user_app.migrations.0002_user_uuid_value_unique')
+
+        class SchemaEditor:
+            def __init__(self, vendor):
+                self.connection = mock.Mock(vendor=vendor, ops=connection.ops)
+                self.executed = []
+
+            def execute(self, sql):
+                self.executed.append(sql)
+
+        for vendor, concurrently in (('sqlite', False), ('mysql', False), ('postgresql', True)):
+            editor = SchemaEditor(vendor)
+            migration.create_uuid_value_index(apps, editor)
+            migration.drop_uuid_value_index(apps, editor)
+            self.assertEqual(['CONCURRENTLY' in sql for sql in editor.executed], [concurrently, concurrently])
+
+
+
+class SMSBackendTests(TestCase):
+
+    def test_derived_pairs(self):
+        class SyncBackend(sms_backends.BaseVerificationBackend):
+            def send(self, phone):
+                return sms_backends.PENDING
+
+            def check(self, phone, code):
+                return sms_backends.APPROVED
+
+        class AsyncBackend(sms_backends.BaseVerificationBackend):
+            async def asend(self, phone):
+                return sms_backends.PENDING
+
+            async def acheck(self, phone, code):
+                return sms_backends.APPROVED
+
+        for backend in (SyncBackend(), AsyncBackend()):
+            self.assertEqual(backend.send('+12025550100'), sms_backends.PENDING)
+            self.assertEqual(asyncio.run(backend.acheck('+12025550100', '123456')), sms_backends.APPROVED)
+
+    def test_backend_without_either_pair(self):
+        backend = type('Backend', (sms_backends.BaseVerificationBackend,), {})()
+        with self.assertRaises(NotImplementedError):
+            backend.send('+12025550100')
+        with self.assertRaises(NotImplementedError):
+            asyncio.run(backend.acheck('+12025550100', '123456'))
+
+    @override_settings(USER_APP_FAKE_SMS_CODE='123456')
+    def test_fake_backend(self):
+        backend = sms_backends.FakeBackend()
+        self.assertEqual(backend.send('+12025550100'), sms_backends.PENDING)
+        self.assertEqual(backend.check('+12025550100', '000000'), sms_backends.PENDING)
+        self.assertEqual(backend.check('+12025550100', '123456'), sms_backends.APPROVED)
+        self.assertEqual(backend.check('+12025550100', '123456'), sms_backends.PENDING) # codes are used once
+
+    @override_settings(USER_APP_SMS_QUEUE_BACKEND='user_app.sms_backends.FakeBackend', USER_APP_FAKE_SMS_CODE='123456')
+    def test_queued_backend(self):
+        backend = sms_backends.QueuedBackend()
+        self.assertEqual(backend.send('+12025550100'), sms_backends.PENDING)
+        backend.close()
+        backend.executor.shutdown(wait=True) # the queued send still goes out
+        self.assertEqual(backend.check('+12025550100', '123456'), sms_backends.APPROVED)
+
+    def test_replaced_backend_is_closed(self):
+        with override_settings(USER_APP_SMS_BACKEND='user_app.sms_backends.QueuedBackend', USER_APP_SMS_QUEUE_BACKEND='user_app.sms_backends.FakeBackend'):
+            backend = sms_backends.get_backend()
+        self.assertIsNot(sms_backends.get_backend(), backend)
+        with self.assertRaises(RuntimeError): # shut down; its threads are gone once idle
+            backend.executor.submit(print)
+
+    def test_async_twilio_backend_reuses_its_client(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(201, json={'status': 'pending'})
+
+        real_client = httpx.AsyncClient
+        with mock.patch('httpx.AsyncClient', side_effect=lambda **kwargs: real_client(transport=httpx.MockTransport(handler), **kwargs)) as client_class:
+            backend = sms_backends.AsyncTwilioBackend()
+
+            async def send_twice():
+                return [await backend.asend('+12025550100'), await backend.asend('+12025550101')]
+
+            self.assertEqual(asyncio.run(send_twice()), ['pending', 'pending'])
+        self.assertEqual(client_class.call_count, 1)
+        self.assertEqual(len(requests), 2)
+
+    def test_async_twilio_backend_from_sync_code(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(201, json={'status': 'pending'})
+
+        real_clients = httpx.Client, httpx.AsyncClient
+        with mock.patch('httpx.Client', side_effect=lambda **kwargs: real_clients[0](transport=httpx.MockTransport(handler), **kwargs)) as client_class, \
+             mock.patch('httpx.AsyncClient', side_effect=lambda **kwargs: real_clients[1](transport=httpx.MockTransport(handler), **kwargs)) as async_client_class:
+            backend = sms_backends.AsyncTwilioBackend()
+            self.assertEqual([backend.send('+12025550100'), backend.send('+12025550101')], ['pending', 'pending'])
+            self.assertEqual((client_class.call_count, async_client_class.call_count), (1, 0))
+
+            loop = asyncio.new_event_loop()
+            self.addCleanup(loop.close)
+            self.assertEqual(loop.run_until_complete(backend.asend('+12025550102')), 'pending')
+        sync_client, async_client = backend.sync_client, backend.clients[loop]
+        self.assertEqual(len(requests), 3)
+
+        backend.close()
+        self.assertTrue(sync_client.is_closed)
+        self.assertTrue(async_client.is_closed) # closed in its own loop
+        self.assertEqual(len(backend.clients), 0)
+
+    def test_credentials_are_read_lazily(self):
+        for cached in (twilio_verify.get_credentials, twilio_verify.get_client):
+            cached.cache_clear()
+            self.addCleanup(cached.cache_clear)
+
+        with mock.patch.dict(os.environ, clear=True), mock.patch('dotenv.load_dotenv', create=True):
+            # Building the backends (and importing the views) doesn't need the credentials...
+            backends = [twilio_verify.TwilioBackend(), sms_backends.AsyncTwilioBackend()]
+            # ... and without them, sending reports an error instead of raising
+            with self.assertLogs('user_app', 'ERROR'):
+                self.assertEqual(backends[0].send('+12025550100'), sms_backends.ERROR)
+                self.assertEqual(asyncio.run(backends[1].asend('+12025550100')), sms_backends.ERROR)
+
+
+
+@override_settings(USER_APP_OUTBOX_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', USER_APP_OUTBOX_RETRY_DELAY=30, USER_APP_OUTBOX_MAX_ATTEMPTS=2)
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.emails = [outbox.enqueue(f'Code {i}', f'Your code is {i}', 'from@example.com', [f'user{i}@example.com']) for i in range(3)]
+
+    def test_drain(self):
+        self.assertEqual(outbox.drain(), (3, 0))
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ['user0@example.com', 'user1@example.com', 'user2@example.com'])
+        self.assertEqual(set(OutboxEmail.objects.values_list('status', 'attempts')), {(OutboxEmail.SENT, 1)})
+        self.assertEqual(outbox.drain(), (0, 0))
+
+    def test_file_backend(self):
+        with tempfile.TemporaryDirectory() as path:
+            with override_settings(USER_APP_OUTBOX_EMAIL_BACKEND='django.core.mail.backends.filebased.EmailBackend', EMAIL_FILE_PATH=path):
+                self.assertEqual(outbox.drain(batch_size=2), (2, 0))
+            written = ''.join(open(os.path.join(path, name)).read() for name in os.listdir(path))
+        self.assertIn('Your code is 0', written)
+        self.assertIn('Your code is 1', written)
+        self.assertNotIn('Your code is 2', written)
+
+    def test_claimed_emails_are_not_claimed_again(self):
+        self.assertEqual(len(outbox.claim(batch_size=2)), 2)
+        self.assertEqual([email.pk for email in outbox.claim()], [self.emails[2].pk])
+        self.assertEqual(outbox.claim(), [])
+
+    def test_unreachable_server(self):
+        connection = mail.get_connection('django.core.mail.backends.locmem.EmailBackend')
+        with mock.patch.object(connection, 'open', side_effect=ConnectionRefusedError('SMTP is down')), self.assertLogs('user_app.outbox', 'WARNING'):
+            self.assertEqual(outbox.drain(connection=connection), (0, 3))
+        for email in OutboxEmail.objects.all():
+            self.assertEqual((email.status, email.attempts, email.last_error), (OutboxEmail.QUEUED, 1, 'SMTP is down'))
+            self.assertGreater(email.next_attempt_at, timezone.now() + timedelta(seconds=25))
+
+        # Once due again, a second failure is the last one
+        OutboxEmail.objects.update(next_attempt_at=timezone.now())
+        with mock.patch.object(connection, 'open', side_effect=ConnectionRefusedError('SMTP is down')), self.assertLogs('user_app.outbox', 'WARNING'):
+            self.assertEqual(outbox.drain(connection=connection), (0, 3))
+        self.assertEqual(set(OutboxEmail.objects.values_list('status', 'attempts')), {(OutboxEmail.FAILED, 2)})
+
+    def test_failed_message(self):
+        connection = mail.get_connection('django.core.mail.backends.locmem.EmailBackend')
+        send_messages = connection.send_messages
+
+        def fail_second(messages):
+            if messages[0].to == ['user1@example.com']:
+                raise OSError('Recipient refused')
+            return send_messages(messages)
+
+        with mock.patch.object(connection, 'send_messages', side_effect=fail_second), self.assertLogs('user_app.outbox', 'WARNING'):
+            self.assertEqual(outbox.drain(connection=connection), (2, 1))
+        email = OutboxEmail.objects.get(pk=self.emails[1].pk)
+        self.assertEqual((email.status, email.attempts, email.last_error), (OutboxEmail.QUEUED, 1, 'Recipient refused'))
+
+    def test_purge_sent(self):
+        outbox.drain(batch_size=2)
+        OutboxEmail.objects.filter(pk=self.emails[0].pk).update(sent_at=timezone.now() - timedelta(days=8))
+        self.assertEqual(outbox.purge_sent(), 1)
+        self.assertEqual(OutboxEmail.objects.count(), 2)
+
+
+
+class PendingVerificationPromotionTests(TestCase):
+
+    def test_failed_promotion_leaves_the_user_unchanged(self):
+        taken = customized_user_model.objects.create(phone='+12025550100', email='taken@example.com')
+        user = customized_user_model.objects.create(phone='+12025550101', email='user@example.com')
+        # Written directly: the reservation in "start_pending_verification()" would refuse the taken number/address
+        for kind, target in ((PendingVerification.PHONE, '+12025550100'), (PendingVerification.EMAIL, 'taken@example.com')):
+            PendingVerification.objects.create(user=user, kind=kind, target=target, expires_at=PendingVerification.new_expiry())
+
+        for promote in (user.promote_temp_phone, user.promote_temp_email):
+            with self.assertRaises(IntegrityError):
+                promote()
+        self.assertEqual((str(user.phone), user.email), ('+12025550101', 'user@example.com'))
+        self.assertEqual((str(user.phone_temp), user.email_temp), (str(taken.phone), taken.email)) # still pending
+        user.refresh_from_db()
+        self.assertEqual((str(user.phone), user.email), ('+12025550101', 'user@example.com'))
+
+    @override_settings(USER_APP_SMS_BACKEND='user_app.sms_backends.FakeBackend', USER_APP_FAKE_SMS_CODE='123456', USER_APP_PHONE_RATE_LIMITS={})
+    def test_expired_phone_change_isnt_an_activation(self):
+        user = customized_user_model.objects.create(phone='+12025550101', email='user@example.com', is_active=True)
+        CustomizedEmailDevice.objects.create(user=user, name=user.email)
+        PendingVerification.objects.create(user=user, kind=PendingVerification.PHONE, target='+12025550199', expires_at=timezone.now())
+        self.client.force_login(user)
+        for urlconf in ('user_app.tests', AsyncURLConf):
+            with self.subTest(urlconf=urlconf), override_settings(ROOT_URLCONF=urlconf):
+                cache.clear()
+                with mock.patch.object(sms_backends.FakeBackend, 'send') as send:
+                    response = self.client.get(reverse('user_app:twilio_token_send_again', args=[user.uuid_value]), follow=True)
+                send.assert_not_called()
+                self.assertRedirects(response, reverse('user_app:phone_change'))
+                self.assertContains(response, 'Your phone number change has expired')
+
+                response = self.client.post(reverse('user_app:phone_verify', args=[user.uuid_value]), {'code': '123456'}, follow=True)
+                self.assertRedirects(response, reverse('user_app:phone_change'))
+                self.assertContains(response, 'Your phone number change has expired')
+                self.assertNotContains(response, 'Congratulations')
+                self.assertEqual(user.customizedemaildevice_set.count(), 1)
+                self.assertEqual(str(customized_user_model.objects.get(pk=user.pk).phone), '+12025550101')
+
+
+
+class RateLimitTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().post('/', REMOTE_ADDR='10.0.0.1')
+
+    def test_sliding_window(self):
+        with mock.patch('time.time') as now:
+            now.return_value = 1050 # halfway through the window [1000, 1100)
+            self.assertEqual([throttling._hit(cache, 'key', 2, 100) for _ in range(3)], [True, True, False])
+            now.return_value = 1150 # the previous window still counts half: 3 * 0.5 + 1
+            self.assertFalse(throttling._hit(cache, 'key', 2, 100))
+            now.return_value = 1190 # ... and later only a tenth: 3 * 0.1 + 2
+            self.assertFalse(throttling._hit(cache, 'key', 2, 100))
+            now.return_value = 1290 # the window before is out of reach: 2 * 0.1 + 1
+            self.assertTrue(throttling._hit(cache, 'key', 2, 100))
+
+    @override_settings(USER_APP_PHONE_RATE_LIMITS={'send': {'phone': (2, 600), 'ip': (3, 600)}})
+    def test_scopes(self):
+        limited = lambda phone, ip='10.0.0.1': throttling.is_rate_limited('send', RequestFactory().post('/', REMOTE_ADDR=ip), phone=phone)
+        self.assertEqual([limited('+12025550100') for _ in range(3)], [False, False, True]) # per phone...
+        self.assertTrue(limited('+12025550101')) # ... and per IP: this is its 4th send
+        self.assertFalse(limited('+12025550101', ip='10.0.0.2'))
+        self.assertFalse(throttling.is_rate_limited('verify', self.request, phone='+12025550100')) # actions are limited separately
+
+    @override_settings(
+        ROOT_URLCONF='user_app.tests',
+        USER_APP_SMS_BACKEND='user_app.sms_backends.FakeBackend',
+        USER_APP_PHONE_RATE_LIMITS={'send': {'phone': (1, 600)}},
+        PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    )
+    def test_throttled_signup_hashes_no_password(self):
+        data = {'first_name': 'Rate', 'last_name': 'Limit', 'phone': '+12025550100', 'gender': 'None', 'password1': 'Rate-Pa55word!', 'password2': 'Rate-Pa55word!'}
+        response = self.client.post(reverse('user_app:create'), {**data, 'email': 'first@example.com'})
+        self.assertEqual(response.status_code, 302)
+
+        with mock.patch.object(customized_user_model, 'set_password') as set_password:
+            response = self.client.post(reverse('user_app:create'), {**data, 'phone': '+1 202 555 0100', 'email': 'second@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Too many attempts')
+        set_password.assert_not_called()
+        self.assertFalse(customized_user_model.objects.filter(email='second@example.com').exists())
+
+
+
+class ImportExportUsersTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def import_users(self, path, **options):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('import_users', path, stdout=stdout, stderr=stderr, **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_round_trip(self):
+        for i in range(3):
+            customized_user_model.objects.create(phone=f'+1202555010{i}', email=f'user{i}@example.com', first_name=f'User {i}', email_verified=bool(i))
+        fields = ['uuid_value', 'phone', 'email', 'first_name', 'email_verified', 'is_active']
+        exported = list(customized_user_model.objects.order_by('pk').values_list(*fields))
+
+        for name in ('users.csv', 'users.jsonl'):
+            with self.subTest(name):
+                path = os.path.join(self.directory.name, name)
+                call_command('export_users', path, stdout=io.StringIO())
+                customized_user_model.objects.all().delete()
+                stdout, stderr = self.import_users(path, batch_size=2)
+                self.assertIn('Done: 3 imported, 0 skipped, 0 invalid.', stdout)
+                self.assertEqual(stderr, '')
+                self.assertEqual(list(customized_user_model.objects.order_by('phone').values_list(*fields)), exported)
+                self.assertEqual(CustomizedEmailDevice.objects.count(), 3)
+
+    def test_bad_rows(self):
+        path = self.write('users.jsonl', '\n'.join([
+            json.dumps({'phone': '+12025550100', 'email': 'user0@example.com'}),
+            '{"phone": "+12025550101", "email": ',
+            '',
+            json.dumps({'phone': 'not a number', 'email': 'user2@example.com'}),
+            json.dumps(['+12025550103', 'user3@example.com']),
+            json.dumps({'phone': '+12025550104', 'email': 'user4@example.com'}),
+        ]))
+        stdout, stderr = self.import_users(path)
+        self.assertIn('Done: 2 imported, 0 skipped, 3 invalid.', stdout)
+        self.assertEqual([line.split(':')[0] for line in stderr.splitlines()], ['Line 2', 'Line 4', 'Line 5'])
+        self.assertEqual(sorted(customized_user_model.objects.values_list('email', flat=True)), ['user0@example.com', 'user4@example.com'])
+
+    def test_invalid_field_values(self):
+        path = self.write('users.jsonl', '\n'.join(json.dumps(row) for row in [
+            {'phone': '+12025550100', 'email': 'user0@example.com', 'gender': 'Other'},
+            {'phone': '+12025550101', 'email': 'user1@example.com', 'first_name': 'x' * 200},
+            {'phone': '+12025550102', 'email': 'not an address'},
+            {'phone': '+12025550103', 'email': 'user3@example.com', 'username': 'no spaces allowed'},
+            {'phone': '+12025550104', 'email': 'user4@example.com', 'gender': 'Female', 'date_joined': '2020-01-02T03:04:05'},
+        ]))
+        stdout, stderr = self.import_users(path)
+        self.assertIn('Done: 1 imported, 0 skipped, 4 invalid.', stdout)
+        self.assertEqual(
+            [line.split(' (')[0] for line in stderr.splitlines()],
+            ["Line 1: invalid gender 'Other'", f"Line 2: invalid first_name '{'x' * 200}'", "Line 3: invalid email 'not an address'", "Line 4: invalid username 'no spaces allowed'"],
+        )
+        user = customized_user_model.objects.get()
+        self.assertEqual((user.email, user.gender), ('user4@example.com', 'Female'))
+        self.assertEqual(user.date_joined, timezone.make_aware(datetime(2020, 1, 2, 3, 4, 5))) # naive dates are in the current time zone
+
+    def test_duplicates(self):
+        existing = customized_user_model.objects.create(phone='+12025550100', email='existing@example.com')
+        path = self.write('users.csv', '\n'.join([
+            'uuid_value,phone,email',
+            f'{existing.uuid_value},+12025550101,uuid@example.com', # the uuid is taken
+            ',+12025550100,phone@example.com', # the phone number is taken
+            ',+12025550102,new@example.com',
+            ',+12025550102,again@example.com', # a duplicate within the file
+        ]))
+        stdout, _ = self.import_users(path)
+        self.assertIn('Done: 1 imported, 3 skipped, 0 invalid.', stdout)
+        self.assertEqual(sorted(customized_user_model.objects.values_list('email', flat=True)), ['existing@example.com', 'new@example.com'])
+        self.assertFalse(CustomizedEmailDevice.objects.filter(user=existing).exists())
+
+
+
+class AccountDeletionTests(TestCase):
+
+    def setUp(self):
+        self.user = customized_user_model.objects.create(phone='+12025550100', email='user@example.com')
+        for i in range(3):
+            CustomizedEmailDevice.objects.create(user=self.user, name=f'device {i}')
+        for kind, target in ((PendingVerification.PHONE, '+12025550102'), (PendingVerification.EMAIL, 'new@example.com')):
+            PendingVerification.objects.create(user=self.user, kind=kind, target=target, expires_at=PendingVerification.new_expiry())
+        self.kept = CustomizedEmailDevice.objects.create(user=customized_user_model.objects.create(phone='+12025550101', email='kept@example.com'), name='kept')
+
+    def test_process_next(self):
+        queued = deletion.enqueue(self.user)
+        self.assertFalse(customized_user_model.objects.get(pk=self.user.pk).is_active)
+
+        with mock.patch.object(QuerySet, 'delete', autospec=True, side_effect=QuerySet.delete) as delete:
+            processed = deletion.process_next(batch_size=2)
+        # Devices have delete signal receivers, so they go through the collector; pending verifications don't
+        collected = {call.args[0].model for call in delete.call_args_list}
+        self.assertIn(CustomizedEmailDevice, collected)
+        self.assertNotIn(PendingVerification, collected)
+        self.assertEqual(processed.pk, queued.pk)
+        self.assertEqual((processed.status, processed.deleted_rows), (AccountDeletion.DONE, 6)) # 3 devices, 2 verifications and the user
+        self.assertFalse(PendingVerification.objects.exists())
+        self.assertFalse(customized_user_model.objects.filter(pk=self.user.pk).exists())
+        self.assertEqual(list(CustomizedEmailDevice.objects.all()), [self.kept])
+        self.assertIsNone(deletion.process_next())
+
+    def test_failure_keeps_the_progress(self):
+        deletion.enqueue(self.user)
+        with mock.patch.object(deletion, '_delete_in_batches', side_effect=[5, RuntimeError('boom')]), self.assertLogs('user_app.deletion', 'ERROR'):
+            processed = deletion.process_next()
+        self.assertEqual((processed.status, processed.deleted_rows, processed.last_error), (AccountDeletion.FAILED, 5, 'boom'))
+        processed.refresh_from_db()
+        self.assertEqual((processed.status, processed.deleted_rows), (AccountDeletion.FAILED, 5))
+
+    def test_abandoned_deletion_is_claimed_again(self):
+        queued = deletion.enqueue(self.user)
+        self.assertEqual(deletion.claim_next().pk, queued.pk)
+        self.assertIsNone(deletion.claim_next()) # in progress
+        with self.assertLogs('user_app.deletion', 'WARNING'):
+            claimed = deletion.claim_next(now=timezone.now() + timedelta(hours=2))
+        self.assertEqual((claimed.pk, claimed.status), (queued.pk, AccountDeletion.IN_PROGRESS))
+
+    @override_settings(USER_APP_SMS_BACKEND='user_app.sms_backends.FakeBackend', USER_APP_FAKE_SMS_CODE='123456', USER_APP_PHONE_RATE_LIMITS={})
+    def test_pending_user_cant_be_verified(self):
+        queued = deletion.enqueue(self.user)
+        for status in (AccountDeletion.QUEUED, AccountDeletion.IN_PROGRESS, AccountDeletion.FAILED):
+            AccountDeletion.objects.filter(pk=queued.pk).update(status=status)
+            for urlconf in ('user_app.tests', AsyncURLConf):
+                with self.subTest(status=status, urlconf=urlconf), override_settings(ROOT_URLCONF=urlconf):
+                    cache.clear()
+                    with mock.patch.object(sms_backends.FakeBackend, 'send') as send:
+                        response = self.client.get(reverse('user_app:twilio_token_send_again', args=[self.user.uuid_value]))
+                    self.assertEqual(response.status_code, 404)
+                    send.assert_not_called()
+                    response = self.client.post(reverse('user_app:phone_verify', args=[self.user.uuid_value]), {'code': '123456'})
+                    self.assertEqual(response.status_code, 404)
+                    self.assertFalse(customized_user_model.objects.get(pk=self.user.pk).is_active)
+                    self.assertEqual(self.user.customizedemaildevice_set.count(), 3)
+
+
+
+@override_settings(ROOT_URLCONF='user_app.tests')
+class ProfileCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = customized_user_model.objects.create(phone='+12025550100', email='user@example.com', first_name='Old')
+        self.client.force_login(self.user)
+        self.url = reverse('user_app:profile', args=[self.user.uuid_value])
+
+    def test_conditional_get(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, 'Old')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"outdated"').status_code, 200)
+
+    def test_invalidated_by_an_update(self):
+        etag = self.client.get(self.url)['ETag']
+        self.user.first_name = 'New'
+        self.user.save(update_fields=['first_name'])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'New')
+        self.assertNotEqual(response['ETag'], etag)
+
+        # "QuerySet.update()" doesn't send signals; "invalidate()" has to be called explicitly
+        etag = response['ETag']
+        customized_user_model.objects.filter(pk=self.user.pk).update(first_name='Updated')
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        profile_cache.invalidate(self.user.uuid_value)
+        self.assertContains(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag), 'Updated')
+
+    def test_invalidated_again_on_commit(self):
+        key = profile_cache._key(self.user.uuid_value)
+        model_admin = UserAdmin(customized_user_model, admin.site)
+        device = CustomizedEmailDevice.objects.create(user_id=self.user.pk, name='device')
+        for change in (
+            lambda: self.user.save(update_fields=['is_active']),
+            lambda: CustomizedEmailDevice.objects.get(pk=device.pk).delete(),
+            lambda: model_admin.set_active(customized_user_model.objects.filter(pk=self.user.pk), False),
+        ):
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+                self.assertIsNone(cache.get(key))
+                # Before the transaction commits, a concurrent request still reads (and caches) the old row
+                cache.set(key, 'outdated')
+                version = verification_state._get_version(self.user.pk)
+            self.assertIsNone(cache.get(key))
+            self.assertNotEqual(verification_state._get_version(self.user.pk), version)
+
+    def test_locmem_cache_check(self):
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://localhost'}}
+        with override_settings(CACHES=locmem):
+            self.assertEqual([error.id for error in profile_cache.check_shared_cache(None)], ['user_app.W001'])
+            self.assertNotIn('user_app.W001', [error.id for error in checks.run_checks(tags=[checks.Tags.caches])]) # deploy only
+        with override_settings(CACHES=shared):
+            self.assertEqual(profile_cache.check_shared_cache(None), [])
+
+
+
+@override_settings(ROOT_URLCONF='user_app.tests', PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class VerificationStateTests(TestCase):
+    '''
+    The session snapshot behind "otp_required" and "Email_Verification_Required", through "UserDelete" (gated by both).
+    '''
+
+    def setUp(self):
+        cache.clear()
+        self.user = customized_user_model.objects.create(phone='+12025550100', email='user@example.com', email_verified=True)
+        self.user.set_password('State-Pa55word!')
+        self.user.save()
+        self.device = CustomizedEmailDevice.objects.create(user=self.user, name='device')
+        self.client.force_login(self.user)
+        self.verify_otp(self.device)
+        self.url = reverse('user_app:delete')
+
+    def verify_otp(self, device):
+        session = self.client.session
+        session[DEVICE_ID_SESSION_KEY] = device.persistent_id
+        session.save()
+
+    def test_password_change_logs_out_other_sessions(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.user.set_password('State-Pa55word!2')
+        self.user.save(update_fields=['password'])
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn('_auth_user_id', self.client.session) # flushed, like "request.user" does
+
+    def test_deleted_device(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.device.delete()
+        response = self.client.get(self.url)
+        self.assertTrue(response.url.startswith(reverse('user_app:otp_verify')))
+        self.assertNotIn(DEVICE_ID_SESSION_KEY, self.client.session)
+
+    def test_device_of_another_user(self):
+        other = customized_user_model.objects.create(phone='+12025550101', email='other@example.com')
+        self.verify_otp(CustomizedEmailDevice.objects.create(user=other, name='other'))
+        self.assertTrue(self.client.get(self.url).url.startswith(reverse('user_app:otp_verify')))
+
+    def test_evicted_version(self):
+        verification_state.bump_version(self.user.pk)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+        # The version is evicted, and the user changed behind the signals' back (then bumped by hand, as "QuerySet.update()" callers do)
+        cache.delete(verification_state._version_key(self.user.pk))
+        customized_user_model.objects.filter(pk=self.user.pk).update(email_verified=False)
+        verification_state.bump_version(self.user.pk)
+        self.assertTrue(self.client.get(self.url).url.startswith(reverse('user_app:email_verify')))
+
+    def test_snapshot_is_reused(self):
+        self.client.get(self.url)
+        request = RequestFactory().get(self.url)
+        request.session = self.client.session
+        request.session.keys() # loaded outside the count
+        with self.assertNumQueries(0):
+            self.assertEqual(verification_state.get_state(request)['otp_device_id'], self.device.persistent_id)
+
+
+
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', OTP_EMAIL_BODY_TEMPLATE='{{ token }}',
+    USER_APP_PENDING_VERIFICATION_MAX_ATTEMPTS=2,
+)
+class EmailChangeFormTests(TestCase):
+
+    def setUp(self):
+        self.user = customized_user_model.objects.create(phone='+12025550100', email='user@example.com')
+        self.device = self.user.customizedemaildevice_set.create(name=self.user.email)
+        self.other = customized_user_model.objects.create(phone='+12025550101', email='other@example.com')
+
+    def submit(self, **data):
+        request = RequestFactory().post('/')
+        request.user = customized_user_model.objects.get(pk=self.user.pk)
+        form = EmailChangeForm(request, data={'otp_device': self.device.persistent_id, 'new_email': 'new@example.com', **data})
+        form.is_valid()
+        return form
+
+    def challenge(self):
+        return self.submit(otp_challenge='1')
+
+    def test_reservation_conflict(self):
+        self.other.set_temp_email('new@example.com')
+        self.assertEqual(self.challenge().errors['__all__'][0], 'Error generating OTP Token: This email address is already being verified by another account')
+        self.assertEqual(mail.outbox, [])
+
+    def test_unknown_device_reserves_nothing(self):
+        other_device = self.other.customizedemaildevice_set.create(name=self.other.email)
+        form = self.submit(otp_device=other_device.persistent_id, otp_challenge='1')
+        self.assertEqual(form.errors['__all__'][0], 'The selected OTP device is not interactive')
+        self.assertFalse(PendingVerification.objects.exists())
+
+    def test_attempt_exhaustion_and_expiry(self):
+        self.assertEqual(self.challenge().errors['__all__'][0], 'OTP Token: sent to new@example.com')
+        for _ in range(2):
+            self.assertFalse(self.submit(otp_token='000000').is_valid())
+        self.assertIsNone(customized_user_model.objects.get(pk=self.user.pk).email_temp) # out of attempts
+
+        # Neither another token nor a new challenge is accepted...
+        exhausted = 'Too many invalid tokens. Please wait a few minutes before requesting a new one.'
+        self.device.refresh_from_db()
+        self.assertEqual(self.submit(otp_token=self.device.token).errors['__all__'][0], exhausted)
+        self.assertEqual(self.submit(otp_token='000000', new_email='another@example.com').errors['__all__'][0], exhausted)
+        self.assertEqual(self.challenge().errors['__all__'][0], exhausted)
+        self.assertEqual(len(mail.outbox), 1)
+        # ... while the address isn't reserved for this user anymore
+        self.other.set_temp_email('new@example.com')
+        self.other.clear_pending_verification(PendingVerification.EMAIL)
+
+        # ... until the pending verification expires
+        PendingVerification.objects.filter(user=self.user).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.challenge().errors['__all__'][0], 'OTP Token: sent to new@example.com')
+        self.assertEqual(len(mail.outbox), 2)
+        self.device.refresh_from_db()
+        self.device.throttle_reset()
+        self.assertTrue(self.submit(otp_token=self.device.token).is_valid())
+        self.assertEqual(customized_user_model.objects.get(pk=self.user.pk).email, 'new@example.com')
+
+    def test_address_taken_after_the_challenge(self):
+        self.challenge()
+        customized_user_model.objects.create(phone='+12025550102', email='new@example.com') # e.g. a signup
+        self.device.refresh_from_db()
+        form = self.submit(otp_token=self.device.token)
+        self.assertEqual(form.errors['__all__'][0], 'This email address has been taken by another account in the meantime. Please choose another one.')
+        self.assertIsNone(form.get_user().otp_device)
+        self.assertEqual(customized_user_model.objects.get(pk=self.user.pk).email, 'user@example.com')
+        self.assertFalse(PendingVerification.objects.filter(user=self.user).exists())
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.name, 'user@example.com')
+
+
+
+@override_settings(
+    ROOT_URLCONF=AsyncURLConf,
+    USER_APP_SMS_BACKEND='user_app.sms_backends.FakeBackend',
+    USER_APP_FAKE_SMS_CODE='123456',
+    USER_APP_PHONE_RATE_LIMITS={},
+    USER_APP_SMS_SEND_COOLDOWN=0,
+    USER_APP_EMAIL_OUTBOX=False,
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    OTP_EMAIL_BODY_TEMPLATE='{{ token }}',
+)
+class AsyncViewTests(TestCase):
+    '''
+    Smoke tests of "user_app.async_views", through the ASGI handler.
+    '''
+
+    password = 'Async-Pa55word!'
+
+    def setUp(self):
+        cache.clear()
+
+    async def signup(self, phone='+12025550100', email='user@example.com'):
+        return await self.async_client.post(reverse('user_app:create'), {
+            'first_name': 'Async', 'last_name': 'Test', 'phone': phone, 'email': email,
+            'gender': 'None', 'password1': self.password, 'password2': self.password,
+        })
+
+    async def verified_user(self, phone='+12025550100', email='user@example.com'):
+        user = await customized_user_model.objects.acreate(phone=phone, email=email, is_active=True)
+        device = await user.customizedemaildevice_set.acreate(name=user.email)
+        await sync_to_async(self.async_client.force_login)(user)
+        return user, device
+
+    async def verify_otp(self, url, device, **data):
+        response = await self.async_client.post(url, {'otp_device': device.persistent_id, 'otp_challenge': '1', **data})
+        self.assertContains(response, 'OTP Token: sent to')
+        await device.arefresh_from_db()
+        return await self.async_client.post(url, {'otp_device': device.persistent_id, 'otp_token': device.token, **data})
+
+    async def test_signup_and_phone_views(self):
+        self.assertEqual((await self.async_client.get(reverse('user_app:create'))).status_code, 200)
+        response = await self.signup()
+        user = await customized_user_model.objects.aget(email='user@example.com')
+        verify_url = reverse('user_app:phone_verify', args=[user.uuid_value])
+        self.assertRedirects(response, verify_url, fetch_redirect_response=False)
+        self.assertFalse(user.is_active)
+
+        response = await self.async_client.get(reverse('user_app:twilio_token_send_again', args=[user.uuid_value]))
+        self.assertRedirects(response, verify_url, fetch_redirect_response=False)
+        self.assertEqual((await self.async_client.get(verify_url)).status_code, 200)
+        self.assertContains(await self.async_client.post(verify_url, {'code': '000000'}), 'error verifying your code')
+        response = await self.async_client.post(verify_url, {'code': '123456'})
+        self.assertRedirects(response, reverse('user_app:login'), fetch_redirect_response=False)
+        await user.arefresh_from_db()
+        self.assertTrue(user.is_active)
+        self.assertTrue(await user.customizedemaildevice_set.aexists())
+
+        await sync_to_async(self.async_client.force_login)(user)
+        self.assertEqual((await self.async_client.get(reverse('user_app:phone_change'))).status_code, 200)
+        response = await self.async_client.post(reverse('user_app:phone_change'), {'new_phone': '+12025550199'})
+        self.assertRedirects(response, verify_url, fetch_redirect_response=False)
+        response = await self.async_client.post(verify_url, {'code': '123456'})
+        self.assertRedirects(response, reverse('user_app:profile', args=[user.uuid_value]), fetch_redirect_response=False)
+        await user.arefresh_from_db()
+        self.assertEqual(str(user.phone), '+12025550199')
+
+    async def test_email_and_otp_views(self):
+        user, device = await self.verified_user()
+        response = await self.async_client.get(reverse('user_app:email_change'))
+        self.assertTrue(response.url.startswith(reverse('user_app:email_verify'))) # the email isn't verified yet
+
+        self.assertEqual((await self.async_client.get(reverse('user_app:email_verify'))).status_code, 200)
+        response = await self.verify_otp(reverse('user_app:email_verify'), device)
+        self.assertRedirects(response, reverse('user_app:profile', args=[user.uuid_value]), fetch_redirect_response=False)
+        await user.arefresh_from_db()
+        self.assertTrue(user.email_verified)
+
+        self.assertEqual((await self.async_client.get(reverse('user_app:email_change'))).status_code, 200)
+        response = await self.verify_otp(reverse('user_app:email_change'), device, new_email='new@example.com')
+        self.assertEqual(response.status_code, 302)
+        await user.arefresh_from_db()
+        self.assertEqual(user.email, 'new@example.com')
+
+        self.assertEqual((await self.async_client.get(reverse('user_app:otp_verify'))).status_code, 200)
+        response = await self.verify_otp(reverse('user_app:otp_verify'), device)
+        self.assertRedirects(response, reverse('user_app:profile', args=[user.uuid_value]), fetch_redirect_response=False)
+        self.assertEqual(len(mail.outbox), 3)
+
+    async def test_login_required(self):
+        for name in ('phone_change', 'email_verify', 'email_change', 'otp_verify'):
+            response = await self.async_client.get(reverse(f'user_app:{name}'))
+            self.assertEqual(response.status_code, 302, name)
+
+    @override_settings(USER_APP_PHONE_RATE_LIMITS={'send': {'phone': (1, 600)}, 'verify': {'phone': (1, 600)}})
+    async def test_rate_limits(self):
+        await self.signup()
+        response = await self.signup(email='second@example.com')
+        self.assertContains(response, 'Too many attempts')
+        self.assertFalse(await customized_user_model.objects.filter(email='second@example.com').aexists())
+
+        user = await customized_user_model.objects.aget(email='user@example.com')
+        await self.async_client.get(reverse('user_app:twilio_token_send_again', args=[user.uuid_value]))
+        verify_url = reverse('user_app:phone_verify', args=[user.uuid_value])
+        self.assertContains(await self.async_client.get(verify_url), 'Too many attempts') # the message from "send again"
+
+        self.assertContains(await self.async_client.post(verify_url, {'code': '000000'}), 'error verifying your code')
+        self.assertContains(await self.async_client.post(verify_url, {'code': '123456'}), 'Too many attempts')
+        self.assertFalse((await customized_user_model.objects.aget(pk=user.pk)).is_active)
+
+        await self.verified_user('+12025550101', 'other@example.com')
+        await self.async_client.post(reverse('user_app:phone_change'), {'new_phone': '+12025550199'})
+        response = await self.async_client.post(reverse('user_app:phone_change'), {'new_phone': '+12025550199'})
+        self.assertContains(response, 'Too many attempts')
+
+
+
+@override_settings(
+    ROOT_URLCONF='user_app.tests',
+    USER_APP_SMS_BACKEND='user_app.sms_backends.FakeBackend',
+    USER_APP_FAKE_SMS_CODE='123456',
+    USER_APP_PHONE_RATE_LIMITS={},
+    USER_APP_SMS_SEND_COOLDOWN=10,
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+class SendDeduplicationTests(TestCase):
+    '''
+    Idempotency keys ("user_app.idempotency") and the SMS send cooldown ("throttling.claim_send()").
+    '''
+
+    data = {
+        'first_name': 'Idem', 'last_name': 'Potent', 'phone': '+12025550100', 'email': 'user@example.com',
+        'gender': 'None', 'password1': 'Idem-Pa55word!', 'password2': 'Idem-Pa55word!', 'idempotency_key': 'key',
+    }
+
+    def setUp(self):
+        cache.clear()
+        self.send = mock.patch.object(sms_backends.FakeBackend, 'send', autospec=True, side_effect=sms_backends.FakeBackend.send).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def lock_key(self, key='key'):
+        request = RequestFactory().post(reverse('user_app:create'), {'idempotency_key': key})
+        return idempotency._keys(request, 'signup')[1]
+
+    def test_same_key_replays_the_redirect(self):
+        first = self.client.post(reverse('user_app:create'), self.data)
+        self.assertEqual(first.status_code, 302)
+        second = self.client.post(reverse('user_app:create'), {**self.data, 'email': 'other@example.com'})
+        self.assertEqual((second.status_code, second['Location']), (302, first['Location']))
+        self.assertEqual(customized_user_model.objects.count(), 1)
+        self.assertEqual(self.send.call_count, 1)
+
+    def test_concurrent_key_gets_409(self):
+        cache.add(self.lock_key(), True) # a first request still running
+        with mock.patch.object(idempotency, 'WAIT_TIMEOUT', 0):
+            response = self.client.post(reverse('user_app:create'), self.data)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(customized_user_model.objects.exists())
+
+    def test_waiting_stops_when_the_lock_is_released_without_an_outcome(self):
+        cache.add(self.lock_key(), True) # a first request that will end with an invalid form
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            cache.delete(self.lock_key())
+
+        with mock.patch.object(idempotency.time, 'sleep', sleep):
+            response = self.client.post(reverse('user_app:create'), self.data)
+        self.assertEqual(response.status_code, 302) # processed by this request, without waiting for WAIT_TIMEOUT
+        self.assertEqual(sleeps, [idempotency.WAIT_INTERVAL])
+        self.assertEqual(customized_user_model.objects.count(), 1)
+        self.assertIsNone(cache.get(self.lock_key()))
+
+    @override_settings(ROOT_URLCONF=AsyncURLConf)
+    async def test_async_waiting_stops_when_the_lock_is_released_without_an_outcome(self):
+        lock_key = await sync_to_async(self.lock_key)()
+        await cache.aadd(lock_key, True)
+        sleeps = []
+
+        async def sleep(seconds):
+            sleeps.append(seconds)
+            await cache.adelete(lock_key)
+
+        with mock.patch.object(idempotency.asyncio, 'sleep', sleep):
+            response = await self.async_client.post(reverse('user_app:create'), self.data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(sleeps, [idempotency.WAIT_INTERVAL])
+        self.assertEqual(await customized_user_model.objects.acount(), 1)
+
+    def test_waiting_request_replays_the_stored_outcome(self):
+        result_key, lock_key = idempotency._keys(RequestFactory().post(reverse('user_app:create'), {'idempotency_key': 'key'}), 'signup')
+        cache.add(lock_key, True)
+
+        def sleep(seconds):
+            # The first request stores its redirect, then releases the lock
+            cache.set(result_key, {'status': 302, 'location': '/done/'})
+            cache.delete(lock_key)
+
+        with mock.patch.object(idempotency.time, 'sleep', sleep):
+            response = self.client.post(reverse('user_app:create'), self.data)
+        self.assertEqual((response.status_code, response['Location']), (302, '/done/'))
+        self.assertFalse(customized_user_model.objects.exists())
+        self.assertIsNone(cache.get(lock_key))
+
+    def test_lock_is_released(self):
+        response = self.client.post(reverse('user_app:create'), {**self.data, 'password2': 'mismatch'})
+        self.assertEqual(response.status_code, 200) # not stored: the same key may be retried
+        self.assertIsNone(cache.get(self.lock_key()))
+        self.assertEqual(self.client.post(reverse('user_app:create'), self.data).status_code, 302)
+
+    def test_cooldown(self):
+        self.assertEqual(twilio_verify.token_send('+12025550100'), sms_backends.PENDING)
+        self.assertEqual(twilio_verify.token_send('+12025550100'), sms_backends.COOLDOWN) # coalesced
+        self.assertEqual(twilio_verify.token_send('+12025550101'), sms_backends.PENDING)
+        self.assertEqual([str(call.args[1]) for call in self.send.call_args_list], ['+12025550100', '+12025550101'])
+        self.assertEqual(async_to_sync(twilio_verify.atoken_send)('+12025550101'), sms_backends.COOLDOWN)
+        self.assertEqual(self.send.call_count, 2)
+
+    def test_send_again_within_the_cooldown(self):
+        for urlconf in ('user_app.tests', AsyncURLConf):
+            with self.subTest(urlconf=urlconf), override_settings(ROOT_URLCONF=urlconf):
+                cache.clear()
+                self.send.reset_mock()
+                response = self.client.post(reverse('user_app:create'), {**self.data, 'idempotency_key': str(urlconf)})
+                self.assertEqual(response.status_code, 302)
+                user = customized_user_model.objects.get(email=self.data['email'])
+
+                response = self.client.get(reverse('user_app:twilio_token_send_again', args=[user.uuid_value]), follow=True)
+                self.assertContains(response, 'A code was already sent to this number moments ago')
+                self.assertNotContains(response, 'sent another confirmation code')
+                self.assertEqual(self.send.call_count, 1)
+                user.delete()
+
+    def test_signup_within_the_cooldown(self):
+        twilio_verify.token_send(self.data['phone']) # e.g. an earlier signup attempt that failed afterwards
+        response = self.client.post(reverse('user_app:create'), self.data)
+        self.assertEqual(response.status_code, 302) # the code sent moments ago is still valid
+        self.assertTrue(customized_user_model.objects.exists())
+        self.assertEqual(self.send.call_count, 1)
+
+    def test_failed_send_releases_the_claim(self):
+        self.send.side_effect = [sms_backends.ERROR, sms_backends.PENDING]
+        self.assertEqual(twilio_verify.token_send('+12025550100'), sms_backends.ERROR)
+        self.assertEqual(twilio_verify.token_send('+12025550100'), sms_backends.PENDING)
+        self.assertEqual(self.send.call_count, 2)
+
+    @override_settings(USER_APP_SMS_QUEUE_BACKEND='user_app.sms_backends.FakeBackend')
+    def test_failed_queued_send_releases_the_claim(self):
+        backend = sms_backends.QueuedBackend()
+        self.addCleanup(backend.close)
+        self.assertTrue(throttling.claim_send('+12025550100'))
+        self.send.side_effect = OSError('provider down')
+        with self.assertLogs('user_app.sms_backends', 'ERROR'):
+            self.assertEqual(backend._deliver('+12025550100'), sms_backends.ERROR)
+        self.assertTrue(throttling.claim_send('+12025550100'))
+
+        # A delivered code keeps its claim for the cooldown
+        self.send.side_effect = None
+        self.send.return_value = sms_backends.PENDING
+        self.assertTrue(throttling.claim_send('+12025550101'))
+        self.assertEqual(backend._deliver('+12025550101'), sms_backends.PENDING)
+        self.assertFalse(throttling.claim_send('+12025550101'))
+
+
+
+@override_settings(
+    AUTHENTICATION_BACKENDS=['user_app.backends.PhoneAuthenticationBackend'],
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+class PhoneAuthenticationBackendTests(TestCase):
+
+    password = 'Login-Pa55word!'
+
+    @classmethod
+    def setUpTestData(cls):
+        for phone, is_active in (('+12025550100', True), ('+12025550101', False)):
+            user = customized_user_model(phone=phone, email=f'{phone}@example.com', is_active=is_active)
+            user.set_password(cls.password)
+            user.save()
+
+    def login(self, phone, password=None):
+        request = RequestFactory().post('/')
+        form = CustomizededAuthenticationForm(request, data={'username': phone, 'password': password or self.password})
+        form.is_valid()
+        return form, request
+
+    def test_success(self):
+        form, _ = self.login('+12025550100')
+        self.assertEqual(form.errors, {})
+        self.assertEqual(str(form.get_user().phone), '+12025550100')
+
+    def test_failures_take_one_query(self):
+        for phone, password, failure, code in (
+            ('+12025550100', 'wrong', 'invalid', 'invalid_login'),
+            ('+12025550101', None, 'inactive', 'inactive'), # the right password, but not activated yet
+            ('+12025550199', None, 'invalid', 'invalid_login'),
+        ):
+            with self.subTest(phone), self.assertNumQueries(1): # the user lookup; no second one in the form
+                form, request = self.login(phone, password)
+            self.assertEqual(request.user_app_login_failure, failure)
+            self.assertEqual(form.non_field_errors().as_data()[0].code, code)
+
+    def test_unknown_phone_runs_the_hasher(self):
+        with mock.patch.object(customized_user_model, 'set_password', autospec=True) as set_password:
+            self.login('+12025550199')
+        set_password.assert_called_once_with(mock.ANY, self.password)
+
+    @override_settings(AUTHENTICATION_BACKENDS=['django.contrib.auth.backends.ModelBackend'])
+    def test_form_falls_back_to_a_query_with_model_backend(self):
+        with self.assertNumQueries(2): # the user lookup, then the form's EXISTS
+            form, request = self.login('+12025550101')
+        self.assertFalse(hasattr(request, 'user_app_login_failure'))
+        self.assertEqual(form.non_field_errors().as_data()[0].code, 'inactive')
+        with self.assertNumQueries(2):
+            form, _ = self.login('+12025550100', 'wrong')
+        self.assertEqual(form.non_field_errors().as_data()[0].code, 'invalid_login')
+
+
+
+@override_settings(
+    PASSWORD_HASHERS=['user_app.hashers.TunedPBKDF2PasswordHasher', 'user_app.hashers.TunedScryptPasswordHasher'],
+    USER_APP_PASSWORD_HASHER_PARAMS={'pbkdf2_sha256': {'iterations': 1000}, 'scrypt': {'work_factor': 2**10}},
+)
+class TunedPasswordHasherTests(TestCase):
+
+    def test_parameters(self):
+        self.assertEqual(hashers.TunedPBKDF2PasswordHasher().iterations, 1000)
+        scrypt = hashers.TunedScryptPasswordHasher()
+        self.assertEqual((scrypt.work_factor, scrypt.block_size), (2**10, 8)) # missing ones fall back to Django's defaults
+        self.assertTrue(scrypt.encode('password', scrypt.salt()).startswith('scrypt$1024$'))
+        argon2 = hashers.TunedArgon2PasswordHasher()
+        self.assertEqual((argon2.time_cost, argon2.memory_cost), (django_hashers.Argon2PasswordHasher.time_cost, django_hashers.Argon2PasswordHasher.memory_cost))
+
+    def test_rehashed_after_a_parameter_change(self):
+        user = customized_user_model(phone='+12025550100', email='user@example.com')
+        user.set_password('Hash-Pa55word!')
+        user.save()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$1000$'))
+
+        with override_settings(USER_APP_PASSWORD_HASHER_PARAMS={'pbkdf2_sha256': {'iterations': 2000}}):
+            user = customized_user_model.objects.get(pk=user.pk)
+            self.assertTrue(user.check_password('Hash-Pa55word!'))
+        self.assertTrue(customized_user_model.objects.get(pk=user.pk).password.startswith('pbkdf2_sha256$2000$'))
+
+    def test_benchmark_command(self):
+        stdout = io.StringIO()
+        call_command('benchmark_password_hashers', seconds=0.01, logins_per_second=50, stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertIn('cores available', lines[0])
+        self.assertRegex(lines[1], r'^pbkdf2_sha256 +[0-9.]+ hashes/s/core +[0-9.]+ ms/hash +[0-9.]+ cores for 50 logins/s$')
+        self.assertTrue(lines[2].startswith('scrypt'))
+
+
+
+class AdminTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = [
+            customized_user_model.objects.create(phone='+12025550100', email='first@example.com'),
+            customized_user_model.objects.create(phone='+12025550101', email='second@example.com', is_active=False),
+        ]
+
+    def search(self, term):
+        query = exact_user_search(term)
+        return query and list(customized_user_model.objects.filter(query).order_by('pk'))
+
+    def test_exact_user_search(self):
+        first, second = self.users
+        self.assertEqual(self.search('+12025550101'), [second])
+        self.assertEqual(self.search(' first@example.com '), [first])
+        self.assertEqual(self.search(str(first.uuid_value)), [first])
+        self.assertEqual(self.search('first@'), []) # no partial matches
+        self.assertEqual(self.search('not a phone, email or uuid'), [])
+        self.assertIsNone(self.search('  '))
+
+        query = exact_user_search('+12025550100', prefix='user__')
+        self.assertEqual(list(CustomizedEmailDevice.objects.filter(query)), [])
+        device = CustomizedEmailDevice.objects.create(user=first, name=first.email)
+        self.assertEqual(list(CustomizedEmailDevice.objects.filter(query)), [device])
+
+    def test_actions_update_once_and_invalidate(self):
+        model_admin = UserAdmin(customized_user_model, admin.site)
+        request = RequestFactory().post('/')
+        for action, is_active in ((model_admin.activate_users, True), (model_admin.deactivate_users, False)):
+            with self.subTest(action.__name__):
+                for user in self.users:
+                    cache.set(profile_cache._key(user.uuid_value), 'outdated')
+                versions = [verification_state._get_version(user.pk) for user in self.users]
+
+                with mock.patch.object(model_admin, 'message_user') as message_user, CaptureQueriesContext(connection) as queries:
+                    action(request, customized_user_model.objects.all())
+                self.assertEqual([query['sql'].split()[0] for query in queries], ['SELECT', 'UPDATE']) # the pks, then one UPDATE
+                message_user.assert_called_once()
+                self.assertIn('2 user(s)', message_user.call_args.args[1])
+
+                self.assertEqual(list(customized_user_model.objects.values_list('is_active', flat=True)), [is_active] * 2)
+                for user, version in zip(self.users, versions):
+                    self.assertIsNone(cache.get(profile_cache._key(user.uuid_value)))
+                    self.assertNotEqual(verification_state._get_version(user.pk), version)
+
+    def test_paginator_exact_count(self):
+        queryset = customized_user_model.objects.order_by('pk')
+        self.assertEqual(EstimatedCountPaginator(queryset, 10).count, 2) # not PostgreSQL
+
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            # A filtered list isn't estimated; there's no pg_class on this database to ask anyway
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(EstimatedCountPaginator(queryset.filter(is_active=True), 10).count, 1)
+            self.assertEqual(len(queries), 1)
+            self.assertIn('COUNT(', queries[0]['sql'])
+
+            with mock.patch.object(connection, 'cursor') as cursor:
+                cursor.return_value.__enter__.return_value.fetchone.return_value = (250000,)
+                self.assertEqual(EstimatedCountPaginator(queryset, 10).count, 250000)
+                cursor.return_value.__enter__.return_value.fetchone.return_value = (50,)
+                with mock.patch('django.core.paginator.Paginator.count', 2):
+                    self.assertEqual(EstimatedCountPaginator(queryset, 10).count, 2) # a small table is counted exactly
+
+
+
+class InstrumentationTests(TestCase):
+
+    def setUp(self):
+        instrumentation.metrics.reset()
+        self.addCleanup(instrumentation.metrics.reset)
+
+    def request(self):
+        request = RequestFactory().get('/')
+        request.resolver_match = mock.Mock(view_name='user_app:test')
+        return request
+
+    def get_response(self, request):
+        list(customized_user_model.objects.all())
+        customized_user_model.objects.exists()
+        with instrumentation.timed('sms'):
+            with instrumentation.timed('sms'): # nested blocks count once
+                with instrumentation.timed('email'):
+                    pass
+        return HttpResponse()
+
+    def metrics_lines(self):
+        response = instrumentation.metrics_view(RequestFactory().get('/'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        return response.content.decode().splitlines()
+
+    @override_settings(USER_APP_INSTRUMENTATION_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_not_measured(self):
+        middleware = instrumentation.InstrumentationMiddleware(self.get_response)
+        with self.assertNoLogs('user_app.instrumentation'), mock.patch.object(instrumentation, '_add_call') as add_call:
+            self.assertEqual(middleware(self.request()).status_code, 200)
+        add_call.assert_not_called()
+        self.assertFalse([line for line in self.metrics_lines() if not line.startswith('#')])
+
+    def test_timed_outside_a_request(self):
+        with mock.patch.object(instrumentation, '_add_call') as add_call:
+            with instrumentation.timed('sms'):
+                pass
+        add_call.assert_not_called()
+
+    @override_settings(USER_APP_INSTRUMENTATION_SAMPLE_RATE=1)
+    def test_sampled_request(self):
+        middleware = instrumentation.InstrumentationMiddleware(self.get_response)
+        with self.assertLogs('user_app.instrumentation', 'INFO') as logs:
+            middleware(self.request())
+        self.assertRegex(logs.output[0], r'GET user_app:test 200 [0-9.]+ ms, 2 queries, ')
+        record = logs.records[0].user_app_metrics
+        self.assertEqual((record['view'], record['method'], record['status'], record['queries']), ('user_app:test', 'GET', 200, 2))
+        self.assertEqual({name: call['calls'] for name, call in record['calls'].items()}, {'db': 2, 'sms': 1, 'email': 1})
+
+        lines = self.metrics_lines()
+        for line in (
+            'user_app_requests_total{view="user_app:test",status="200"} 1',
+            'user_app_request_duration_seconds_bucket{view="user_app:test",le="+Inf"} 1',
+            'user_app_request_duration_seconds_count{view="user_app:test"} 1',
+            'user_app_request_queries_total{view="user_app:test"} 2',
+            'user_app_calls_total{view="user_app:test",call="db"} 2',
+            'user_app_calls_total{view="user_app:test",call="sms"} 1',
+            'user_app_calls_total{view="user_app:test",call="email"} 1',
+        ):
+            self.assertIn(line, lines)
+        self.assertIn('# TYPE user_app_request_duration_seconds histogram', lines)
+        self.assertTrue(any(line.startswith('user_app_call_seconds_total{view="user_app:test",call="sms"} ') for line in lines))
+
+    @override_settings(USER_APP_INSTRUMENTATION_SAMPLE_RATE=1)
+    async def test_sampled_async_request(self):
+        async def get_response(request):
+            with instrumentation.timed('sms'):
+                await asyncio.sleep(0)
+            await sync_to_async(self.get_response)(request) # "timed()" blocks in the sync thread count too
+            return HttpResponse(status=201)
+
+        middleware = instrumentation.InstrumentationMiddleware(get_response)
+        with self.assertLogs('user_app.instrumentation', 'INFO') as logs:
+            response = await middleware(self.request())
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('n/a queries', logs.output[0])
+        record = logs.records[0].user_app_metrics
+        self.assertIsNone(record['queries'])
+        self.assertEqual({name: call['calls'] for name, call in record['calls'].items()}, {'sms': 2, 'email': 1})
+        lines = self.metrics_lines()
+        self.assertIn('user_app_requests_total{view="user_app:test",status="201"} 1', lines)
+        self.assertFalse([line for line in lines if line.startswith('user_app_request_queries_total')])
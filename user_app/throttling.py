@@ -0,0 +1,112 @@
+'''
+user_app.throttling
+
+Rate limits for phone verification (sending and checking SMS codes), kept in Django's cache
+framework; so they're shared between workers when the cache is (Redis, Memcached, database),
+and per process with the locmem cache (fine for tests).
+
+Every action is limited per phone number, per user (uuid) and per client IP, with a sliding
+window: the count of the current fixed window plus the previous window's count, weighted by how
+much of it still overlaps the sliding window. Limits are configured with:
+
+    USER_APP_PHONE_RATE_LIMITS = {
+        'send': {'phone': (3, 600), 'uuid': (5, 3600), 'ip': (20, 3600)},  # (max. requests, seconds)
+        'verify': {'phone': (5, 600), 'uuid': (10, 3600), 'ip': (50, 3600)},
+    }
+    USER_APP_RATE_LIMIT_CACHE = 'default'  # an alias from settings.CACHES
+
+Leave a scope out (or set the whole setting to {}) to disable it. The client IP is taken from
+REMOTE_ADDR; if you're behind a proxy, make sure it's set to the real client address.
+
+Separately, sends to the same phone number within a short cooldown are coalesced: only the first
+one reaches the SMS provider, the others reuse its (still valid) code ("twilio_verify.token_send()"
+returns 'cooldown' for them). See "claim_send()":
+
+    USER_APP_SMS_SEND_COOLDOWN = 10  # seconds; 0 disables it
+'''
+
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+DEFAULT_RATE_LIMITS = {
+    'send': {'phone': (3, 600), 'uuid': (5, 3600), 'ip': (20, 3600)},
+    'verify': {'phone': (5, 600), 'uuid': (10, 3600), 'ip': (50, 3600)},
+}
+
+
+
+
+def _hit(cache, key, limit, period):
+    '''
+    Records one request for "key" and returns True if it's still within "limit" requests per "period" seconds.
+    '''
+    now = time.time()
+    window = int(now // period)
+    current_key, previous_key = f'{key}:{window}', f'{key}:{window - 1}'
+
+    cache.add(current_key, 0, timeout=period * 2)
+    try:
+        current = cache.incr(current_key)
+    except ValueError: # the key expired between add() and incr()
+        cache.set(current_key, 1, timeout=period * 2)
+        current = 1
+    previous = cache.get(previous_key, 0)
+
+    overlap = 1 - (now % period) / period
+    return previous * overlap + current <= limit
+
+
+def is_rate_limited(action, request, phone=None, uuid_value=None):
+    '''
+    Records an attempt of "action" ('send' or 'verify') and returns True if any of its limits is exceeded.
+    Call it before talking to the SMS provider, so rejected requests never reach it.
+    '''
+    limits = getattr(settings, 'USER_APP_PHONE_RATE_LIMITS', DEFAULT_RATE_LIMITS).get(action, {})
+    cache = caches[getattr(settings, 'USER_APP_RATE_LIMIT_CACHE', 'default')]
+
+    identities = {
+        'phone': phone,
+        'uuid': uuid_value,
+        'ip': request.META.get('REMOTE_ADDR'),
+    }
+
+    allowed = [
+        _hit(cache, f'user_app:rl:{action}:{scope}:{identities[scope]}', limit, period)
+        for scope, (limit, period) in limits.items()
+        if identities.get(scope)
+    ]
+    return not all(allowed)
+
+
+
+def _send_key(phone):
+    return f'user_app:sms-sent:{phone}'
+
+
+def claim_send(phone):
+    '''
+    Returns True if a code may be sent to "phone" now, i.e. none was sent (or is being sent) within the cooldown.
+    Call "release_send()" if the send then fails, so the next attempt isn't coalesced with a failure.
+    '''
+    cooldown = getattr(settings, 'USER_APP_SMS_SEND_COOLDOWN', 10)
+    if not cooldown:
+        return True
+    return caches[getattr(settings, 'USER_APP_RATE_LIMIT_CACHE', 'default')].add(_send_key(phone), True, timeout=cooldown)
+
+
+def release_send(phone):
+    caches[getattr(settings, 'USER_APP_RATE_LIMIT_CACHE', 'default')].delete(_send_key(phone))
+
+
+async def aclaim_send(phone):
+    cooldown = getattr(settings, 'USER_APP_SMS_SEND_COOLDOWN', 10)
+    if not cooldown:
+        return True
+    return await caches[getattr(settings, 'USER_APP_RATE_LIMIT_CACHE', 'default')].aadd(_send_key(phone), True, timeout=cooldown)
+
+
+async def arelease_send(phone):
+    await caches[getattr(settings, 'USER_APP_RATE_LIMIT_CACHE', 'default')].adelete(_send_key(phone))
@@ -2,55 +2,157 @@
 user_app.twilio_verify
 '''
 
+import logging
 import os
+from functools import lru_cache
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
-from twilio.rest import Client
+from .sms_backends import BaseVerificationBackend, COOLDOWN, ERROR, PENDING, get_backend
+from .throttling import aclaim_send, arelease_send, claim_send, release_send
+from .instrumentation import timed
 
-from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
 
 
 
-# from dotenv import dotenv_values
-# config_var = dotenv_values('.env')
-load_dotenv()  # take environment variables from .env.
 
-account_sid = os.environ['TWILIO_ACCOUNT_SID']
-auth_token = os.environ['TWILIO_AUTH_TOKEN']
-client = Client(account_sid, auth_token)
+@lru_cache(maxsize=None)
+def get_credentials():
+    '''
+    Returns (account_sid, auth_token, service_sid). Nothing is read until the first SMS is
+    actually sent or checked; so importing this module (and "user_app.views") doesn't require
+    the Twilio environment variables to be set.
+    '''
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        pass # python-dotenv is optional; the variables can also come from the real environment
+    else:
+        # from dotenv import dotenv_values
+        # config_var = dotenv_values('.env')
+        load_dotenv()  # take environment variables from .env.
 
-TWILIO_SERVICE_SID = os.environ['TWILIO_SERVICE_SID']
+    try:
+        return os.environ['TWILIO_ACCOUNT_SID'], os.environ['TWILIO_AUTH_TOKEN'], os.environ['TWILIO_SERVICE_SID']
+    except KeyError as e:
+        raise ImproperlyConfigured(f'The {e.args[0]} environment variable is not set.') from e
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    '''
+    Builds the "twilio.rest.Client" on first use and reuses it afterwards. Its HTTP session keeps
+    connections alive in a pool, configured by these optional settings:
+
+    USER_APP_TWILIO_TIMEOUT (seconds per call, default 10), USER_APP_TWILIO_POOL_SIZE (default 10)
+    and USER_APP_TWILIO_MAX_RETRIES (default 0).
+    '''
+    from requests.adapters import HTTPAdapter
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client
+
+    account_sid, auth_token, _ = get_credentials()
+
+    http_client = TwilioHttpClient(
+        pool_connections=True,
+        timeout=getattr(settings, 'USER_APP_TWILIO_TIMEOUT', 10),
+    )
+    pool_size = getattr(settings, 'USER_APP_TWILIO_POOL_SIZE', 10)
+    http_client.session.mount('https://', HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=getattr(settings, 'USER_APP_TWILIO_MAX_RETRIES', 0),
+    ))
+
+    return Client(account_sid, auth_token, http_client=http_client)
+
+
+@receiver(setting_changed)
+def _reset_client(setting, **kwargs):
+    if setting.startswith('USER_APP_TWILIO_'):
+        get_client.cache_clear()
+
+
+def __getattr__(name):
+    # Backwards compatibility: these used to be module-level globals built at import time.
+    if name == 'client':
+        return get_client()
+    if name == 'TWILIO_SERVICE_SID':
+        return get_credentials()[2]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+class TwilioBackend(BaseVerificationBackend):
+    '''
+    The default backend; uses the (blocking) "twilio" client.
+    '''
+
+    def send(self, phone):
+        try:
+            verification = get_client().verify \
+                         .v2 \
+                         .services(get_credentials()[2]) \
+                         .verifications \
+                         .create(to=str(phone), channel='sms')
+            status = verification.status
+        except Exception:
+            logger.exception('Sending a verification code to %s failed', phone)
+            status = ERROR
+
+        return status # verification.status == 'pending', if successful
+
+    def check(self, phone, code):
+        try:
+            verification_check = get_client().verify \
+                               .v2 \
+                               .services(get_credentials()[2]) \
+                               .verification_checks \
+                               .create(to=str(phone), code=str(code))
+            status = verification_check.status
+        except Exception:
+            logger.exception('Checking the verification code for %s failed', phone)
+            status = ERROR
+
+        return status # verification_check.status == 'approved', if successful
 
 
 def token_send(phone):
-    
+    # The actual sending is done by the backend configured in "settings.USER_APP_SMS_BACKEND"
+    if not claim_send(phone):
+        return COOLDOWN # a code was sent to this number moments ago (see "throttling.claim_send()")
+    status = ERROR
     try:
-        verification = client.verify \
-                     .v2 \
-                     .services(TWILIO_SERVICE_SID) \
-                     .verifications \
-                     .create(to=str(phone), channel='sms')
-        status = verification.status
-    except:
-        status = 'got error'
-    
-    return status # verification.status == 'pending', if successful
+        with timed('sms'):
+            status = get_backend().send(phone)
+    finally:
+        if status != PENDING:
+            release_send(phone)
+    return status
 
 
 def token_verify(phone, code):
+    with timed('sms'):
+        return get_backend().check(phone, code)
 
-    try:
-        verification_check = client.verify \
-                           .v2 \
-                           .services(TWILIO_SERVICE_SID) \
-                           .verification_checks \
-                           .create(to=str(phone), code=str(code))
-        status = verification_check.status
-    except:
-        status = 'got error'
 
-    return status # verification_check.status == 'approved', if successful
+async def atoken_send(phone):
+    if not await aclaim_send(phone):
+        return COOLDOWN
+    status = ERROR
+    try:
+        with timed('sms'):
+            status = await get_backend().asend(phone)
+    finally:
+        if status != PENDING:
+            await arelease_send(phone)
+    return status
 
 
+async def atoken_verify(phone, code):
+    with timed('sms'):
+        return await get_backend().acheck(phone, code)
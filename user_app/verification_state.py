@@ -0,0 +1,134 @@
+'''
+user_app.verification_state
+
+A small snapshot of the logged-in user's verification state (is_active, email_verified and the
+OTP-verified device id), kept in the session. The gates in "user_app.decorators" decide with it,
+so they don't have to load the user (and its OTP device) from the database on every request.
+
+The snapshot is rebuilt from the database only when it's stale: every change to a user (or the
+deletion of one of their email devices) replaces a per-user version token in the cache (see
+"user_app.signals"), and a snapshot with another version is thrown away. A missing version (never
+set, or evicted from the cache) is replaced with a fresh token too, so it can't match an old snapshot.
+The snapshot also records the session's auth hash and OTP device id it was built for; when either
+changes, it's rebuilt as well. Rebuilding resolves the user like "request.user" does (so a session
+whose password hash is outdated is logged out) and checks that the OTP device still exists and
+belongs to the user. Optional settings:
+
+USER_APP_VERIFICATION_STATE_CACHE: an alias from settings.CACHES (default 'default').
+'''
+
+import uuid
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY, get_user
+from django.core.cache import caches
+from django.db import transaction
+
+from django_otp import DEVICE_ID_SESSION_KEY
+from django_otp.models import Device
+
+
+STATE_SESSION_KEY = '_user_app_verification_state'
+
+
+
+
+def _cache():
+    return caches[getattr(settings, 'USER_APP_VERIFICATION_STATE_CACHE', 'default')]
+
+
+def _version_key(user_id):
+    return f'user_app:verification_state_version:{user_id}'
+
+
+def _get_version(user_id):
+    key = _version_key(user_id)
+    version = _cache().get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not _cache().add(key, version, timeout=None):
+            version = _cache().get(key) or version # set by a concurrent request
+    return version
+
+
+def bump_version(user_id):
+    '''
+    Marks every stored snapshot of this user as stale.
+    '''
+    _cache().set(_version_key(user_id), uuid.uuid4().hex, timeout=None)
+
+
+def _bump_versions(user_ids):
+    for user_id in user_ids:
+        bump_version(user_id)
+
+
+def bump_version_on_commit(*user_ids, using=None):
+    '''
+    Bumps the versions now, and again once the current transaction (if any) commits; a snapshot rebuilt from the
+    old rows in between (by a concurrent request) would otherwise carry the new version.
+    '''
+    _bump_versions(user_ids)
+    if transaction.get_connection(using).in_atomic_block:
+        transaction.on_commit(partial(_bump_versions, user_ids), using=using)
+
+
+def clear(request):
+    '''
+    Drops the session's snapshot (e.g. on login; the in-memory user at hand may be staler than the
+    database), so the next "get_state()" rebuilds it.
+    '''
+    request.session.pop(STATE_SESSION_KEY, None)
+
+
+def _build(request, user_id, version):
+    # "request.user" (if the middleware set it) verifies the session's auth hash, and flushes the session if it's outdated
+    user = request.user if hasattr(request, 'user') else get_user(request)
+    if not user.is_authenticated or str(user.pk) != str(user_id):
+        return None
+
+    device_id = request.session.get(DEVICE_ID_SESSION_KEY)
+    if device_id:
+        # Set by "django_otp.middleware.OTPMiddleware", if installed
+        device = user.otp_device if hasattr(user, 'otp_device') else Device.from_persistent_id(device_id)
+        if device is None or device.user_id != user.pk:
+            del request.session[DEVICE_ID_SESSION_KEY]
+            device_id = None
+
+    return {
+        'user_id': str(user_id),
+        'version': version,
+        'session_hash': request.session.get(HASH_SESSION_KEY),
+        'otp_device_id': device_id,
+        'is_active': user.is_active,
+        'email_verified': user.email_verified,
+    }
+
+
+def get_state(request):
+    '''
+    Returns the logged-in user's snapshot as a dict (is_active, email_verified, otp_device_id, ...),
+    or None if nobody is logged in.
+    '''
+    user_id = request.session.get(SESSION_KEY)
+    if user_id is None:
+        return None
+
+    snapshot = request.session.get(STATE_SESSION_KEY)
+    version = _get_version(user_id)
+    if (
+        snapshot is None
+        or snapshot['user_id'] != str(user_id)
+        or snapshot['version'] != version
+        or snapshot.get('session_hash') != request.session.get(HASH_SESSION_KEY)
+        or snapshot.get('otp_device_id') != request.session.get(DEVICE_ID_SESSION_KEY)
+    ):
+        snapshot = _build(request, user_id, version)
+        if snapshot is None:
+            return None
+        request.session[STATE_SESSION_KEY] = snapshot
+
+    if not snapshot['is_active']:
+        return None # inactive users are logged out by the authentication backend anyway
+    return dict(snapshot)
@@ -2,40 +2,90 @@
 user_app.views
 '''
 
+from django.conf import settings
 from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.utils.translation import gettext_lazy as _
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponseRedirect
 from django.contrib import messages
 from django.views import View
 from django.views.generic.edit import FormView, UpdateView
 from django.views.generic.detail import DetailView
 from django.contrib.auth.views import LoginView, LogoutView, PasswordChangeView, PasswordResetView, PasswordResetDoneView, PasswordResetConfirmView
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.shortcuts import resolve_url, get_object_or_404
+from django.shortcuts import resolve_url
 from django.urls import reverse_lazy
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 
-from .models import user as customized_user_model
+from .models import user as customized_user_model, PendingVerification
+from .phones import to_python
 from .forms import CustomizedUserCreationForm, CustomizededAuthenticationForm, EmailChangeForm, CustomizedUserDeletionForm, CustomizedOTPTokenForm, EmailVerificationForm, PhoneVerificationForm, PhoneChangeForm
-from .decorators import Email_Verification_Required
-from . import twilio_verify
+from .decorators import Email_Verification_Required, otp_required
+from .idempotency import idempotent
+from .resolvers import get_user_by_uuid
+from .query_budget import QueryBudgetMixin
+from .sms_backends import COOLDOWN, PENDING
+from .throttling import is_rate_limited
+from . import deletion, profile_cache, twilio_verify
 
-from django_otp.decorators import otp_required
 
 
 
 
-class UserCreate(FormView):
+RATE_LIMITED_MESSAGE = _('Too many attempts. Please wait a while and try again.')
+PHONE_CHANGE_EXPIRED_MESSAGE = _('Your phone number change has expired. Please start it again.')
+CODE_ALREADY_SENT_MESSAGE = _('A code was already sent to this number moments ago. Please wait a little before asking for another one.')
+
+
+def is_signup_rate_limited(request):
+    '''
+    Applies the 'send' limits to a signup from its raw POST data, before the form is validated and
+    the password hashed; so a throttled client doesn't cost a password hash per request.
+    '''
+    phone = to_python(request.POST.get('phone', '').strip())
+    return is_rate_limited('send', request, phone=phone if phone and phone.is_valid() else None)
+
+
+
+class UUIDUserMixin:
+    '''
+    Gives a view access to the user addressed by the "uuid_value" URL kwarg. The lookup is memoized per request (see "resolvers.get_user_by_uuid").
+    '''
+
+    def get_uuid_user(self):
+        return get_user_by_uuid(self.request, self.kwargs['uuid_value'])
+
+    def get_verifiable_uuid_user(self):
+        '''
+        The user, for the phone verification views; a user whose account is being deleted can't be verified (or activated) again.
+        '''
+        user = self.get_uuid_user()
+        if deletion.is_pending(user):
+            raise Http404('No user found matching the query')
+        return user
+
+
+
+@method_decorator(idempotent('signup'), name='post')
+class UserCreate(QueryBudgetMixin, FormView):
     template_name = 'user_app/user_create_form.html'
     form_class = CustomizedUserCreationForm
     success_url = None
+    query_budget = {'GET': 0, 'POST': 2}
+
+    def post(self, request, *args, **kwargs):
+        if is_signup_rate_limited(request):
+            messages.error(request, RATE_LIMITED_MESSAGE)
+            return self.render_to_response(self.get_context_data())
+        return super(UserCreate, self).post(request, *args, **kwargs)
 
     def form_valid(self, form):
         user = form.save(commit=False)
         user.is_active = False # Setting it to False; because the phone number hasn't been verified yet
         token_send = twilio_verify.token_send(user.phone)
-        if token_send=='pending':
-            user = form.save()
+        if token_send in (PENDING, COOLDOWN): # on cooldown, the code sent moments ago is still valid
+            if not form.save_user(user):
+                return super(UserCreate, self).form_invalid(form)
             messages.success(self.request, 'Your account has been created. Please Enter the code we\'ve sent to your number to ACTIVATE your account. Once activated, you can log into your account.')
             self.success_url = reverse_lazy("user_app:phone_verify", args = [user.uuid_value])
             return super(UserCreate, self).form_valid(form)
@@ -45,50 +95,75 @@ class UserCreate(FormView):
 
 
 
-class TwilioTokenSendAgain(View):
+@method_decorator(idempotent('token_send_again'), name='get')
+class TwilioTokenSendAgain(QueryBudgetMixin, UUIDUserMixin, View):
+    query_budget = 3
 
     def get(self, request, uuid_value):
-        user = customized_user_model.objects.get(uuid_value=uuid_value)
+        user = self.get_verifiable_uuid_user()
+        if user.is_active and not user.phone_temp:
+            # An active user only verifies a phone number change; there's nothing to send once it has expired
+            messages.error(self.request, PHONE_CHANGE_EXPIRED_MESSAGE)
+            return HttpResponseRedirect(reverse_lazy('user_app:phone_change'))
+        if is_rate_limited('send', request, phone=user.phone_temp or user.phone, uuid_value=user.uuid_value):
+            messages.error(self.request, RATE_LIMITED_MESSAGE)
+            return HttpResponseRedirect(reverse_lazy("user_app:phone_verify", args = [self.kwargs['uuid_value']]))
         token_send = twilio_verify.token_send(user.phone_temp or user.phone)
-        if token_send=='pending':
+        if token_send==PENDING:
             messages.success(self.request, f'We\'ve sent another confirmation code to {user.phone_temp or user.phone}. Please enter it')
+        elif token_send==COOLDOWN:
+            messages.info(self.request, CODE_ALREADY_SENT_MESSAGE)
         else:
             messages.error(self.request, f'Unfortunately, there has been an error sending a confirmation code to {user.phone_temp or user.phone}. Please try again.')
         return HttpResponseRedirect(reverse_lazy("user_app:phone_verify", args = [self.kwargs['uuid_value']]))
 
 
 
-class UserPhoneVerify(FormView):
+class UserPhoneVerify(QueryBudgetMixin, UUIDUserMixin, FormView):
     template_name = 'user_app/user_phone_verify_form.html'
     form_class = PhoneVerificationForm
     success_url = reverse_lazy("user_app:login")
+    query_budget = {'GET': 0, 'POST': 5}
 
     def form_valid(self, form):
-        user = customized_user_model.objects.get(uuid_value = self.kwargs['uuid_value'])
+        user = self.get_verifiable_uuid_user()
+        if user.is_active and not user.phone_temp:
+            # The phone number change has expired (or run out of attempts); the user mustn't be activated again
+            messages.error(self.request, PHONE_CHANGE_EXPIRED_MESSAGE)
+            return HttpResponseRedirect(reverse_lazy('user_app:phone_change'))
+        if is_rate_limited('verify', self.request, phone=user.phone_temp or user.phone, uuid_value=user.uuid_value):
+            messages.error(self.request, RATE_LIMITED_MESSAGE)
+            return super().form_invalid(form)
         token_verify = twilio_verify.token_verify(user.phone_temp or user.phone, form.cleaned_data['code'])
         if token_verify == 'approved':
             if user.phone_temp:
-                user.phone = user.phone_temp
-                user.phone_temp = None
-                user.save()
+                try:
+                    with transaction.atomic():
+                        user.promote_temp_phone()
+                except IntegrityError:
+                    # Someone else has claimed (and verified) the same number in the meantime
+                    messages.error(self.request, 'A user with this number already exists!')
+                    return super().form_invalid(form)
                 messages.success(self.request, 'Your phone number is changed!')
                 self.success_url = reverse_lazy('user_app:profile', args = [user.uuid_value])
             else:
-                user.is_active = True
                 user.customizedemaildevice_set.create(user=user, name=user.email)
-                user.save()
+                user.activate()
                 messages.success(self.request, 'Congratulations! Your account is now active. You can log into your account.')
             return super().form_valid(form)
         else:
+            if user.phone_temp:
+                user.record_pending_verification_attempt(PendingVerification.PHONE)
             messages.error(self.request, 'There has been an error verifying your code. Please try again')
             return super().form_invalid(form)
 
 
 
-class UserPhoneChange(LoginRequiredMixin, FormView):
+class UserPhoneChange(QueryBudgetMixin, LoginRequiredMixin, FormView):
     template_name = 'user_app/user_phone_change_form.html'
     form_class = PhoneChangeForm
     success_url = None
+    query_budget = {'GET': 2, 'POST': 5}
 
     def form_valid(self, form):
         user = self.request.user
@@ -98,32 +173,38 @@ class UserPhoneChange(LoginRequiredMixin, FormView):
             messages.error(self.request, 'You are already using this number!')
             return super().form_invalid(form)
 
+        # A single indexed EXISTS query; the unique constraint on "phone" is still the final guard (see "UserPhoneVerify")
+        if customized_user_model.objects.filter(phone=new_phone).exists():
+            messages.error(self.request, 'A user with this number already exists!')
+            return super().form_invalid(form)
+
+        if is_rate_limited('send', self.request, phone=new_phone, uuid_value=user.uuid_value):
+            messages.error(self.request, RATE_LIMITED_MESSAGE)
+            return super().form_invalid(form)
+
+        # Reserve the number before sending, so two accounts can't be verifying the same one
         try:
-            real_phone = user.phone
-            user.phone = new_phone
-            user.save()
-            user.phone = real_phone
-            user.save()
+            user.set_temp_phone(new_phone)
         except IntegrityError:
-            messages.error(self.request, 'A user with this number already exists!')
+            messages.error(self.request, 'This number is already being verified by another user!')
             return super().form_invalid(form)
 
         token_send = twilio_verify.token_send(new_phone)
-        if token_send=='pending':
-            user.phone_temp = new_phone
-            user.save()
+        if token_send in (PENDING, COOLDOWN):
             messages.success(self.request, 'We\'ve sent a confirmation code to your new number. Please enter it')
             self.success_url = reverse_lazy("user_app:phone_verify", args = [user.uuid_value])
             return super().form_valid(form)
         else:
+            user.clear_pending_verification(PendingVerification.PHONE)
             messages.error(self.request, 'Unfortunately, there has been an error sending a confirmation code to your new number. Please try again.')
             return super().form_invalid(form)
         
 
 
-class UserLogin(LoginView):
+class UserLogin(QueryBudgetMixin, LoginView):
     template_name = 'user_app/login.html'
     form_class = CustomizededAuthenticationForm # The built-in AuthenticationForm doesn't show inactive-account errors
+    query_budget = {'GET': 0, 'POST': 4}
 
     def get(self, request, *args, **kwargs):
         if request.user.is_authenticated:
@@ -139,25 +220,31 @@ class UserLogin(LoginView):
 
 
 
-class UserProfile(LoginRequiredMixin, DetailView):
+@method_decorator(condition(etag_func=profile_cache.etag, last_modified_func=profile_cache.last_modified), name='get')
+class UserProfile(QueryBudgetMixin, LoginRequiredMixin, DetailView):
     model = customized_user_model
     template_name = 'user_app/user_profile.html'
+    context_object_name = 'user'
+    query_budget = 3
 
     def get_object(self, queryset=None):
-        return get_object_or_404(customized_user_model, uuid_value=self.kwargs.get('uuid_value'))
+        # The profile is rendered from its cached data (a dict), not from the user row; see "profile_cache"
+        return profile_cache.get_entry(self.request, self.kwargs['uuid_value'])['data']
 
 
 
-class UserUpdate(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
+class UserUpdate(QueryBudgetMixin, LoginRequiredMixin, UserPassesTestMixin, UUIDUserMixin, UpdateView):
     model = customized_user_model
     fields = ['first_name', 'last_name', 'gender', ]
     template_name_suffix = '_update_form'
+    query_budget = {'GET': 3, 'POST': 4}
 
     def get_object(self, queryset=None):
-        return get_object_or_404(customized_user_model, uuid_value=self.kwargs.get('uuid_value'))
+        return self.get_uuid_user()
 
     def test_func(self):
-        if self.request.user == customized_user_model.objects.get(uuid_value = self.kwargs['uuid_value']):
+        # "get_uuid_user()" is memoized, so "get_object()" won't query the same user again
+        if self.request.user == self.get_uuid_user():
             return True
         return False
 
@@ -168,8 +255,9 @@ class UserUpdate(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
 
 
 @method_decorator(Email_Verification_Required, name='dispatch')
-class UserPasswordChange(PasswordChangeView):
+class UserPasswordChange(QueryBudgetMixin, PasswordChangeView):
     template_name = 'user_app/password_change_form.html'
+    query_budget = {'GET': 4, 'POST': 8}
     
     def get_success_url(self):
         messages.success(self.request, "Your password hass been changed!")
@@ -178,14 +266,15 @@ class UserPasswordChange(PasswordChangeView):
 
 
 @method_decorator(Email_Verification_Required, name='dispatch')
-class UserPasswordReset(PasswordResetView):
+class UserPasswordReset(QueryBudgetMixin, PasswordResetView):
     template_name = 'user_app/password_reset_form.html'
     email_template_name = 'user_app/password_reset_email.html'
     subject_template_name = 'user_app/password_reset_subject.txt'
     success_url = reverse_lazy('user_app:password_reset_done')
+    query_budget = {'GET': 3, 'POST': 3}
 
     def form_valid(self, form):
-        if not customized_user_model.objects.filter(email=form.cleaned_data.get("email")):
+        if not customized_user_model.objects.filter(email=form.cleaned_data.get("email")).exists():
             messages.error(self.request, 'No account found with that email! Please check the email address and try again.')
             return HttpResponseRedirect(reverse_lazy('user_app:password_reset'))
         return super().form_valid(form)
@@ -193,14 +282,16 @@ class UserPasswordReset(PasswordResetView):
 
 
 @method_decorator(Email_Verification_Required, name='dispatch')
-class UserPasswordResetDone(PasswordResetDoneView):
+class UserPasswordResetDone(QueryBudgetMixin, PasswordResetDoneView):
     template_name = 'user_app/password_reset_done.html'
+    query_budget = 1
 
 
 
 @method_decorator(Email_Verification_Required, name='dispatch')
-class UserPasswordResetConfirm(PasswordResetConfirmView):
+class UserPasswordResetConfirm(QueryBudgetMixin, PasswordResetConfirmView):
     template_name = 'user_app/password_reset_confirm.html'
+    query_budget = {'GET': 2, 'POST': 3}
     
     def get_success_url(self):
         messages.success(self.request, "Your password has been reset. Please login again with the new password.")
@@ -208,9 +299,10 @@ class UserPasswordResetConfirm(PasswordResetConfirmView):
 
 
 
-class UserEmailVerify(LoginRequiredMixin, LoginView):
+class UserEmailVerify(QueryBudgetMixin, LoginRequiredMixin, LoginView):
     template_name = 'user_app/user_email_verify_form.html'
     authentication_form = EmailVerificationForm
+    query_budget = {'GET': 3, 'POST': 7}
 
     def get_default_redirect_url(self):
         """Return the default redirect URL."""
@@ -221,9 +313,10 @@ class UserEmailVerify(LoginRequiredMixin, LoginView):
 
 
 @method_decorator(Email_Verification_Required, name='dispatch')
-class UserEmailChange(LoginRequiredMixin, LoginView):
+class UserEmailChange(QueryBudgetMixin, LoginRequiredMixin, LoginView):
     template_name = 'user_app/user_email_change_form.html'
     authentication_form = EmailChangeForm
+    query_budget = {'GET': 5, 'POST': 11}
     
     def get_default_redirect_url(self):
         """Return the default redirect URL."""
@@ -233,9 +326,10 @@ class UserEmailChange(LoginRequiredMixin, LoginView):
 
 
 
-class UserOTPVerify(LoginRequiredMixin, LoginView):
+class UserOTPVerify(QueryBudgetMixin, LoginRequiredMixin, LoginView):
     template_name = 'user_app/user_otp_verify_form.html'
     authentication_form = CustomizedOTPTokenForm
+    query_budget = {'GET': 5, 'POST': 10}
 
     def get_default_redirect_url(self):
         """Return the default redirect URL."""
@@ -245,23 +339,29 @@ class UserOTPVerify(LoginRequiredMixin, LoginView):
 
 
 
-class UserLogout(LogoutView):
+class UserLogout(QueryBudgetMixin, LogoutView):
     template_name = 'user_app/logout.html'
+    query_budget = 4
 
 
 
 @method_decorator(Email_Verification_Required, name='dispatch')
-@method_decorator(otp_required(redirect_field_name='next', login_url=reverse_lazy('user_app:otp_verify'), if_configured=False), name='dispatch')
-class UserDelete(FormView):
+@method_decorator(otp_required(redirect_field_name='next', login_url=reverse_lazy('user_app:otp_verify')), name='dispatch')
+class UserDelete(QueryBudgetMixin, FormView):
     template_name = 'user_app/user_delete_form.html'
     form_class = CustomizedUserDeletionForm
     success_url = reverse_lazy('user_app:logout')
+    query_budget = {'GET': 3, 'POST': 12}
 
     def form_valid(self, form):
         SadUser = self.request.user
         if SadUser.check_password(form.cleaned_data['password']):
             # It's not recommended to delete the user altogether; rather you can set SadUser.is_active = False
-            SadUser.delete()
+            if getattr(settings, 'USER_APP_ACCOUNT_DELETION_QUEUE', False):
+                # The account is deactivated now, and removed later by the "process_account_deletions" command
+                deletion.enqueue(SadUser)
+            else:
+                SadUser.delete()
             messages.info(self.request, "Your Account has been deleted!")
             return super().form_valid(form)
         else: